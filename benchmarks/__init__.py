@@ -0,0 +1,11 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Benchmarks for tss, run from the repository root as modules, for example
+
+    python -m benchmarks.load --output load.json
+    python -m benchmarks.micro --output micro.json
+    python -m benchmarks.compare before.json after.json
+"""
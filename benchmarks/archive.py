@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Time to copy a bucket in and out of the server with one PUT or GET per
+object by concurrent clients, versus one tar archive import or export.
+
+    python -m benchmarks.archive --objects 10000 --size 4K --output archive.json
+"""
+
+import argparse
+import http.client
+import io
+import os
+import sys
+import tarfile
+import tempfile
+import time
+
+from benchmarks.common import free_port, parse_size, start_server, write_results
+from benchmarks.load import run
+
+
+def make_archive(path, count, size):
+    with tarfile.open(path, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        for i in range(count):
+            info = tarfile.TarInfo("object-%d" % i)
+            info.size = size
+            archive.addfile(info, io.BytesIO(b"x" * size))
+
+
+def archive_request(port, method, path, body=None):
+    """Makes one archive request, streaming its body from a file. Returns the summary in the format of run()."""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    start = time.perf_counter()
+    try:
+        headers = {"Content-Length": str(os.fstat(body.fileno()).st_size)} if body is not None else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        while response.read(1024 * 1024):
+            pass
+        ok = response.status < 300
+    finally:
+        connection.close()
+    return {"seconds": time.perf_counter() - start, "errors": 0 if ok else 1}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--objects", type=int, default=10000)
+    parser.add_argument("--size", type=parse_size, default=4096)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=16, help="Clients for the requests per object")
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, - for stdout")
+    args = parser.parse_args()
+
+    port = free_port()
+    results = {}
+    with tempfile.TemporaryDirectory() as storage_root:
+        server = start_server(storage_root, port, args.workers, args=["--log-level=warning"])
+        try:
+            run(port, "PUT", ["/objects", "/archive"], 1)
+            paths = ["/objects/object-%d" % i for i in range(args.objects)]
+            for name, method, body in (("PUT per object", "PUT", b"x" * args.size), ("GET per object", "GET", None)):
+                start = time.perf_counter()
+                result = run(port, method, paths, args.concurrency, body, args.size)
+                results[name] = {"seconds": time.perf_counter() - start, "errors": result["errors"]}
+
+            archive_path = os.path.join(storage_root, "bench.tar")
+            make_archive(archive_path, args.objects, args.size)
+            with open(archive_path, "rb") as f:
+                results["POST archive"] = archive_request(port, "POST", "/archive?archive=tar", f)
+            results["GET archive"] = archive_request(port, "GET", "/archive?archive=tar")
+        finally:
+            server.terminate()
+            server.wait()
+
+    for name, result in results.items():
+        result["objects_per_second"] = args.objects / result["seconds"]
+        print("%-16s %8.2f s %10.0f objects/s  %d errors" % (
+            name, result["seconds"], result["objects_per_second"], result["errors"]), file=sys.stderr)
+    write_results(args.output, "archive", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Helpers shared by the benchmarks."""
+
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(value):
+    if value[-1].upper() in UNITS:
+        return int(value[:-1]) * UNITS[value[-1].upper()]
+    return int(value)
+
+
+def parse_count(value):
+    """Parses counts like 1k or 10M, in powers of ten."""
+    multipliers = {"K": 1000, "M": 1000 ** 2}
+    if value[-1].upper() in multipliers:
+        return int(value[:-1]) * multipliers[value[-1].upper()]
+    return int(value)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(storage_root, port, workers=1, app="tss:app", args=(), env=None):
+    """Starts gunicorn serving app on port, and waits until it accepts connections."""
+    env = dict(os.environ, TSS_STORAGE_ROOT=storage_root, **(env or {}))
+    env.pop("TSS_API_TOKEN", None)
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", f"--workers={workers}", f"--bind=127.0.0.1:{port}",
+                               *args, app], cwd=ROOT, env=env)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server did not start")
+
+
+def summarize(timings, elapsed=None, size=0):
+    """Summarizes a list of durations in seconds. With the elapsed wall clock time, throughput is included."""
+    timings = sorted(timings)
+    if not timings:
+        return {"count": 0}
+    result = {
+        "count": len(timings),
+        "mean": sum(timings) / len(timings),
+        "p50": timings[len(timings) // 2],
+        "p99": timings[min(int(len(timings) * 0.99), len(timings) - 1)],
+    }
+    if elapsed:
+        result["ops_per_second"] = len(timings) / elapsed
+        result["bytes_per_second"] = len(timings) * size / elapsed
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, benchmark, parameters, results):
+    """Writes results as JSON, with what is needed to tell runs apart."""
+    document = {
+        "benchmark": benchmark,
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "parameters": parameters,
+        "results": results,
+    }
+    if path == "-":
+        json.dump(document, sys.stdout, indent=2)
+        print()
+    else:
+        with open(path, "w") as f:
+            json.dump(document, f, indent=2)
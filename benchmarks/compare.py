@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Compares two result files of the same benchmark, by p50 and p99.
+
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import json
+
+
+def result_items(document):
+    """Yields (name, result) for the results of micro benchmarks, keyed by name, and of load tests, in a list."""
+    results = document["results"]
+    if isinstance(results, dict):
+        yield from results.items()
+    else:
+        for result in results:
+            yield "%s %d bytes %d keys" % (result["operation"], result["object_size"], result["bucket_size"]), result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    if before["benchmark"] != after["benchmark"]:
+        parser.error("Results are of different benchmarks")
+
+    after_results = dict(result_items(after))
+    for name, result in result_items(before):
+        other = after_results.get(name)
+        if other is None or "p50" not in result or "p50" not in other:
+            continue
+        print("%-40s p50 %+7.1f%%  p99 %+7.1f%%" % (name, (other["p50"] / result["p50"] - 1) * 100,
+                                                   (other["p99"] / result["p99"] - 1) * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Latency of small GETs while many slow clients are downloading a large
+object, for the sync gunicorn workers and for tss_asgi under uvicorn
+workers, which has to be installed for the second run.
+
+    python -m benchmarks.concurrency --slow-clients 1000 --requests 200
+"""
+
+import argparse
+import http.client
+import socket
+import statistics
+import tempfile
+import time
+
+from benchmarks.common import free_port, start_server
+
+
+MODES = {
+    "sync": ("tss:app", []),
+    "asgi": ("tss_asgi:app", ["--worker-class=uvicorn.workers.UvicornWorker"]),
+}
+
+
+def put(port, path, body=b""):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request("PUT", path, body=body)
+    assert connection.getresponse().status == 200
+    connection.close()
+
+
+def open_slow_clients(port, path, count):
+    """Starts count downloads that are never read, so the server sees clients that do not keep up."""
+    clients = []
+    for _ in range(count):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        s.sendall(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        clients.append(s)
+    return clients
+
+
+def measure(port, path, requests, timeout):
+    latencies = []
+    failures = 0
+    for _ in range(requests):
+        start = time.perf_counter()
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            if response.status != 200:
+                failures += 1
+                continue
+        except OSError:
+            failures += 1
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default="sync,asgi")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--slow-clients", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--large-size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--timeout", type=float, default=5.0)
+    args = parser.parse_args()
+
+    for mode in args.modes.split(","):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as storage_root:
+            app, worker_args = MODES[mode]
+            server = start_server(storage_root, port, args.workers, app=app,
+                                  args=["--backlog=4096", "--timeout=600", *worker_args])
+            clients = []
+            try:
+                put(port, "/bench")
+                put(port, "/bench/small", b"x" * 100)
+                put(port, "/bench/large", b"\0" * args.large_size)
+                clients = open_slow_clients(port, "/bench/large", args.slow_clients)
+                time.sleep(1)
+                latencies, failures = measure(port, "/bench/small", args.requests, args.timeout)
+                if latencies:
+                    latencies.sort()
+                    print("%-5s  %5d slow clients  p50 %8.2f ms  p99 %8.2f ms  %d of %d failed" % (
+                        mode, args.slow_clients, statistics.median(latencies) * 1000,
+                        latencies[int(len(latencies) * 0.99) - 1] * 1000, failures, args.requests))
+                else:
+                    print("%-5s  %5d slow clients  all %d requests failed" % (mode, args.slow_clients, args.requests))
+            finally:
+                for s in clients:
+                    s.close()
+                server.terminate()
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
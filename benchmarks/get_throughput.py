@@ -0,0 +1,69 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+GET throughput for large objects, served by gunicorn so that responses go
+through its wsgi.file_wrapper and os.sendfile().
+
+    python -m benchmarks.get_throughput --sizes 1M,16M,256M,1G --requests 5
+"""
+
+import argparse
+import http.client
+import tempfile
+import time
+
+from benchmarks.common import UNITS, free_port, parse_size, start_server
+
+
+def upload(port, path, size):
+    with tempfile.TemporaryFile() as f:
+        f.truncate(size)
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        connection.request("PUT", path, body=f, headers={"Content-Length": str(size)})
+        assert connection.getresponse().status == 200
+        connection.close()
+
+
+def download(connection, path, headers={}):
+    connection.request("GET", path, headers=headers)
+    response = connection.getresponse()
+    assert response.status in (200, 206)
+    total = 0
+    while True:
+        data = response.read(1024 * 1024)
+        if not data:
+            return total
+        total += len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1M,16M,256M,1G")
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    port = free_port()
+    with tempfile.TemporaryDirectory() as storage_root:
+        server = start_server(storage_root, port, args.workers)
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            connection.request("PUT", "/bench")
+            assert connection.getresponse().status == 200
+            for size in map(parse_size, args.sizes.split(",")):
+                path = f"/bench/object-{size}"
+                upload(port, path, size)
+                for name, headers in (("full", {}), ("range", {"Range": f"bytes={size // 2}-"})):
+                    start = time.perf_counter()
+                    total = sum(download(connection, path, headers) for _ in range(args.requests))
+                    elapsed = time.perf_counter() - start
+                    print("%12d bytes  %-5s  %8.1f MB/s" % (size, name, total / elapsed / UNITS["M"]))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
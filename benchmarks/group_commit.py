@@ -0,0 +1,78 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Throughput of small PUTs by concurrent clients, with every write in a
+transaction of its own, merged by a committer thread in each gthread
+worker, and merged across sync workers by the commit service. Merging
+only pays off where a commit has to wait for the disk, so use --directory
+to put the storage root on the disk of interest.
+
+    python -m benchmarks.group_commit --workers 8 --concurrency 64 --requests 5000 --output group_commit.json
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import ROOT, free_port, parse_size, start_server, write_results
+from benchmarks.load import run
+
+
+def start_commit_service(storage_root):
+    env = dict(os.environ, FLASK_APP="tss", TSS_STORAGE_ROOT=storage_root)
+    service = subprocess.Popen([sys.executable, "-m", "flask", "commit-service"], cwd=ROOT, env=env)
+    for _ in range(100):
+        if os.path.exists(os.path.join(storage_root, "commit.sock")):
+            return service
+        time.sleep(0.1)
+    service.terminate()
+    raise RuntimeError("Commit service did not start")
+
+
+def measure(mode, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory(dir=args.directory) as storage_root:
+        service = start_commit_service(storage_root) if mode == "service" else None
+        worker_args = ["--worker-class=gthread", f"--threads={args.threads}"] if mode == "thread" else []
+        server = start_server(storage_root, port, args.workers, args=worker_args, env={"TSS_GROUP_COMMIT": mode})
+        try:
+            run(port, "PUT", ["/bench"], 1)
+            paths = ["/bench/object-%d" % i for i in range(args.requests)]
+            return run(port, "PUT", paths, args.concurrency, b"x" * args.size, args.size)
+        finally:
+            server.terminate()
+            server.wait()
+            if service is not None:
+                service.terminate()
+                service.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default="none,thread,service")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=8, help="Threads of each worker in thread mode")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--size", type=parse_size, default=1024)
+    parser.add_argument("--directory", default=None,
+                        help="Where to create the storage root, on the disk to measure the commits of")
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, - for stdout")
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes.split(","):
+        results[mode] = measure(mode, args)
+        print("%-8s %8.0f PUT/s  p50 %7.2f ms  p99 %7.2f ms  %d errors" % (
+            mode, results[mode]["ops_per_second"], results[mode]["p50"] * 1000, results[mode]["p99"] * 1000,
+            results[mode]["errors"]), file=sys.stderr)
+    write_results(args.output, "group_commit", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
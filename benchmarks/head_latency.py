@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+HEAD latency with the shared per-process LMDB environment, compared to
+opening the environment on every request like the old flask.g cache did.
+
+    python -m benchmarks.head_latency --requests 5000
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+
+import tss
+
+
+def measure(client, url, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        r = client.head(url)
+        timings.append(time.perf_counter() - start)
+        assert r.status_code == 200
+    timings.sort()
+    return {
+        "mean": statistics.mean(timings),
+        "p50": timings[len(timings) // 2],
+        "p99": timings[int(len(timings) * 0.99)],
+    }
+
+
+def reopen_per_request(exception):
+    tss.close_lmdb_env()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as storage_root:
+        tss.app.config["STORAGE_ROOT"] = storage_root
+        client = tss.app.test_client()
+        client.put("/bench")
+        client.put("/bench/object.txt", data="benchmark", headers={"Content-Type": "text/plain"})
+
+        results = {"shared": measure(client, "/bench/object.txt", args.requests)}
+
+        tss.app.teardown_request_funcs.setdefault(None, []).append(reopen_per_request)
+        try:
+            results["per-request"] = measure(client, "/bench/object.txt", args.requests)
+        finally:
+            tss.app.teardown_request_funcs[None].remove(reopen_per_request)
+
+    for name, result in results.items():
+        print("%-12s mean %7.1fus  p50 %7.1fus  p99 %7.1fus" % (name, result["mean"] * 1e6, result["p50"] * 1e6,
+                                                               result["p99"] * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Load test of a locally started gunicorn server. For every bucket size a
+bucket is seeded with that many keys, directly in LMDB, after which PUT,
+GET, HEAD, list and DELETE requests are made for every object size by
+concurrent clients.
+
+    python -m benchmarks.load --sizes 1K,1M --bucket-sizes 1k,1M --concurrency 16 --output load.json
+"""
+
+import argparse
+import concurrent.futures
+import http.client
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.common import free_port, parse_count, parse_size, start_server, summarize, write_results
+
+import tss
+
+
+SEED_BATCH_SIZE = 100000
+
+
+def seed_bucket(storage_root, bucket_name, count):
+    """Creates a bucket with count objects that only have metadata, which is enough for HEAD and listings."""
+    tss.app.config["STORAGE_ROOT"] = storage_root
+    with tss.app.test_client() as client:
+        assert client.put(f"/{bucket_name}").status_code == 200
+    meta_data = {"Content-Type": "text/plain", "Content-Length": "0", "ETag": '"seed"',
+                 "Last-Modified": "Thu, 01 Jan 2020 00:00:00 GMT"}
+    for start in range(0, count, SEED_BATCH_SIZE):
+        with tss.get_lmdb_env().begin(write=True) as tx:
+            for i in range(start, min(start + SEED_BATCH_SIZE, count)):
+                tss.write_metadata(tx, bucket_name, seed_name(i), meta_data)
+    tss.close_lmdb_env()
+
+
+def seed_name(i):
+    return "seed/%08d" % i
+
+
+def run(port, method, paths, concurrency, body=None, size=0):
+    """Makes one request per path with concurrency clients. Returns the summary of the successful ones."""
+    local = threading.local()
+
+    def request(path):
+        if not hasattr(local, "connection"):
+            local.connection = http.client.HTTPConnection("127.0.0.1", port)
+        start = time.perf_counter()
+        try:
+            local.connection.request(method, path, body=body)
+            response = local.connection.getresponse()
+            response.read()
+            ok = response.status < 300
+        except (OSError, http.client.HTTPException):
+            local.connection.close()
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(request, paths))
+    elapsed = time.perf_counter() - start
+    summary = summarize([timing for timing, ok in results if ok], elapsed, size)
+    summary["errors"] = sum(1 for _, ok in results if not ok)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1K,64K,1M", help="Object sizes")
+    parser.add_argument("--bucket-sizes", default="1k,100k", help="Number of keys in the bucket, like 1k or 10M")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per operation")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, - for stdout")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    bucket_sizes = [parse_count(count) for count in args.bucket_sizes.split(",")]
+    results = []
+    with tempfile.TemporaryDirectory() as storage_root:
+        for bucket_size in bucket_sizes:
+            seed_bucket(storage_root, f"bench-{bucket_size}", bucket_size)
+
+        port = free_port()
+        server = start_server(storage_root, port, args.workers, args=["--log-level=warning"])
+        try:
+            for bucket_size in bucket_sizes:
+                bucket = f"/bench-{bucket_size}"
+                for size in sizes:
+                    body = os.urandom(size)
+                    paths = [f"{bucket}/load/{size}/{i}" for i in range(args.requests)]
+                    operations = {
+                        "PUT": run(port, "PUT", paths, args.concurrency, body, size),
+                        "GET": run(port, "GET", paths, args.concurrency, size=size),
+                        "HEAD": run(port, "HEAD", paths, args.concurrency),
+                    }
+                    starts = [seed_name(rng.randrange(bucket_size)) for _ in range(args.requests)]
+                    operations["LIST"] = run(port, "GET", [f"{bucket}?prefix=seed/&max-keys=100&start-after={start}"
+                                                           for start in starts], args.concurrency)
+                    operations["DELETE"] = run(port, "DELETE", paths, args.concurrency)
+                    for operation, summary in operations.items():
+                        results.append({"operation": operation, "object_size": size, "bucket_size": bucket_size,
+                                        **summary})
+                        print("%-6s %10d bytes %10d keys  p50 %8.2f ms  p99 %8.2f ms  %8.1f ops/s  %d errors" % (
+                            operation, size, bucket_size, summary.get("p50", 0) * 1000, summary.get("p99", 0) * 1000,
+                            summary.get("ops_per_second", 0), summary["errors"]), file=sys.stderr)
+        finally:
+            server.terminate()
+            server.wait()
+
+    write_results(args.output, "load", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Micro benchmarks of the functions on the request path: object paths, keys,
+metadata packing and LMDB metadata reads and writes.
+
+    python -m benchmarks.micro --output micro.json
+"""
+
+import argparse
+import sys
+import tempfile
+import timeit
+
+from benchmarks.common import summarize, write_results
+
+import tss
+
+
+META_DATA = {"Content-Type": "application/json", "Content-Encoding": "identity", "Content-Length": "1234",
+             "ETag": '"%s"' % ("0" * 64), "Last-Modified": "Thu, 01 Jan 2020 00:00:00 GMT", "X-Tss-Owner": "bench"}
+
+
+def measure(function, repeat, number):
+    """Returns the summary of repeat runs of function, each the mean of number calls, in seconds per call."""
+    return summarize([timing / number for timing in timeit.repeat(function, repeat=repeat, number=number)])
+
+
+def lmdb_benchmarks(keys, batch_size):
+    def read():
+        with tss.get_lmdb_env().begin() as tx:
+            tss.read_metadata(tx, "bench", "object-%d" % (keys // 2))
+
+    def write():
+        with tss.get_lmdb_env().begin(write=True) as tx:
+            tss.write_metadata(tx, "bench", "object-%d" % (keys // 2), META_DATA)
+
+    def write_batch():
+        with tss.get_lmdb_env().begin(write=True) as tx:
+            for i in range(batch_size):
+                tss.write_metadata(tx, "bench", "object-%d" % i, META_DATA)
+
+    def read_batch():
+        with tss.get_lmdb_env().begin() as tx:
+            for i in range(batch_size):
+                tss.read_metadata(tx, "bench", "object-%d" % i)
+
+    return {"read_metadata": (read, 1), "write_metadata": (write, 1),
+            "read_metadata_batch": (read_batch, batch_size), "write_metadata_batch": (write_batch, batch_size)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=10000, help="Calls per repeat")
+    parser.add_argument("--keys", type=int, default=100000, help="Objects in the LMDB database")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Objects per transaction for the batch benchmarks")
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, - for stdout")
+    args = parser.parse_args()
+
+    packed = tss.pack_metadata(META_DATA)
+    functions = {
+        "make_object_path": lambda: tss.make_object_path("/data", "bench", "some/object/name.json"),
+        "split_key": lambda: tss.split_key(b"bench:some/object/name.json:Content-Type"),
+        "key_prefix": lambda: tss.key_prefix("bench", "some/object/name.json"),
+        "pack_metadata": lambda: tss.pack_metadata(META_DATA),
+        "unpack_metadata": lambda: tss.unpack_metadata(packed),
+    }
+    results = {}
+    for name, function in functions.items():
+        results[name] = measure(function, args.repeat, args.number)
+
+    with tempfile.TemporaryDirectory() as storage_root:
+        tss.app.config["STORAGE_ROOT"] = storage_root
+        with tss.get_lmdb_env().begin(write=True) as tx:
+            for i in range(args.keys):
+                tss.write_metadata(tx, "bench", "object-%d" % i, META_DATA)
+        for name, (function, calls) in lmdb_benchmarks(args.keys, args.batch_size).items():
+            number = max(args.number // calls // 10, 1)
+            summary = measure(function, args.repeat, number)
+            # Per object, also for the batches
+            results[name] = {key: value / calls if key != "count" else value for key, value in summary.items()}
+        tss.close_lmdb_env()
+
+    for name, result in results.items():
+        print("%-22s mean %8.2f us  p50 %8.2f us" % (name, result["mean"] * 1e6, result["p50"] * 1e6), file=sys.stderr)
+    write_results(args.output, "micro", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
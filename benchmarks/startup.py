@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Cold start of the server: the time to import tss as reported by
+python -X importtime, the time until gunicorn answers the first request,
+and the memory of each worker, with and without --preload. PSS counts
+pages shared with the master and the other workers in parts, so it shows
+what preloading saves where RSS does not.
+
+    python -m benchmarks.startup --workers 8 --output startup.json
+"""
+
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import ROOT, free_port, start_server, summarize, write_results
+
+
+def import_time(module):
+    """Returns the cumulative import time of module in seconds, and the slowest modules it imports."""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], cwd=ROOT,
+                            stderr=subprocess.PIPE, check=True).stderr.decode()
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(cumulative) / 1e6))
+    total = next(seconds for name, seconds in imports if name == module)
+    return total, sorted(imports, key=lambda item: item[1], reverse=True)
+
+
+def worker_pids(master):
+    pids = []
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    # The command name in parentheses may contain spaces
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == master:
+                pids.append(int(name))
+    return pids
+
+
+def memory(pid):
+    """Returns the RSS and PSS of a process in bytes, PSS is None where the kernel does not report it."""
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line and not line[0].isdigit())
+        return int(fields["Rss"].split()[0]) * 1024, int(fields["Pss"].split()[0]) * 1024
+    except (OSError, KeyError):
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmRSS"].split()[0]) * 1024, None
+
+
+def request(port, method, path, body=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request(method, path, body=body)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def serve(workers, preload, requests):
+    """Starts gunicorn and returns the seconds until it answered the first request, and the memory of its workers."""
+    port = free_port()
+    with tempfile.TemporaryDirectory() as storage_root:
+        start = time.perf_counter()
+        server = start_server(storage_root, port, workers, args=["--preload"] if preload else [])
+        try:
+            assert request(port, "PUT", "/bench") == 200
+            elapsed = time.perf_counter() - start
+            assert request(port, "PUT", "/bench/object", b"x") == 200
+            # Requests go to any worker, with enough of them each has opened the environment
+            for _ in range(requests):
+                request(port, "GET", "/bench/object")
+            pids = worker_pids(server.pid)
+            return elapsed, [memory(pid) for pid in pids]
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200, help="Requests before the memory of the workers is read")
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to show")
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, - for stdout")
+    args = parser.parse_args()
+
+    results = {}
+    timings = []
+    for _ in range(args.repeat):
+        total, imports = import_time("tss")
+        timings.append(total)
+    results["import"] = summarize(timings)
+    for name, seconds in imports[:args.top]:
+        print("%-40s %8.1f ms" % (name, seconds * 1000), file=sys.stderr)
+
+    for preload in (False, True):
+        suffix = " --preload" if preload else ""
+        timings, rss, pss = [], [], []
+        for _ in range(args.repeat):
+            elapsed, workers = serve(args.workers, preload, args.requests)
+            timings.append(elapsed)
+            rss.extend(worker_rss for worker_rss, _ in workers)
+            pss.extend(worker_pss for _, worker_pss in workers if worker_pss is not None)
+        results["startup" + suffix] = summarize(timings)
+        results["worker rss" + suffix] = summarize(rss)
+        if pss:
+            results["worker pss" + suffix] = summarize(pss)
+
+    for name, result in results.items():
+        unit, scale = ("MB", 1 / 1024 ** 2) if name.startswith("worker") else ("ms", 1000)
+        print("%-22s p50 %8.1f %s" % (name, result["p50"] * scale, unit), file=sys.stderr)
+    write_results(args.output, "startup", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Throughput of PUT and GET with object data spread over one and up to all
+of the given volumes. Give one directory per disk, each on its own
+filesystem. Objects larger than the page cache, or a dropped cache between
+the phases, keep the GETs from being served from memory.
+
+    python -m benchmarks.volumes --volumes /mnt/nvme0,/mnt/nvme1,/mnt/nvme2 --size 4M --output volumes.json
+"""
+
+import argparse
+import contextlib
+import sys
+import tempfile
+
+from benchmarks.common import free_port, parse_size, start_server, write_results
+from benchmarks.load import run
+
+
+def measure(directories, args):
+    port = free_port()
+    with contextlib.ExitStack() as stack:
+        roots = [stack.enter_context(tempfile.TemporaryDirectory(dir=directory)) for directory in directories]
+        server = start_server(",".join(roots), port, args.workers)
+        try:
+            run(port, "PUT", ["/bench"], 1)
+            paths = ["/bench/object-%d" % i for i in range(args.requests)]
+            return {
+                "PUT": run(port, "PUT", paths, args.concurrency, b"x" * args.size, args.size),
+                "GET": run(port, "GET", paths, args.concurrency, size=args.size),
+            }
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--volumes", required=True, help="Comma separated directories, one per disk")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--size", type=parse_size, default=1024 * 1024)
+    parser.add_argument("--output", default="-", help="File to write the JSON results to, - for stdout")
+    args = parser.parse_args()
+
+    directories = args.volumes.split(",")
+    results = {}
+    for count in range(1, len(directories) + 1):
+        for method, result in measure(directories[:count], args).items():
+            name = "%s %d volumes" % (method, count)
+            results[name] = result
+            print("%-16s %8.0f req/s %8.1f MB/s  %d errors" % (
+                name, result["ops_per_second"], result.get("bytes_per_second", 0) / 1024 ** 2, result["errors"]),
+                file=sys.stderr)
+    write_results(args.output, "volumes", vars(args), results)
+
+
+if __name__ == "__main__":
+    main()
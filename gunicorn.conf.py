@@ -0,0 +1,29 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Read by gunicorn from the working directory.
+
+import gc
+import glob
+import os
+
+
+def on_starting(server):
+    # Workers continue the metrics files left by earlier processes with
+    # their pid, so the files of the previous run are removed before the
+    # first worker starts. Like tss.py, the directory defaults to metrics in
+    # the first data root of TSS_STORAGE_ROOT.
+    storage_root = os.getenv("TSS_STORAGE_ROOT", "/data").split(",")[0].strip().partition(":")[0]
+    directory = os.getenv("TSS_METRICS_DIR") or os.path.join(storage_root, "metrics")
+    for path in glob.glob(os.path.join(directory, "*.json")) + glob.glob(os.path.join(directory, "*.metrics")):
+        os.remove(path)
+
+
+def when_ready(server):
+    # With --preload the app is imported in the master before the workers are
+    # forked. Freezing what it allocated keeps the garbage collector of the
+    # workers from writing to those objects, which would copy the pages they
+    # share with the master. gc.freeze() is new in Python 3.7.
+    if server.cfg.preload_app and hasattr(gc, "freeze"):
+        gc.freeze()
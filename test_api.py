@@ -3,7 +3,12 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import io
+import os
+import pathlib
 import re
+import subprocess
+import sys
 import flask
 import pytest
 import tss
@@ -142,3 +147,86 @@ def test_put_object_sizes_image_png(client):
         assert r.status_code == 200
         assert r.headers["Content-Type"] == "image/png"
         assert r.data == data
+
+class FailingStream(io.BytesIO):
+    def read(self, size=-1):
+        data = super().read(size)
+        if not data:
+            raise IOError("Connection reset")
+        return data
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def test_put_object_streaming(client):
+    r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    tss.app.config["UPLOAD_CHUNK_SIZE"] = 1000
+    try:
+        data = bytes(range(256)) * 100
+        r = client.put(flask.url_for('put_object', bucket_name="test", object_name="test.bin"), data=data)
+        assert r.status_code == 200
+    finally:
+        tss.app.config["UPLOAD_CHUNK_SIZE"] = 64 * 1024
+    r = client.get(flask.url_for('get_object', bucket_name="test", object_name="test.bin"))
+    assert r.status_code == 200
+    assert r.headers["Content-Length"] == str(len(data))
+    assert r.data == data
+
+def test_put_object_failed_upload_keeps_object(client):
+    r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    r = client.put(flask.url_for('put_object', bucket_name="test", object_name="test.txt"), data="test")
+    assert r.status_code == 200
+    # An upload that breaks halfway must not replace the existing object or leave files behind
+    r = client.put(flask.url_for('put_object', bucket_name="test", object_name="test.txt"),
+                   input_stream=FailingStream(b"broken"), environ_overrides={"CONTENT_LENGTH": "100"})
+    assert r.status_code == 400
+    r = client.get(flask.url_for('get_object', bucket_name="test", object_name="test.txt"))
+    assert r.status_code == 200
+    assert r.data == b"test"
+    object_path = tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "test.txt")
+    assert [p.name for p in object_path.parent.iterdir()] == [object_path.name]
+
+@pytest.mark.parametrize("fsync", tss.FSYNC_POLICIES)
+def test_put_object_fsync(client, fsync):
+    tss.app.config["FSYNC"] = fsync
+    try:
+        r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+        assert r.status_code == 200
+        r = client.put(flask.url_for('put_object', bucket_name="test", object_name="test.txt"), data="test")
+        assert r.status_code == 200
+    finally:
+        tss.app.config["FSYNC"] = "none"
+    r = client.get(flask.url_for('get_object', bucket_name="test", object_name="test.txt"))
+    assert r.status_code == 200
+    assert r.data == b"test"
+
+def test_invalid_fsync_policy():
+    # Fails when the app is loaded rather than on every upload
+    env = dict(os.environ, TSS_FSYNC="always")
+    result = subprocess.run([sys.executable, "-c", "import tss"], cwd=pathlib.Path(__file__).parent, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode != 0
+    assert b"Unknown TSS_FSYNC policy 'always'" in result.stderr
+
+def test_replica_header_without_cluster(client):
+    client.put(flask.url_for('put_bucket', bucket_name="test"))
+    url = flask.url_for('put_object', bucket_name="test", object_name="test.txt")
+    headers = {"Tss-Replica": "1", "Tss-Version": "1"}
+    assert client.put(url, data="test", headers=headers).status_code == 403
+    assert client.head(url).status_code == 404
+
+def test_get_object_without_file(client):
+    r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    r = client.put(flask.url_for('put_object', bucket_name="test", object_name="test.txt"), data="test")
+    assert r.status_code == 200
+    tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "test.txt").unlink()
+    r = client.head(flask.url_for('get_object', bucket_name="test", object_name="test.txt"))
+    assert r.status_code == 200
+    r = client.get(flask.url_for('get_object', bucket_name="test", object_name="test.txt"))
+    assert r.status_code == 404
+    r = client.delete(flask.url_for('delete_object', bucket_name="test", object_name="test.txt"))
+    assert r.status_code == 200
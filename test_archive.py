@@ -0,0 +1,183 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import calendar
+import io
+import json
+import pathlib
+import tarfile
+import time
+import flask
+import pytest
+import tss
+from werkzeug.http import http_date, parse_date
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+    app.config["DEDUP"] = False
+    app.config["INLINE_THRESHOLD"] = 0
+
+def object_url(object_name, bucket_name="test"):
+    return flask.url_for('get_object', bucket_name=bucket_name, object_name=object_name)
+
+def archive_url(bucket_name="test", **args):
+    return flask.url_for('get_bucket', bucket_name=bucket_name, archive="tar", **args)
+
+def export(client, bucket_name="test", **args):
+    r = client.get(archive_url(bucket_name, **args))
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-tar"
+    assert len(r.data) % tarfile.RECORDSIZE == 0
+    with tarfile.open(fileobj=io.BytesIO(r.data), mode="r:", encoding="utf-8") as archive:
+        return {member.name: (member, archive.extractfile(member).read()) for member in archive}
+
+def make_archive(files, mtime=1600000000):
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w", format=tarfile.PAX_FORMAT, encoding="utf-8") as archive:
+        for name, data, pax_headers in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = mtime
+            info.pax_headers = pax_headers
+            archive.addfile(info, io.BytesIO(data))
+    return f.getvalue()
+
+def temp_files():
+    return list(pathlib.Path(tss.app.config["STORAGE_ROOT"]).rglob(".tmp-*"))
+
+def test_export(client):
+    long_name = "a/" + "long-name/" * 20 + "ünïcode.txt"
+    client.put(object_url("b.txt"), data=b"b", headers={"Content-Type": "text/plain", "X-Tss-Owner": "me"})
+    client.put(object_url(long_name), data=b"long")
+    client.put(object_url("c/empty"), data=b"")
+    members = export(client)
+    assert list(members) == [long_name, "b.txt", "c/empty"]
+    member, data = members["b.txt"]
+    assert data == b"b"
+    assert member.pax_headers["TSS.Content-Type"] == "text/plain"
+    assert member.pax_headers["TSS.X-Tss-Owner"] == "me"
+    assert member.pax_headers["TSS.ETag"] == client.head(object_url("b.txt")).headers["ETag"]
+    assert http_date(member.mtime) == client.head(object_url("b.txt")).headers["Last-Modified"]
+    assert members[long_name][1] == b"long"
+    assert members["c/empty"][1] == b""
+    assert list(export(client, prefix="c/")) == ["c/empty"]
+
+def test_export_time_zone(client, monkeypatch):
+    # The modification time does not depend on the time zone of the server
+    client.put(object_url("a"), data=b"a")
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        member, _ = export(client)["a"]
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert http_date(member.mtime) == client.head(object_url("a")).headers["Last-Modified"]
+
+def test_export_without_last_modified(client):
+    client.put(object_url("a"), data=b"a")
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        meta_data = tss.read_metadata(tx, "test", "a")
+        del meta_data["Last-Modified"]
+        tss.write_metadata(tx, "test", "a", meta_data)
+    member, data = export(client)["a"]
+    assert (member.mtime, data) == (0, b"a")
+
+def test_export_in_chunks(client, monkeypatch):
+    monkeypatch.setattr(tss, "EXPORT_CHUNK_SIZE", 2)
+    for i in range(5):
+        client.put(object_url("object-%d" % i), data=b"data %d" % i)
+    members = export(client)
+    assert {name: data for name, (_, data) in members.items()} == {"object-%d" % i: b"data %d" % i for i in range(5)}
+
+def test_export_404(client):
+    assert client.get(archive_url("unknown")).status_code == 404
+    assert client.get(flask.url_for('get_bucket', bucket_name="test", archive="zip")).status_code == 400
+
+def test_import(client):
+    archive = make_archive([
+        ("./a.txt", b"a", {"TSS.Content-Type": "text/plain", "TSS.X-Tss-Owner": "me", "TSS.Tss-Inline": "1"}),
+        ("dir/b", b"b" * 100000, {}),
+    ])
+    r = client.post(archive_url(), data=archive)
+    assert r.status_code == 200
+    assert r.json == {"Objects": 2}
+    r = client.get(object_url("a.txt"))
+    assert r.data == b"a"
+    assert r.mimetype == "text/plain"
+    assert r.headers["X-Tss-Owner"] == "me"
+    assert r.headers["Last-Modified"] == http_date(1600000000)
+    r = client.get(object_url("dir/b"))
+    assert r.data == b"b" * 100000
+    assert r.headers["Content-Type"] == "application/octet-stream"
+    assert temp_files() == []
+
+def test_import_without_mtime(client):
+    start = int(time.time())
+    assert client.post(archive_url(), data=make_archive([("a", b"a", {})], mtime=0)).json == {"Objects": 1}
+    last_modified = parse_date(client.head(object_url("a")).headers["Last-Modified"])
+    assert start <= calendar.timegm(last_modified.utctimetuple()) <= time.time()
+
+def test_import_in_batches(client):
+    tss.app.config["ARCHIVE_BATCH_SIZE"] = 3
+    try:
+        archive = make_archive([("object-%d" % i, b"data %d" % i, {}) for i in range(10)])
+        assert client.post(archive_url(), data=archive).json == {"Objects": 10}
+    finally:
+        tss.app.config["ARCHIVE_BATCH_SIZE"] = 100
+    for i in range(10):
+        assert client.get(object_url("object-%d" % i)).data == b"data %d" % i
+
+def test_import_gzip(client):
+    f = io.BytesIO()
+    with tarfile.open(fileobj=f, mode="w:gz") as archive:
+        info = tarfile.TarInfo("a")
+        info.size = 1
+        archive.addfile(info, io.BytesIO(b"a"))
+    assert client.post(archive_url(), data=f.getvalue()).json == {"Objects": 1}
+    assert client.get(object_url("a")).data == b"a"
+
+def test_import_invalid(client):
+    assert client.post(archive_url("unknown"), data=make_archive([])).status_code == 404
+    assert client.post(archive_url(), data=b"not a tar file" * 100).status_code == 400
+    archive = make_archive([("a", b"a" * 100000, {})])
+    assert client.post(archive_url(), data=archive[:50000]).status_code == 400
+    assert client.head(object_url("a")).status_code == 404
+    assert temp_files() == []
+
+@pytest.mark.parametrize("dedup", [False, True])
+def test_round_trip(client, dedup):
+    tss.app.config["DEDUP"] = dedup
+    tss.app.config["INLINE_THRESHOLD"] = 10
+    settings = {"Compression": {"Algorithm": "gzip", "ContentTypes": ["application/json"]}}
+    client.put(flask.url_for('put_bucket', bucket_name="source"), data=json.dumps(settings))
+    objects = {
+        "small": (b"tiny", "text/plain"),
+        "small.json": (b"[1, 2]", "application/json"),
+        "large": (b"x" * 100000, "text/plain"),
+        "large.json": (json.dumps(list(range(10000))).encode(), "application/json"),
+        "copy.json": (json.dumps(list(range(10000))).encode(), "application/json"),
+    }
+    for name, (data, content_type) in objects.items():
+        client.put(object_url(name, "source"), data=data, headers={"Content-Type": content_type})
+    archive = client.get(archive_url("source")).data
+    client.put(flask.url_for('put_bucket', bucket_name="copy"), data=json.dumps(settings))
+    assert client.post(archive_url("copy"), data=archive).json == {"Objects": len(objects)}
+    for name, (data, content_type) in objects.items():
+        original = client.get(object_url(name, "source"))
+        copy = client.get(object_url(name, "copy"))
+        assert copy.data == data
+        for header in ("Content-Type", "Content-Length", "ETag", "Last-Modified"):
+            assert copy.headers[header] == original.headers[header]
+    assert temp_files() == []
@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import asyncio
+import hashlib
+import pytest
+import tss
+import tss_asgi
+
+
+@pytest.fixture
+def storage_root(tmpdir_factory):
+    tss.app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    tss.app.config["SERVER_NAME"] = "localhost"
+    assert request("PUT", "/test")[0] == 200
+
+async def call(method, path, body_chunks, headers, query_string=b""):
+    scope = {"type": "http", "http_version": "1.1", "method": method, "path": path, "query_string": query_string,
+             "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+             "server": ("localhost", 80), "client": ("127.0.0.1", 1234), "scheme": "http"}
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(body_chunks) - 1}
+                for i, chunk in enumerate(body_chunks)] or [{"type": "http.request", "body": b""}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await tss_asgi.app(scope, receive, send)
+    return sent
+
+def run(coroutine):
+    # Like asyncio.run(), which needs Python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+def request(method, path, body_chunks=(), headers={}, query_string=b""):
+    sent = run(call(method, path, list(body_chunks), headers, query_string))
+    assert sent[0]["type"] == "http.response.start"
+    assert sent[-1]["more_body"] is False
+    return sent[0]["status"], dict(sent[0]["headers"]), b"".join(message["body"] for message in sent[1:])
+
+def test_put_and_get(storage_root):
+    chunks = [b"a" * 100000, b"b" * 100000, b"c"]
+    status, _, _ = request("PUT", "/test/streamed.bin", chunks, {"Content-Type": "application/test"})
+    assert status == 200
+    status, headers, body = request("GET", "/test/streamed.bin")
+    assert status == 200
+    assert body == b"".join(chunks)
+    assert headers[b"content-type"] == b"application/test"
+    assert headers[b"etag"] == b'"%s"' % hashlib.sha256(body).hexdigest().encode()
+
+def test_content_length_upload(storage_root):
+    status, _, _ = request("PUT", "/test/sized.bin", [b"12345", b"67890"], {"Content-Length": "10"})
+    assert status == 200
+    assert request("GET", "/test/sized.bin")[2] == b"1234567890"
+    # Larger than a read of the app, in messages that do not line up with its reads
+    data = bytes(range(256)) * 1000
+    chunks = [data[i:i + 10000] for i in range(0, len(data), 10000)]
+    status, _, _ = request("PUT", "/test/large.bin", chunks, {"Content-Length": str(len(data))})
+    assert status == 200
+    assert request("GET", "/test/large.bin")[2] == data
+
+def test_request_body_reads():
+    messages = [{"type": "http.request", "body": b"abc", "more_body": True},
+                {"type": "http.request", "body": b"defg", "more_body": False}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def read_all():
+        body = tss_asgi.RequestBody(asyncio.get_event_loop(), receive)
+        return await asyncio.get_event_loop().run_in_executor(None, lambda: [body.read(5), body.read(5), body.read(5)])
+
+    assert run(read_all()) == [b"abcde", b"fg", b""]
+
+def test_disconnected_upload(storage_root):
+    status, _, _ = request("PUT", "/test/partial.bin", [b"12345"], {"Content-Length": "10"})
+    assert status == 400
+    assert request("GET", "/test/partial.bin")[0] == 404
+
+def test_range_and_query(storage_root):
+    request("PUT", "/test/a.txt", [b"0123456789"])
+    status, headers, body = request("GET", "/test/a.txt", headers={"Range": "bytes=2-3"})
+    assert (status, body) == (206, b"23")
+    status, _, body = request("GET", "/test", query_string=b"prefix=a")
+    assert status == 200
+    assert b"a.txt" in body
+
+def test_head_and_not_found(storage_root):
+    request("PUT", "/test/a.txt", [b"abc"])
+    status, headers, body = request("HEAD", "/test/a.txt")
+    assert (status, headers[b"content-length"], body) == (200, b"3", b"")
+    assert request("GET", "/test/missing")[0] == 404
+    assert request("GET", "/missing/a.txt")[0] == 404
+
+def test_lifespan():
+    sent = []
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    run(tss_asgi.app({"type": "lifespan"}, receive, send))
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
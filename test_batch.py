@@ -0,0 +1,85 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import threading
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            for n in range(5):
+                r = c.put(flask.url_for('put_object', bucket_name="test", object_name=f"test-{n}.txt"),
+                          data=f"test {n}", headers={"X-TSS-N": str(n)})
+                assert r.status_code == 200
+            yield c
+
+def test_stat_objects(client):
+    r = client.post(flask.url_for('post_bucket', bucket_name="test", stat=""), json=["test-1.txt", {"Key": "test-3.txt"}, "missing"])
+    assert r.status_code == 200
+    assert [(result["Key"], result["Status"]) for result in r.json] == [("test-1.txt", 200), ("test-3.txt", 200), ("missing", 404)]
+    assert r.json[0]["X-Tss-N"] == "1"
+    assert r.json[1]["Content-Length"] == "6"
+
+def test_stat_objects_ndjson(client):
+    body = "\n".join(json.dumps(key) for key in ("test-0.txt", "missing")) + "\n"
+    r = client.post(flask.url_for('post_bucket', bucket_name="test", stat=""), data=body,
+                    content_type="application/x-ndjson")
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
+    results = [json.loads(line) for line in r.data.splitlines()]
+    assert [(result["Key"], result["Status"]) for result in results] == [("test-0.txt", 200), ("missing", 404)]
+
+def test_delete_objects(client):
+    r = client.post(flask.url_for('post_bucket', bucket_name="test", delete=""), json=["test-0.txt", "test-2.txt", "missing"])
+    assert r.status_code == 200
+    assert [(result["Key"], result["Status"]) for result in r.json] == [("test-0.txt", 200), ("test-2.txt", 200), ("missing", 404)]
+    for n in range(5):
+        r = client.head(flask.url_for('get_object', bucket_name="test", object_name=f"test-{n}.txt"))
+        assert r.status_code == (404 if n in (0, 2) else 200)
+        object_path = tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", f"test-{n}.txt")
+        assert object_path.exists() == (n not in (0, 2))
+
+def test_delete_objects_keeps_newer_file(client, monkeypatch):
+    url = flask.url_for('get_object', bucket_name="test", object_name="test-0.txt")
+    statuses = []
+
+    class Executor:
+        def map(self, function, paths):
+            # The same name is uploaded again between the commit of the batch and the removal of its files
+            upload = threading.Thread(
+                target=lambda: statuses.append(tss.app.test_client().put(url, data="new").status_code))
+            upload.start()
+            upload.join()
+            return map(function, paths)
+
+    monkeypatch.setattr(tss, "get_executor", lambda name, max_workers: Executor())
+    r = client.post(flask.url_for('post_bucket', bucket_name="test", delete=""), json=["test-0.txt"])
+    assert r.status_code == 200
+    assert statuses == [200]
+    assert client.get(url).data == b"new"
+    object_path = tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "test-0.txt")
+    assert [path.name for path in object_path.parent.iterdir()] == [object_path.name]
+
+def test_batch_404_on_bucket(client):
+    r = client.post(flask.url_for('post_bucket', bucket_name="doesnotexist", delete=""), json=["test-0.txt"])
+    assert r.status_code == 404
+
+def test_batch_bad_requests(client):
+    url = flask.url_for('post_bucket', bucket_name="test", delete="")
+    assert client.post(flask.url_for('post_bucket', bucket_name="test"), json=["test-0.txt"]).status_code == 400
+    assert client.post(url, data="not json").status_code == 400
+    assert client.post(url, json={"Key": "test-0.txt"}).status_code == 400
+    assert client.post(url, json=[1, 2]).status_code == 400
+    assert client.post(url, json=["x"] * (tss.MAX_BATCH_KEYS + 1)).status_code == 400
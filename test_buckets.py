@@ -3,7 +3,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import json
+import pathlib
 import re
+import threading
+import time
 import flask
 import pytest
 import tss
@@ -143,8 +147,228 @@ def test_delete_bucket_404(client):
     r = client.delete(flask.url_for('delete_bucket', bucket_name="test"))
     assert r.status_code == 404
 
-def test_delete_bucket_200(client):
+def test_delete_bucket_202(client):
     r = client.put(flask.url_for('put_bucket', bucket_name="test"))
     assert r.status_code == 200
     r = client.delete(flask.url_for('delete_bucket', bucket_name="test"))
+    assert r.status_code == 202
+    assert r.json["Bucket"] == "test"
+    assert r.headers["Location"].endswith("/_deletions/test")
+
+@pytest.mark.parametrize("dedup", [False, True])
+def test_delete_bucket_during_put(client, monkeypatch, dedup):
+    tss.app.config["REAPER"] = False
+    tss.app.config["DEDUP"] = dedup
+    try:
+        client.put(flask.url_for('put_bucket', bucket_name="test"))
+        receive_object = tss.receive_object
+        bucket_url = flask.url_for('delete_bucket', bucket_name="test")
+        statuses = []
+
+        def deleting_receive_object(*args, **kwargs):
+            result = receive_object(*args, **kwargs)
+            # The bucket is deleted after the content is received, before its metadata is written
+            deletion = threading.Thread(target=lambda: statuses.append(tss.app.test_client().delete(bucket_url).status_code))
+            deletion.start()
+            deletion.join()
+            return result
+
+        monkeypatch.setattr(tss, "receive_object", deleting_receive_object)
+        r = client.put(flask.url_for('put_object', bucket_name="test", object_name="a"), data="test")
+        assert r.status_code == 404
+        assert statuses == [202]
+        assert tss.reap_deleted_buckets() == 0
+        with tss.get_lmdb_env().begin() as tx:
+            assert tx.stat(tss.get_lmdb_db(b"objects"))["entries"] == 0
+        assert not tss.make_bucket_path(tss.app.config["STORAGE_ROOT"], "test").exists()
+        assert list(pathlib.Path(tss.app.config["STORAGE_ROOT"]).rglob(".tmp-*")) == []
+    finally:
+        tss.app.config["REAPER"] = True
+        tss.app.config["DEDUP"] = False
+
+def test_delete_bucket_aborts_uploads(client):
+    client.put(flask.url_for('put_bucket', bucket_name="test"))
+    client.put(flask.url_for('put_bucket', bucket_name="other"))
+    uploads = {}
+    for bucket_name in ("test", "other"):
+        r = client.post(flask.url_for('post_object', bucket_name=bucket_name, object_name="a", uploads=""))
+        uploads[bucket_name] = r.json["UploadId"]
+        r = client.put(flask.url_for('put_object', bucket_name=bucket_name, object_name="a",
+                                     uploadId=uploads[bucket_name], partNumber=1), data="part")
+        assert r.status_code == 200
+    assert client.delete(flask.url_for('delete_bucket', bucket_name="test")).status_code == 202
+    with tss.get_lmdb_env().begin() as tx:
+        keys = [key for key, _ in tx.cursor(db=tss.get_lmdb_db(b"uploads"))]
+    assert keys == [uploads["other"].encode(), ("%s:00001" % uploads["other"]).encode()]
+
+def put_objects(client, object_names):
+    r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    for object_name in object_names:
+        r = client.put(flask.url_for('put_object', bucket_name="test", object_name=object_name), data="test")
+        assert r.status_code == 200
+
+def list_names(r):
+    return [o.get("Key", o.get("Prefix")) for o in r.json]
+
+TREE = ["a.txt", "photos/2019/a.jpg", "photos/2019/b.jpg", "photos/2020/c.jpg", "photos/d.jpg", "videos/e.mp4", "z.txt"]
+
+def test_get_bucket_prefix(client):
+    put_objects(client, TREE)
+    r = client.get(flask.url_for('get_bucket', bucket_name="test", prefix="photos/2019/"))
+    assert r.status_code == 200
+    assert list_names(r) == ["photos/2019/a.jpg", "photos/2019/b.jpg"]
+    r = client.get(flask.url_for('get_bucket', bucket_name="test", prefix="nothing"))
     assert r.status_code == 200
+    assert r.json == []
+
+def test_get_bucket_delimiter(client):
+    put_objects(client, TREE)
+    r = client.get(flask.url_for('get_bucket', bucket_name="test", delimiter="/"))
+    assert r.status_code == 200
+    assert list_names(r) == ["a.txt", "photos/", "videos/", "z.txt"]
+    assert r.json[1] == {"Prefix": "photos/"}
+    r = client.get(flask.url_for('get_bucket', bucket_name="test", prefix="photos/", delimiter="/"))
+    assert r.status_code == 200
+    assert list_names(r) == ["photos/2019/", "photos/2020/", "photos/d.jpg"]
+
+def test_get_bucket_start_after(client):
+    put_objects(client, TREE)
+    r = client.get(flask.url_for('get_bucket', bucket_name="test", **{"start-after": "photos/2020/c.jpg"}))
+    assert r.status_code == 200
+    assert list_names(r) == ["photos/d.jpg", "videos/e.mp4", "z.txt"]
+
+def test_get_bucket_max_keys(client):
+    put_objects(client, TREE)
+    names = []
+    url = flask.url_for('get_bucket', bucket_name="test", delimiter="/", **{"max-keys": 1})
+    while url:
+        r = client.get(url)
+        assert r.status_code == 200
+        assert len(r.json) == 1
+        names += list_names(r)
+        url = parse_test_link_header(r.headers["Link"]) if "Link" in r.headers else None
+    assert names == ["a.txt", "photos/", "videos/", "z.txt"]
+
+def test_get_bucket_max_keys_invalid(client):
+    put_objects(client, [])
+    for value in ("0", "1001", "abc"):
+        r = client.get(flask.url_for('get_bucket', bucket_name="test", **{"max-keys": value}))
+        assert r.status_code == 400
+
+def export_lines(client, **args):
+    r = client.get(flask.url_for('get_bucket', bucket_name="test", format="ndjson", **args))
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
+    return [json.loads(line) for line in r.data.decode().splitlines()]
+
+def test_export_bucket(client, monkeypatch):
+    monkeypatch.setattr(tss, "EXPORT_CHUNK_SIZE", 3)
+    put_objects(client, TREE)
+    lines = export_lines(client)
+    assert [line["Key"] for line in lines] == TREE
+    assert lines[0]["Content-Length"] == "4"
+    lines = export_lines(client, prefix="photos/", delimiter="/")
+    assert [line.get("Key", line.get("Prefix")) for line in lines] == ["photos/2019/", "photos/2020/", "photos/d.jpg"]
+
+def test_export_bucket_resume(client, monkeypatch):
+    monkeypatch.setattr(tss, "EXPORT_CHUNK_SIZE", 2)
+    put_objects(client, TREE)
+    for args in ({}, {"delimiter": "/"}):
+        lines = export_lines(client, **args)
+        for i, line in enumerate(lines):
+            # A client that lost the connection continues after the last line it received
+            assert export_lines(client, next=line["Next"], **args) == lines[i + 1:]
+
+def test_export_bucket_404(client):
+    r = client.get(flask.url_for('get_bucket', bucket_name="doesnotexist", format="ndjson"))
+    assert r.status_code == 404
+    put_objects(client, [])
+    r = client.get(flask.url_for('get_bucket', bucket_name="test", format="xml"))
+    assert r.status_code == 400
+
+def test_bucket_registry(client):
+    r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    with tss.get_lmdb_env().begin() as tx:
+        assert tx.get(b"test", db=tss.get_lmdb_db(b"buckets")) is not None
+    r = client.delete(flask.url_for('delete_bucket', bucket_name="test"))
+    assert r.status_code == 202
+    with tss.get_lmdb_env().begin() as tx:
+        assert tx.get(b"test", db=tss.get_lmdb_db(b"buckets")) is None
+    r = client.get(flask.url_for('get_bucket', bucket_name="test"))
+    assert r.status_code == 404
+
+def test_bucket_registry_existing_directories(client):
+    tss.close_lmdb_env()
+    tss.make_bucket_path(tss.app.config["STORAGE_ROOT"], "old", create=True)
+    r = client.get(flask.url_for('get_bucket', bucket_name="old"))
+    assert r.status_code == 200
+    # Directories are only registered once, after that the registry is authoritative
+    tss.close_lmdb_env()
+    tss.make_bucket_path(tss.app.config["STORAGE_ROOT"], "newer", create=True)
+    r = client.get(flask.url_for('get_bucket', bucket_name="newer"))
+    assert r.status_code == 404
+
+def test_bucket_cache_invalidation(client):
+    r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    r = client.get(flask.url_for('get_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    # Another worker deletes the bucket, which invalidates the cache of this one
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        tx.delete(b"test", db=tss.get_lmdb_db(b"buckets"))
+        tss.increment_counter(tx, b"buckets-generation")
+    r = client.get(flask.url_for('get_bucket', bucket_name="test"))
+    assert r.status_code == 404
+
+def test_delete_bucket_reaped_in_batches(client):
+    tss.app.config["REAPER"] = False
+    try:
+        put_objects(client, ["a", "b", "c", "d", "e"])
+        r = client.delete(flask.url_for('delete_bucket', bucket_name="test"))
+        assert r.status_code == 202
+        assert not tss.make_bucket_path(tss.app.config["STORAGE_ROOT"], "test").exists()
+        assert client.get(flask.url_for('get_bucket', bucket_name="test")).status_code == 404
+        # Until it is reaped, the bucket cannot be created again
+        assert client.put(flask.url_for('put_bucket', bucket_name="test")).status_code == 409
+
+        assert tss.reap_deleted_buckets(batch_size=2) == 1
+        r = client.get(flask.url_for('get_deletion', bucket_name="test"))
+        assert r.status_code == 200
+        assert (r.json["ObjectsRemoved"], r.json["Status"]) == (2, "metadata")
+        assert tss.reap_deleted_buckets(batch_size=2) == 1
+        assert tss.reap_deleted_buckets(batch_size=2) == 1
+        r = client.get(flask.url_for('get_deletions'))
+        assert [(d["Bucket"], d["ObjectsRemoved"], d["Status"]) for d in r.json] == [("test", 5, "metadata")]
+        assert tss.reap_deleted_buckets(batch_size=2) == 0
+
+        assert client.get(flask.url_for('get_deletion', bucket_name="test")).status_code == 404
+        assert list(pathlib.Path(tss.app.config["STORAGE_ROOT"], "deleted").iterdir()) == []
+        with tss.get_lmdb_env().begin() as tx:
+            assert tx.stat(tss.get_lmdb_db(b"objects"))["entries"] == 0
+        assert client.put(flask.url_for('put_bucket', bucket_name="test")).status_code == 200
+        assert client.get(flask.url_for('get_bucket', bucket_name="test")).json == []
+    finally:
+        tss.app.config["REAPER"] = True
+
+def test_delete_bucket_background_reaper(client):
+    put_objects(client, ["a", "b"])
+    client.delete(flask.url_for('delete_bucket', bucket_name="test"))
+    for _ in range(100):
+        if client.get(flask.url_for('get_deletion', bucket_name="test")).status_code == 404:
+            break
+        time.sleep(0.05)
+    assert client.put(flask.url_for('put_bucket', bucket_name="test")).status_code == 200
+    assert client.get(flask.url_for('get_bucket', bucket_name="test")).json == []
+
+def test_reap_buckets_command(client):
+    tss.app.config["REAPER"] = False
+    try:
+        put_objects(client, ["a", "b"])
+        client.delete(flask.url_for('delete_bucket', bucket_name="test"))
+        result = tss.app.test_cli_runner().invoke(args=["reap-buckets", "--batch-size", "1"])
+        assert result.exit_code == 0
+        assert client.get(flask.url_for('get_deletion', bucket_name="test")).status_code == 404
+    finally:
+        tss.app.config["REAPER"] = True
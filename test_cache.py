@@ -0,0 +1,121 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os
+import pathlib
+import subprocess
+import sys
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    app.config["CACHE_SIZE"] = 1000
+    app.config["CACHE_MAX_OBJECT_SIZE"] = 400
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+    app.config["CACHE_SIZE"] = 0
+
+def object_url(object_name="hot.json"):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name)
+
+def cache_stats(client):
+    return client.get(flask.url_for('get_stats')).json["Cache"]
+
+def test_cache_hit(client):
+    client.put(object_url(), data=b"hot", headers={"Content-Type": "application/json"})
+    assert client.get(object_url()).data == b"hot"
+    # Served from memory even when the file is gone
+    tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "hot.json").unlink()
+    r = client.get(object_url())
+    assert r.data == b"hot"
+    assert r.headers["Content-Type"] == "application/json"
+    assert client.get(object_url(), headers={"Range": "bytes=1-"}).data == b"ot"
+    stats = cache_stats(client)
+    assert (stats["Hits"], stats["Misses"], stats["Entries"], stats["Bytes"]) == (2, 1, 1, 3)
+
+def test_cache_invalidation(client):
+    client.put(object_url(), data=b"old")
+    assert client.get(object_url()).data == b"old"
+    client.put(object_url(), data=b"new")
+    assert client.get(object_url()).data == b"new"
+    client.delete(object_url())
+    assert client.get(object_url()).status_code == 404
+    client.put(object_url(), data=b"again")
+    assert client.get(object_url()).data == b"again"
+    client.delete(flask.url_for('delete_bucket', bucket_name="test"))
+    while tss.reap_deleted_buckets():
+        pass
+    client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert client.get(object_url()).status_code == 404
+
+def test_cache_invalidation_by_other_worker(client):
+    client.put(object_url(), data=b"old")
+    assert client.get(object_url()).data == b"old"
+    # Another worker writing the object only shares the LMDB environment with this one
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        meta_data = tss.read_metadata(tx, "test", "hot.json")
+        meta_data["Content-Type"] = "text/plain"
+        tss.write_metadata(tx, "test", "hot.json", meta_data)
+    assert client.get(object_url()).headers["Content-Type"].startswith("text/plain")
+
+def test_cache_invalidation_by_worker_without_cache(client):
+    client.put(object_url(), data=b"old")
+    assert client.get(object_url()).data == b"old"
+    # A process that has no cache itself, like the commit service, still invalidates the caches of the workers
+    code = """if True:
+        import tss
+        with tss.get_lmdb_env().begin(write=True) as tx:
+            meta_data = tss.read_metadata(tx, "test", "hot.json")
+            meta_data["Content-Type"] = "text/plain"
+            tss.write_metadata(tx, "test", "hot.json", meta_data)
+    """
+    env = dict(os.environ, TSS_STORAGE_ROOT=tss.app.config["STORAGE_ROOT"], TSS_CACHE_SIZE="0")
+    subprocess.run([sys.executable, "-c", code], cwd=pathlib.Path(__file__).parent, env=env, check=True)
+    assert client.get(object_url()).headers["Content-Type"].startswith("text/plain")
+
+def test_no_generation_counters_without_cache(tmpdir):
+    tss.app.config["STORAGE_ROOT"] = str(tmpdir)
+    tss.app.config["CACHE_SIZE"] = 0
+    client = tss.app.test_client()
+    client.put("/test")
+    client.put("/test/object", data=b"data")
+    client.delete("/test/object")
+    with tss.get_lmdb_env().begin() as tx:
+        keys = list(tx.cursor(db=tss.get_lmdb_db(b"state")).iternext(values=False))
+    assert not [key for key in keys if key.startswith(b"generation:")]
+
+def test_cache_eviction(client):
+    for name in "abc":
+        client.put(object_url(name), data=name.encode() * 400)
+        client.get(object_url(name))
+    stats = cache_stats(client)
+    assert (stats["Entries"], stats["Bytes"], stats["Evictions"]) == (2, 800, 1)
+    # "a" was least recently used
+    client.get(object_url("b"))
+    client.get(object_url("a"))
+    stats = cache_stats(client)
+    assert (stats["Hits"], stats["Evictions"]) == (1, 2)
+
+def test_large_objects_are_not_cached(client):
+    client.put(object_url(), data=b"x" * 401)
+    assert client.get(object_url()).data == b"x" * 401
+    assert cache_stats(client)["Entries"] == 0
+
+def test_head_uses_cache(client):
+    client.put(object_url(), data=b"hot")
+    client.get(object_url())
+    r = client.head(object_url())
+    assert r.status_code == 200
+    assert r.headers["Content-Length"] == "3"
+    assert cache_stats(client)["Hits"] == 1
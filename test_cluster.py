@@ -0,0 +1,267 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import collections
+import http.client
+import json
+import os
+import pathlib
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.parse
+import pytest
+import tss
+
+
+SECRET = "cluster-secret"
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class Cluster:
+    """Nodes started as separate servers, each with a storage root of its own."""
+
+    def __init__(self, directory, count, **config):
+        self.ports = [free_port() for _ in range(count)]
+        self.nodes = ["http://127.0.0.1:%d" % port for port in self.ports]
+        self.envs = []
+        self.servers = [None] * count
+        for i, port in enumerate(self.ports):
+            (directory / ("node-%d" % i)).mkdir()
+            env = dict(os.environ, TSS_STORAGE_ROOT=str(directory / ("node-%d" % i)),
+                       TSS_CLUSTER_NODES=",".join(self.nodes), TSS_CLUSTER_SELF=self.nodes[i], TSS_CLUSTER_SECRET=SECRET,
+                       **{"TSS_CLUSTER_" + name: str(value) for name, value in config.items()})
+            env.pop("TSS_API_TOKEN", None)
+            self.envs.append(env)
+            self.start(i, wait=False)
+        for node in range(count):
+            self.wait(node)
+
+    def start(self, node, wait=True):
+        self.servers[node] = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn.app.wsgiapp", "--worker-class=gthread", "--threads=16", "--log-level=warning",
+             "--bind=127.0.0.1:%d" % self.ports[node], "tss:app"], cwd=pathlib.Path(__file__).parent, env=self.envs[node])
+        if wait:
+            self.wait(node)
+
+    def wait(self, node):
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", self.ports[node]), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    def request(self, node, method, path, body=None, headers=None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.ports[node], timeout=30)
+        try:
+            connection.request(method, urllib.parse.quote(path, safe="/?=&%"), body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.getheaders(), response.read()
+        finally:
+            connection.close()
+
+    def holders(self, path, nodes=None):
+        """The nodes that have an object themselves."""
+        return [node for node in (nodes if nodes is not None else range(len(self.ports)))
+                if self.request(node, "HEAD", path, headers={"Tss-Replica": SECRET})[0] == 200]
+
+    def stop(self, node):
+        # Without waiting for the keep-alive connections of the other nodes
+        self.servers[node].send_signal(signal.SIGINT)
+        self.servers[node].wait()
+
+    def close(self):
+        for node, server in enumerate(self.servers):
+            if server.poll() is None:
+                self.stop(node)
+
+@pytest.fixture(scope="module")
+def cluster(tmp_path_factory):
+    cluster = Cluster(tmp_path_factory.mktemp("cluster"), 3, REPLICAS=2, WRITE_QUORUM=2, READ_QUORUM=1)
+    assert cluster.request(0, "PUT", "/test")[0] == 200
+    yield cluster
+    cluster.close()
+
+def test_hash_ring():
+    nodes = ["http://node-%d" % i for i in range(5)]
+    ring = tss.HashRing(nodes)
+    owners = collections.Counter()
+    for i in range(5000):
+        replicas = ring.preference_list("test:object-%d:" % i, 3)
+        assert len(set(replicas)) == 3
+        assert replicas == ring.preference_list("test:object-%d:" % i, 3)
+        owners[replicas[0]] += 1
+    assert all(700 < count < 1300 for count in owners.values())
+    # Removing a node only moves the keys it had
+    smaller = tss.HashRing(nodes[:4])
+    for i in range(1000):
+        key = "test:object-%d:" % i
+        if ring.preference_list(key, 1) != [nodes[4]]:
+            assert smaller.preference_list(key, 1) == ring.preference_list(key, 1)
+    assert tss.HashRing(nodes[:2]).preference_list("key", 3) == tss.HashRing(nodes[:2]).preference_list("key", 2)
+
+def test_buckets_are_on_every_node(cluster):
+    for node in range(3):
+        status, _, body = cluster.request(node, "GET", "/test", headers={"Tss-Replica": SECRET})
+        assert status == 200
+
+def test_objects_are_replicated(cluster):
+    for i in range(20):
+        status, _, _ = cluster.request(i % 3, "PUT", "/test/object-%d" % i, body=b"data %d" % i)
+        assert status == 200
+    placement = collections.Counter()
+    for i in range(20):
+        holders = cluster.holders("/test/object-%d" % i)
+        assert len(holders) == 2
+        placement.update(holders)
+        for node in range(3):
+            status, headers, body = cluster.request(node, "GET", "/test/object-%d" % i)
+            assert (status, body) == (200, b"data %d" % i)
+    assert len(placement) == 3
+
+def test_range_and_conditional_requests_are_proxied(cluster):
+    cluster.request(0, "PUT", "/test/ranged", body=b"0123456789")
+    for node in range(3):
+        status, headers, body = cluster.request(node, "GET", "/test/ranged", headers={"Range": "bytes=2-4"})
+        assert (status, body) == (206, b"234")
+        etag = dict(headers)["ETag"]
+        assert cluster.request(node, "GET", "/test/ranged", headers={"If-None-Match": etag})[0] == 304
+
+def test_delete(cluster):
+    cluster.request(0, "PUT", "/test/deleted", body=b"x")
+    assert cluster.request(1, "DELETE", "/test/deleted")[0] == 200
+    assert cluster.holders("/test/deleted") == []
+    for node in range(3):
+        assert cluster.request(node, "GET", "/test/deleted")[0] == 404
+    assert cluster.request(2, "DELETE", "/test/deleted")[0] == 404
+
+def test_listing_is_merged(cluster):
+    cluster.request(0, "PUT", "/listed")
+    names = sorted("dir-%d/object-%d" % (i % 4, i) for i in range(30)) + ["top"]
+    for i, name in enumerate(names):
+        cluster.request(i % 3, "PUT", "/listed/" + name, body=b"x")
+    listed = []
+    path = "/listed?max-keys=7"
+    while path:
+        status, headers, body = cluster.request(1, "GET", path)
+        assert status == 200
+        page = json.loads(body)
+        assert len(page) <= 7
+        listed += [entry["Key"] for entry in page]
+        link = dict(headers).get("Link")
+        path = urllib.parse.urlsplit(link[1:link.index(">")])._replace(scheme="", netloc="").geturl() if link else None
+    assert listed == sorted(names, key=lambda name: (name + ":").encode())
+
+    status, _, body = cluster.request(2, "GET", "/listed?delimiter=/")
+    assert [entry.get("Prefix", entry.get("Key")) for entry in json.loads(body)] == \
+        ["dir-0/", "dir-1/", "dir-2/", "dir-3/", "top"]
+
+def test_replicas_keep_the_newest_version(cluster):
+    cluster.request(0, "PUT", "/test/versioned", body=b"new")
+    holder = cluster.holders("/test/versioned")[0]
+    # A write that was overtaken by a newer one arrives late
+    old = {"Tss-Replica": SECRET, "Tss-Version": str(tss.new_version() - 10 ** 9)}
+    assert cluster.request(holder, "PUT", "/test/versioned", body=b"old", headers=old)[0] == 200
+    assert cluster.request(holder, "DELETE", "/test/versioned", headers=old)[0] == 200
+    assert cluster.request(holder, "GET", "/test/versioned")[2] == b"new"
+    # And a write that was overtaken by a delete
+    assert cluster.request(0, "DELETE", "/test/versioned")[0] == 200
+    assert cluster.request(holder, "PUT", "/test/versioned", body=b"old", headers=old)[0] == 200
+    assert cluster.holders("/test/versioned") == []
+    assert cluster.request(holder, "GET", "/test/versioned")[0] == 404
+    # Until there is a newer write
+    assert cluster.request(0, "PUT", "/test/versioned", body=b"newest")[0] == 200
+    assert cluster.request(holder, "GET", "/test/versioned")[2] == b"newest"
+
+def test_replica_requests_need_the_secret(cluster):
+    cluster.request(0, "PUT", "/test/pinned", body=b"x")
+    holder = cluster.holders("/test/pinned")[0]
+    for value in ("1", SECRET + "x"):
+        headers = {"Tss-Replica": value, "Tss-Version": str(10 ** 18)}
+        assert cluster.request(holder, "PUT", "/test/pinned", body=b"pinned", headers=headers)[0] == 403
+        assert cluster.request(holder, "DELETE", "/test/pinned", headers=headers)[0] == 403
+        assert cluster.request(holder, "GET", "/test/pinned", headers=headers)[0] == 403
+    # A version a client sends along is not taken
+    assert cluster.request(0, "PUT", "/test/pinned", body=b"y", headers={"Tss-Version": str(10 ** 18)})[0] == 200
+    assert cluster.request(0, "PUT", "/test/pinned", body=b"z")[0] == 200
+    assert cluster.request(holder, "GET", "/test/pinned")[2] == b"z"
+
+def test_invalid_versions(cluster):
+    for version in ("abc", "-1", "1e9", "", str(10 ** 30), str(2 ** 63)):
+        headers = {"Tss-Replica": SECRET, "Tss-Version": version}
+        assert cluster.request(0, "PUT", "/test/invalid", body=b"x", headers=headers)[0] == 400
+        assert cluster.request(0, "DELETE", "/test/invalid", headers=headers)[0] == 400
+    assert cluster.holders("/test/invalid") == []
+
+def test_cluster_needs_a_secret():
+    env = dict(os.environ, TSS_CLUSTER_NODES="http://127.0.0.1:1", TSS_CLUSTER_SELF="http://127.0.0.1:1")
+    env.pop("TSS_CLUSTER_SECRET", None)
+    result = subprocess.run([sys.executable, "-c", "import tss"], cwd=pathlib.Path(__file__).parent, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode != 0
+    assert b"TSS_CLUSTER_SECRET is required" in result.stderr
+
+def test_batches_are_not_supported(cluster):
+    assert cluster.request(0, "POST", "/test?delete", body=b"[]")[0] == 501
+    assert cluster.request(0, "POST", "/test/object?uploads")[0] == 501
+    assert cluster.request(0, "GET", "/test?format=ndjson")[0] == 501
+    assert cluster.request(0, "GET", "/test?archive=tar")[0] == 501
+
+def test_tombstones_are_reaped(tmp_path):
+    tss.app.config["STORAGE_ROOT"] = str(tmp_path)
+    tombstones = tss.get_lmdb_db(b"tombstones")
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        tss.put_bucket_entry(tx, "test", {})
+        expired = tss.new_version() - (tss.app.config["CLUSTER_TOMBSTONE_TTL"] + 1) * 10 ** 9
+        assert tss.remove_object(tx, "test", "new", version=tss.new_version()) is False
+        for i in range(5):
+            assert tss.remove_object(tx, "test", "old-%d" % i, version=expired) is False
+        for _ in range(3):
+            tss.reap_tombstones(tx, 2)
+        assert [key for key, _ in tx.cursor(db=tombstones)] == [tss.key_prefix("test", "new").encode()]
+
+def test_delete_while_replica_is_down(tmp_path):
+    cluster = Cluster(tmp_path, 3, REPLICAS=3, WRITE_QUORUM=2, READ_QUORUM=3, TIMEOUT=5)
+    try:
+        assert cluster.request(0, "PUT", "/test")[0] == 200
+        assert cluster.request(0, "PUT", "/test/a", body=b"a")[0] == 200
+        cluster.stop(2)
+        assert cluster.request(0, "DELETE", "/test/a")[0] == 200
+        cluster.start(2)
+        # The replica that missed the delete still has the object, which the tombstones of the others overrule
+        assert cluster.holders("/test/a") == [2]
+        for node in range(3):
+            assert cluster.request(node, "GET", "/test/a")[0] == 404
+            assert cluster.request(node, "HEAD", "/test/a")[0] == 404
+    finally:
+        cluster.close()
+
+def test_quorums(tmp_path):
+    cluster = Cluster(tmp_path, 3, REPLICAS=3, WRITE_QUORUM=2, READ_QUORUM=2, TIMEOUT=5)
+    try:
+        assert cluster.request(0, "PUT", "/test")[0] == 200
+        assert cluster.request(0, "PUT", "/test/a", body=b"1")[0] == 200
+        # A write that reached a write quorum is seen by every read quorum, whichever replicas answer
+        newer = {"Tss-Replica": SECRET, "Tss-Version": str(tss.new_version())}
+        assert cluster.request(1, "PUT", "/test/a", body=b"2", headers=newer)[0] == 200
+        assert cluster.request(2, "PUT", "/test/a", body=b"2", headers=newer)[0] == 200
+        for node in range(3):
+            assert cluster.request(node, "GET", "/test/a")[2] == b"2"
+
+        cluster.stop(2)
+        assert cluster.request(0, "PUT", "/test/b", body=b"b")[0] == 200
+        assert cluster.request(1, "GET", "/test/b")[2] == b"b"
+        assert cluster.holders("/test/b", nodes=[0, 1]) == [0, 1]
+        cluster.stop(1)
+        assert cluster.request(0, "PUT", "/test/c", body=b"c")[0] == 503
+        assert cluster.request(0, "GET", "/test/b")[0] == 503
+    finally:
+        cluster.close()
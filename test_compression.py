@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import gzip
+import hashlib
+import json
+import zlib
+import flask
+import pytest
+import tss
+
+
+DATA = json.dumps([{"id": i, "name": "object %d" % i} for i in range(1000)]).encode()
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            settings = {"Compression": {"Algorithm": "gzip", "Level": 9, "ContentTypes": ["application/json", "text/*"]}}
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"), data=json.dumps(settings))
+            assert r.status_code == 200
+            yield c
+
+def object_url(object_name="data.json"):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name)
+
+def put_json(client, data=DATA):
+    r = client.put(object_url(), data=data, headers={"Content-Type": "application/json"})
+    assert r.status_code == 200
+
+def test_stored_compressed(client):
+    put_json(client)
+    stored = tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "data.json").read_bytes()
+    assert len(stored) < len(DATA) / 4
+    assert gzip.decompress(stored) == DATA
+
+def test_get_compressed(client):
+    put_json(client)
+    r = client.get(object_url(), headers={"Accept-Encoding": "gzip, deflate"})
+    assert r.status_code == 200
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert r.headers["Content-Length"] == str(len(r.data))
+    assert r.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(r.data) == DATA
+    assert r.headers["ETag"] == '"%s-gzip"' % hashlib.sha256(DATA).hexdigest()
+
+def test_get_decompressed(client):
+    put_json(client)
+    for accept_encoding in (None, "identity", "br", "gzip;q=0"):
+        headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+        r = client.get(object_url(), headers=headers)
+        assert r.status_code == 200
+        assert r.data == DATA
+        assert r.headers["Content-Length"] == str(len(DATA))
+        assert r.headers["Content-Encoding"] == "identity"
+        assert r.headers["ETag"] == '"%s"' % hashlib.sha256(DATA).hexdigest()
+    r = client.head(object_url())
+    assert r.headers["Content-Length"] == str(len(DATA))
+    assert "Accept-Ranges" not in r.headers
+
+def test_listing_shows_original_length(client):
+    put_json(client)
+    r = client.get(flask.url_for('get_bucket', bucket_name="test"))
+    assert r.json[0]["Content-Length"] == str(len(DATA))
+    assert not any(name.startswith("Tss-") for name in r.json[0])
+
+def test_range_ignored_when_decompressing(client):
+    put_json(client)
+    r = client.get(object_url(), headers={"Range": "bytes=0-9"})
+    assert r.status_code == 200
+    assert r.data == DATA
+    r = client.get(object_url(), headers={"Range": "bytes=0-9", "Accept-Encoding": "gzip"})
+    assert r.status_code == 206
+    assert len(r.data) == 10
+    assert r.data[:2] == b"\x1f\x8b"
+
+def test_conditional_per_representation(client):
+    put_json(client)
+    etag = client.get(object_url(), headers={"Accept-Encoding": "gzip"}).headers["ETag"]
+    r = client.get(object_url(), headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert r.status_code == 304
+    r = client.get(object_url(), headers={"If-None-Match": etag})
+    assert r.status_code == 200
+
+def test_other_types_and_encodings_not_compressed(client):
+    client.put(object_url("data.bin"), data=b"x" * 1000)
+    assert tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "data.bin").read_bytes() == b"x" * 1000
+    client.put(object_url("pre.json"), data=gzip.compress(DATA),
+               headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+    r = client.get(object_url("pre.json"))
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(r.data) == DATA
+
+def test_deflate_inline_and_dedup(client):
+    tss.app.config["INLINE_THRESHOLD"] = 100000
+    tss.app.config["DEDUP"] = True
+    try:
+        settings = {"Compression": {"Algorithm": "deflate"}}
+        assert client.put(flask.url_for('put_bucket', bucket_name="test"), data=json.dumps(settings)).status_code == 200
+        client.put(object_url("a.txt"), data=b"text " * 100, headers={"Content-Type": "text/plain; charset=utf-8"})
+        r = client.get(object_url("a.txt"), headers={"Accept-Encoding": "deflate"})
+        assert zlib.decompress(r.data) == b"text " * 100
+        assert client.get(object_url("a.txt")).data == b"text " * 100
+        tss.app.config["INLINE_THRESHOLD"] = 0
+        client.put(object_url("b.txt"), data=b"text " * 100, headers={"Content-Type": "text/plain"})
+        assert client.get(object_url("b.txt")).data == b"text " * 100
+        assert tss.make_blob_path(tss.app.config["STORAGE_ROOT"],
+                                  hashlib.sha256(b"text " * 100).hexdigest() + ".deflate").exists()
+    finally:
+        tss.app.config["INLINE_THRESHOLD"] = 0
+        tss.app.config["DEDUP"] = False
+
+def test_dedup_across_compression_levels(client):
+    tss.app.config["DEDUP"] = True
+    try:
+        settings = {"Compression": {"Algorithm": "gzip", "Level": 1, "ContentTypes": ["application/json"]}}
+        client.put(flask.url_for('put_bucket', bucket_name="fast"), data=json.dumps(settings))
+        urls = [flask.url_for('get_object', bucket_name="fast", object_name="data.json"), object_url()]
+        for url in urls:
+            assert client.put(url, data=DATA, headers={"Content-Type": "application/json"}).status_code == 200
+        # Both objects share the blob of the first upload, at level 1
+        blob_path = tss.make_blob_path(tss.app.config["STORAGE_ROOT"], hashlib.sha256(DATA).hexdigest() + ".gzip")
+        for url in urls:
+            r = client.get(url, headers={"Accept-Encoding": "gzip"})
+            assert r.headers["Content-Encoding"] == "gzip"
+            assert int(r.headers["Content-Length"]) == len(r.data) == blob_path.stat().st_size
+            assert gzip.decompress(r.data) == DATA
+        result = tss.app.test_cli_runner().invoke(args=["scrub"])
+        assert result.exit_code == 0
+        assert "found 0 problems" in result.output
+    finally:
+        tss.app.config["DEDUP"] = False
+
+def test_invalid_settings(client):
+    for settings in ({"Compression": {"Algorithm": "zip"}}, {"Compression": {"Algorithm": "gzip", "Level": 10}},
+                     {"Compression": {"Algorithm": "gzip", "ContentTypes": "text/*"}}, {"Other": 1}, [1]):
+        r = client.put(flask.url_for('put_bucket', bucket_name="test"), data=json.dumps(settings))
+        assert r.status_code == 400
+
+def test_disable_compression(client):
+    client.put(flask.url_for('put_bucket', bucket_name="test"), data=json.dumps({"Compression": None}))
+    put_json(client)
+    assert tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "data.json").read_bytes() == DATA
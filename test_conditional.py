@@ -0,0 +1,89 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import hashlib
+import flask
+import pytest
+import tss
+
+
+ETAG = '"%s"' % hashlib.sha256(b"test").hexdigest()
+PAST = "Sat, 01 Jan 2000 00:00:00 GMT"
+FUTURE = "Fri, 01 Jan 2100 00:00:00 GMT"
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            r = c.put(flask.url_for('put_object', bucket_name="test", object_name="test.txt"), data="test")
+            assert r.status_code == 200
+            yield c
+
+def get(client, headers, method="GET"):
+    return client.open(flask.url_for('get_object', bucket_name="test", object_name="test.txt"), method=method, headers=headers)
+
+def test_etag(client):
+    r = get(client, {})
+    assert r.status_code == 200
+    assert r.headers["ETag"] == ETAG
+
+def test_etag_changes_with_content(client):
+    r = client.put(flask.url_for('put_object', bucket_name="test", object_name="test.txt"), data="changed")
+    assert r.status_code == 200
+    r = get(client, {}, method="HEAD")
+    assert r.headers["ETag"] == '"%s"' % hashlib.sha256(b"changed").hexdigest()
+
+@pytest.mark.parametrize("method", ["GET", "HEAD"])
+def test_if_none_match(client, method):
+    r = get(client, {"If-None-Match": ETAG}, method=method)
+    assert r.status_code == 304
+    assert r.headers["ETag"] == ETAG
+    assert r.data == b""
+    assert get(client, {"If-None-Match": "W/" + ETAG}, method=method).status_code == 304
+    assert get(client, {"If-None-Match": '"other", ' + ETAG}, method=method).status_code == 304
+    assert get(client, {"If-None-Match": "*"}, method=method).status_code == 304
+    assert get(client, {"If-None-Match": '"other"'}, method=method).status_code == 200
+
+def test_if_match(client):
+    r = get(client, {"If-Match": ETAG})
+    assert r.status_code == 200
+    assert r.data == b"test"
+    assert get(client, {"If-Match": "*"}).status_code == 200
+    assert get(client, {"If-Match": '"other"'}).status_code == 412
+    assert get(client, {"If-Match": "W/" + ETAG}).status_code == 412
+
+def test_if_modified_since(client):
+    last_modified = get(client, {}).headers["Last-Modified"]
+    assert get(client, {"If-Modified-Since": last_modified}).status_code == 304
+    assert get(client, {"If-Modified-Since": FUTURE}).status_code == 304
+    assert get(client, {"If-Modified-Since": PAST}).status_code == 200
+    assert get(client, {"If-Modified-Since": "garbage"}).status_code == 200
+
+def test_if_none_match_takes_precedence(client):
+    assert get(client, {"If-None-Match": '"other"', "If-Modified-Since": FUTURE}).status_code == 200
+
+def test_if_unmodified_since(client):
+    assert get(client, {"If-Unmodified-Since": FUTURE}).status_code == 200
+    assert get(client, {"If-Unmodified-Since": PAST}).status_code == 412
+
+def test_if_match_takes_precedence(client):
+    assert get(client, {"If-Match": ETAG, "If-Unmodified-Since": PAST}).status_code == 200
+
+def test_if_range(client):
+    r = get(client, {"Range": "bytes=0-1", "If-Range": ETAG})
+    assert r.status_code == 206
+    assert r.data == b"te"
+    r = get(client, {"Range": "bytes=0-1", "If-Range": '"other"'})
+    assert r.status_code == 200
+    assert r.data == b"test"
+    last_modified = get(client, {}).headers["Last-Modified"]
+    assert get(client, {"Range": "bytes=0-1", "If-Range": last_modified}).status_code == 206
+    assert get(client, {"Range": "bytes=0-1", "If-Range": PAST}).status_code == 200
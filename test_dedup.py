@@ -0,0 +1,116 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import hashlib
+import json
+import pathlib
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    app.config["DEDUP"] = True
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+    app.config["DEDUP"] = False
+
+def object_url(object_name, **kwargs):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name, **kwargs)
+
+def blob_path(data):
+    return tss.make_blob_path(tss.app.config["STORAGE_ROOT"], hashlib.sha256(data).hexdigest())
+
+def dedup_stats(client):
+    r = client.get(flask.url_for('get_stats'))
+    assert r.status_code == 200
+    return r.json["Dedup"]
+
+def test_identical_objects_share_a_blob(client):
+    data = b"same content" * 100
+    for name in ("a.txt", "b.txt", "c/d.txt"):
+        assert client.put(object_url(name), data=data).status_code == 200
+    for name in ("a.txt", "b.txt", "c/d.txt"):
+        r = client.get(object_url(name))
+        assert r.status_code == 200
+        assert r.data == data
+        assert "Tss-Blob" not in r.headers
+        assert not tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", name).exists()
+    assert blob_path(data).exists()
+    assert dedup_stats(client) == {"Enabled": True, "Blobs": 1, "References": 3, "LogicalBytes": 3 * len(data),
+                                   "PhysicalBytes": len(data), "Ratio": 3.0}
+
+def test_blob_is_removed_with_last_reference(client):
+    data = b"shared"
+    client.put(object_url("a.txt"), data=data)
+    client.put(object_url("b.txt"), data=data)
+    assert client.delete(object_url("a.txt")).status_code == 200
+    assert blob_path(data).exists()
+    assert client.get(object_url("b.txt")).data == data
+    assert client.delete(object_url("b.txt")).status_code == 200
+    assert not blob_path(data).exists()
+    assert dedup_stats(client)["Blobs"] == 0
+    assert dedup_stats(client)["PhysicalBytes"] == 0
+
+def test_overwrite_releases_old_blob(client):
+    client.put(object_url("a.txt"), data=b"old")
+    client.put(object_url("a.txt"), data=b"new")
+    assert not blob_path(b"old").exists()
+    assert client.get(object_url("a.txt")).data == b"new"
+    # Writing the same content again keeps the blob
+    client.put(object_url("a.txt"), data=b"new")
+    assert blob_path(b"new").exists()
+    assert dedup_stats(client)["References"] == 1
+
+def test_no_temporary_files_left(client):
+    for _ in range(3):
+        client.put(object_url("a.txt"), data=b"data")
+    blobs = pathlib.Path(tss.app.config["STORAGE_ROOT"], "blobs")
+    assert [p.name for p in blobs.iterdir() if p.is_file()] == []
+
+def test_batch_delete_and_listing(client):
+    client.put(object_url("a.txt"), data=b"x")
+    client.put(object_url("b.txt"), data=b"x")
+    r = client.get(flask.url_for('get_bucket', bucket_name="test"))
+    assert all("Tss-Blob" not in entry for entry in r.json)
+    r = client.post(flask.url_for('post_bucket', bucket_name="test", stat=""), data=json.dumps(["a.txt"]))
+    assert "Tss-Blob" not in r.json[0]
+    r = client.post(flask.url_for('post_bucket', bucket_name="test", delete=""), data=json.dumps(["a.txt", "b.txt"]))
+    assert [result["Status"] for result in r.json] == [200, 200]
+    assert not blob_path(b"x").exists()
+
+def test_delete_bucket_releases_blobs(client):
+    client.put(object_url("a.txt"), data=b"x")
+    assert client.delete(flask.url_for('delete_bucket', bucket_name="test")).status_code == 202
+    while tss.reap_deleted_buckets():
+        pass
+    assert not blob_path(b"x").exists()
+    assert dedup_stats(client)["LogicalBytes"] == 0
+
+def test_multipart_upload_is_deduplicated(client):
+    data = b"a" * 1000 + b"b" * 10
+    client.put(object_url("whole.bin"), data=data)
+    upload_id = client.post(object_url("parts.bin", uploads="")).json["UploadId"]
+    client.put(object_url("parts.bin", uploadId=upload_id, partNumber=1), data=data[:1000])
+    client.put(object_url("parts.bin", uploadId=upload_id, partNumber=2), data=data[1000:])
+    assert client.post(object_url("parts.bin", uploadId=upload_id)).status_code == 200
+    assert client.get(object_url("parts.bin")).data == data
+    assert dedup_stats(client)["Blobs"] == 1
+
+def test_objects_stored_without_dedup_still_work(client):
+    tss.app.config["DEDUP"] = False
+    client.put(object_url("plain.txt"), data=b"plain")
+    tss.app.config["DEDUP"] = True
+    assert client.get(object_url("plain.txt")).data == b"plain"
+    client.put(object_url("plain.txt"), data=b"plain")
+    assert not tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "plain.txt").exists()
+    assert client.get(object_url("plain.txt")).data == b"plain"
@@ -0,0 +1,146 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import concurrent.futures
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    app.config["GROUP_COMMIT"] = "thread"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+    app.config["GROUP_COMMIT"] = "none"
+
+@pytest.fixture
+def service(client):
+    path = tss.get_commit_socket_path()
+    listener = tss.open_commit_socket(path)
+    threading.Thread(target=tss.serve_commits, args=(listener,), daemon=True).start()
+    tss.app.config["GROUP_COMMIT"] = "service"
+    yield path
+    tss.close_commit_connection()
+    listener.close()
+    path.unlink()
+
+def object_url(object_name):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name)
+
+def put_state(tx, name, value=b"1"):
+    tx.put(name.encode(), value, db=tss.get_lmdb_db(b"state"))
+
+def put_state_and_fail(tx, name):
+    put_state(tx, name)
+    raise ValueError(name)
+
+def read_state(name):
+    with tss.get_lmdb_env().begin() as tx:
+        return tx.get(name.encode(), db=tss.get_lmdb_db(b"state"))
+
+def test_put_and_delete(client):
+    assert client.put(object_url("a.txt"), data=b"a").status_code == 200
+    assert client.get(object_url("a.txt")).data == b"a"
+    assert client.delete(object_url("a.txt")).status_code == 200
+    assert client.get(object_url("a.txt")).status_code == 404
+    assert client.delete(object_url("a.txt")).status_code == 404
+    assert not tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", "a.txt").exists()
+
+def test_waiting_writes_are_merged(client, monkeypatch):
+    committer = tss.get_group_committer()
+    batches = []
+    commit = committer.commit
+    monkeypatch.setattr(committer, "commit", lambda batch: batches.append(len(batch)) or commit(batch))
+    with concurrent.futures.ThreadPoolExecutor(10) as executor:
+        with tss.get_lmdb_env().begin(write=True):
+            # The committer waits for this transaction with the first write, while the others queue up
+            futures = [executor.submit(tss.commit_write, put_state, "write-0")]
+            while not batches:
+                time.sleep(0.01)
+            futures += [executor.submit(tss.commit_write, put_state, "write-%d" % i) for i in range(1, 10)]
+            while committer.queue.qsize() < 9:
+                time.sleep(0.01)
+        for future in futures:
+            future.result()
+    assert batches == [1, 9]
+    assert all(read_state("write-%d" % i) == b"1" for i in range(10))
+
+def test_failed_write_is_rolled_back_alone(client):
+    committer = tss.get_group_committer()
+    batch = [(put_state, ("first",), {}, concurrent.futures.Future()),
+             (put_state_and_fail, ("failed",), {}, concurrent.futures.Future()),
+             (put_state, ("last",), {}, concurrent.futures.Future())]
+    committer.commit(batch)
+    assert batch[0][3].result() is None
+    with pytest.raises(ValueError):
+        batch[1][3].result()
+    assert batch[2][3].result() is None
+    assert (read_state("first"), read_state("failed"), read_state("last")) == (b"1", None, b"1")
+
+def test_committer_survives_failed_grow(client, monkeypatch):
+    def fill_map(tx):
+        raise tss.lmdb.MapFullError("full")
+
+    owner = tss._get_lmdb()
+
+    def failing_grow(full=False):
+        # Like grow(), does nothing while this thread has a transaction
+        if not owner.lock.held():
+            raise OSError("cannot grow")
+
+    committer = tss.get_group_committer()
+    monkeypatch.setattr(owner, "grow", failing_grow)
+    with pytest.raises(tss.lmdb.MapFullError):
+        committer.submit(fill_map, (), {})
+    monkeypatch.undo()
+    assert committer.submit(put_state, ("after",), {}) is None
+    assert read_state("after") == b"1"
+
+def test_invalid_group_commit_mode():
+    env = dict(os.environ, TSS_GROUP_COMMIT="threads")
+    result = subprocess.run([sys.executable, "-c", "import tss"], cwd=pathlib.Path(__file__).parent, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode != 0
+    assert b"Unknown TSS_GROUP_COMMIT mode 'threads'" in result.stderr
+
+def test_group_commits_are_counted(client):
+    client.put(object_url("a.txt"), data=b"a")
+    metrics = client.get(flask.url_for('get_metrics_endpoint')).data.decode()
+    assert "tss_group_commits_total" in metrics
+    assert "tss_group_commit_writes_total" in metrics
+
+def test_commit_service(client, service):
+    assert client.put(object_url("a.txt"), data=b"a").status_code == 200
+    assert client.get(object_url("a.txt")).data == b"a"
+    assert client.delete(object_url("a.txt")).status_code == 200
+    assert client.delete(object_url("a.txt")).status_code == 404
+    assert tss.get_commit_connection() is not None
+
+def test_commit_service_not_running(client, service):
+    tss.close_commit_connection()
+    tss.app.config["GROUP_COMMIT_SOCKET"] = str(service.with_name("missing.sock"))
+    try:
+        assert tss.get_commit_connection() is None
+        assert client.put(object_url("a.txt"), data=b"a").status_code == 200
+        assert client.get(object_url("a.txt")).data == b"a"
+    finally:
+        tss.app.config["GROUP_COMMIT_SOCKET"] = None
+
+def test_commit_service_already_running(client, service):
+    with pytest.raises(tss.click.ClickException):
+        tss.open_commit_socket(service)
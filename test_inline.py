@@ -0,0 +1,92 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import json
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    app.config["INLINE_THRESHOLD"] = 100
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+    app.config["INLINE_THRESHOLD"] = 0
+
+def object_url(object_name="small.json"):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name)
+
+def object_path(object_name="small.json"):
+    return tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", object_name)
+
+def inline_entries():
+    with tss.get_lmdb_env().begin() as tx:
+        return tx.stat(tss.get_lmdb_db(b"inline"))["entries"]
+
+def test_small_object_is_stored_inline(client):
+    data = b'{"small": true}'
+    r = client.put(object_url(), data=data, headers={"Content-Type": "application/json"})
+    assert r.status_code == 200
+    assert not object_path().exists()
+    assert inline_entries() == 1
+    r = client.get(object_url())
+    assert r.status_code == 200
+    assert r.data == data
+    assert r.headers["Content-Type"] == "application/json"
+    assert r.headers["Content-Length"] == str(len(data))
+    assert "Tss-Inline" not in r.headers
+    r = client.head(object_url())
+    assert r.status_code == 200
+    assert r.headers["Content-Length"] == str(len(data))
+
+def test_inline_object_range(client):
+    client.put(object_url(), data=b"0123456789")
+    r = client.get(object_url(), headers={"Range": "bytes=2-4"})
+    assert r.status_code == 206
+    assert r.data == b"234"
+
+def test_large_object_is_stored_as_file(client):
+    client.put(object_url("large.bin"), data=b"x" * 101)
+    assert object_path("large.bin").exists()
+    assert inline_entries() == 0
+    assert client.get(object_url("large.bin")).data == b"x" * 101
+
+def test_empty_object_is_not_inline_by_default(client):
+    tss.app.config["INLINE_THRESHOLD"] = 0
+    r = client.put(object_url("empty"), environ_overrides={"CONTENT_LENGTH": "0"})
+    assert r.status_code == 200
+    assert object_path("empty").exists()
+    assert inline_entries() == 0
+    r = client.get(object_url("empty"))
+    assert (r.status_code, r.data) == (200, b"")
+
+def test_switching_layouts(client):
+    client.put(object_url(), data=b"x" * 200)
+    client.put(object_url(), data=b"small")
+    assert not object_path().exists()
+    assert client.get(object_url()).data == b"small"
+    client.put(object_url(), data=b"again")
+    assert inline_entries() == 1
+    client.put(object_url(), data=b"y" * 200)
+    assert inline_entries() == 0
+    assert client.get(object_url()).data == b"y" * 200
+
+def test_delete_inline_object(client):
+    client.put(object_url(), data=b"small")
+    assert client.delete(object_url()).status_code == 200
+    assert inline_entries() == 0
+    assert client.get(object_url()).status_code == 404
+    client.put(object_url("a"), data=b"a")
+    client.put(object_url("b"), data=b"b")
+    r = client.post(flask.url_for('post_bucket', bucket_name="test", delete=""), data=json.dumps(["a", "b"]))
+    assert [result["Status"] for result in r.json] == [200, 200]
+    assert inline_entries() == 0
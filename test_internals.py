@@ -3,6 +3,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import pathlib
+import subprocess
+import sys
 import flask, pytest
 
 import tss
@@ -23,3 +25,27 @@ def test_put_bucket(client):
     bucket_path = pathlib.Path(tss.app.config["STORAGE_ROOT"], "buckets", "test")
     assert bucket_path.is_dir()
 
+
+def test_lmdb_env_shared(client):
+    env = tss.get_lmdb_env()
+    with tss.app.app_context():
+        assert tss.get_lmdb_env() is env
+
+def test_lmdb_env_reopened_after_fork(client, monkeypatch):
+    env = tss.get_lmdb_env()
+    pid = tss.os.getpid()
+    monkeypatch.setattr(tss.os, "getpid", lambda: pid + 1)
+    forked_env = tss.get_lmdb_env()
+    assert forked_env is not env
+    assert tss.get_lmdb_env() is forked_env
+
+def test_lmdb_env_reopened_on_storage_root_change(client, tmpdir):
+    env = tss.get_lmdb_env()
+    tss.app.config["STORAGE_ROOT"] = str(tmpdir)
+    assert tss.get_lmdb_env() is not env
+
+def test_import_is_light():
+    # Importing the app opens nothing and pulls in no date parsing libraries, so that preloading it is cheap and safe
+    code = "import sys, tss; print(tss._lmdb is None, sorted({'maya', 'pendulum', 'dateparser'} & set(sys.modules)))"
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=pathlib.Path(__file__).parent)
+    assert output.decode().strip() == "True []"
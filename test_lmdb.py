@@ -0,0 +1,175 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os
+import pathlib
+import subprocess
+import sys
+import flask
+import pytest
+import tss
+
+
+MAP_SIZE = 256 * 1024
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    app.config["LMDB_MAP_SIZE"] = MAP_SIZE
+    app.config["INLINE_THRESHOLD"] = 1024 * 1024
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+    app.config["LMDB_MAP_SIZE"] = 4 * 1024 * 1024 * 1024
+    app.config["INLINE_THRESHOLD"] = 0
+
+def object_url(object_name):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name)
+
+def lmdb_stats(client):
+    r = client.get(flask.url_for('get_lmdb_stats'))
+    assert r.status_code == 200
+    return r.json
+
+def put_until_stored(client, object_name, data, attempts=10):
+    for _ in range(attempts):
+        r = client.put(object_url(object_name), data=data)
+        if r.status_code != 503:
+            return r
+        assert r.headers["Retry-After"] == "1"
+    return r
+
+def test_lmdb_stats(client):
+    client.put(object_url("a"), data=b"a")
+    stats = lmdb_stats(client)
+    assert stats["Path"] == "metadata"
+    assert stats["MapSize"] == MAP_SIZE
+    assert stats["Pages"] * stats["PageSize"] == stats["FileSize"]
+    assert 0 <= stats["FreePages"] < stats["Pages"]
+    assert stats["Databases"]["objects"]["Entries"] == 1
+    assert stats["Databases"]["inline"]["Entries"] == 1
+    assert stats["Databases"]["buckets"]["Entries"] == 1
+
+def test_map_grows_before_it_is_full(client):
+    data = b"x" * 2000
+    for i in range(300):
+        assert client.put(object_url("object-%d" % i), data=data).status_code == 200
+    stats = lmdb_stats(client)
+    assert stats["MapSize"] >= 4 * MAP_SIZE
+    assert stats["Databases"]["objects"]["Entries"] == 300
+    assert client.get(object_url("object-0")).data == data
+
+def test_write_that_fills_the_map_can_be_repeated(client):
+    data = b"x" * (4 * MAP_SIZE)
+    r = client.put(object_url("big"), data=data)
+    assert r.status_code == 503
+    r = put_until_stored(client, "big", data)
+    assert r.status_code == 200
+    assert client.get(object_url("big")).data == data
+    assert lmdb_stats(client)["MapSize"] > 4 * MAP_SIZE
+
+CHILD = """
+import sys, tss
+tss.app.config.update(STORAGE_ROOT=sys.argv[1], SERVER_NAME="localhost", INLINE_THRESHOLD=1024 * 1024)
+with tss.app.test_client() as client:
+    for _ in range(10):
+        if client.put("/test/big", data=b"x" * (4 * %d)).status_code == 200:
+            break
+    else:
+        sys.exit(1)
+""" % MAP_SIZE
+
+def test_map_grown_by_another_process(client):
+    env = dict(os.environ, TSS_LMDB_MAP_SIZE=str(MAP_SIZE))
+    subprocess.run([sys.executable, "-c", CHILD, tss.app.config["STORAGE_ROOT"]], env=env, check=True,
+                   cwd=pathlib.Path(__file__).parent)
+    assert client.get(object_url("big")).data == b"x" * (4 * MAP_SIZE)
+    assert client.put(object_url("small"), data=b"small").status_code == 200
+    assert lmdb_stats(client)["MapSize"] > 4 * MAP_SIZE
+
+def test_compaction(client):
+    for i in range(300):
+        client.put(object_url("object-%d" % i), data=b"x" * 2000)
+    for i in range(290):
+        client.delete(object_url("object-%d" % i))
+    before = lmdb_stats(client)
+    result = tss.app.test_cli_runner().invoke(args=["compact-metadata"])
+    assert result.exit_code == 0
+    after = lmdb_stats(client)
+    assert after["Path"] != "metadata"
+    assert after["FileSize"] < before["FileSize"] // 4
+    assert after["FreePages"] < before["FreePages"]
+    assert after["Databases"]["objects"]["Entries"] == 10
+    storage_root = pathlib.Path(tss.app.config["STORAGE_ROOT"])
+    assert not (storage_root / "metadata").exists()
+    assert (storage_root / "metadata.current").read_text().strip() == after["Path"]
+    assert client.get(object_url("object-299")).data == b"x" * 2000
+    assert client.put(object_url("new"), data=b"new").status_code == 200
+    assert client.get(object_url("new")).data == b"new"
+
+def test_compacted_environment_is_opened_by_new_workers(client, monkeypatch):
+    client.put(object_url("a"), data=b"a")
+    tss.compact_metadata()
+    client.put(object_url("b"), data=b"b")
+    # A new worker finds the compacted environment through metadata.current
+    pid = tss.os.getpid()
+    monkeypatch.setattr(tss.os, "getpid", lambda: pid + 1)
+    assert lmdb_stats(client)["Path"] != "metadata"
+    assert client.get(object_url("a")).data == b"a"
+    assert client.get(object_url("b")).data == b"b"
+
+def test_failed_compaction(client, monkeypatch):
+    client.put(object_url("a"), data=b"a")
+    exit_transaction = tss.TimedTransaction.__exit__
+
+    def failing_exit(self, *exc_info):
+        # The commit of the compaction, after the copy, fails
+        if exc_info[0] is None and self.write and self.tx.get(tss.MOVED_KEY, db=tss.get_lmdb_db(b"state")):
+            exit_transaction(self, tss.lmdb.Error, tss.lmdb.Error("commit failed"), None)
+            raise tss.lmdb.Error("commit failed")
+        return exit_transaction(self, *exc_info)
+
+    monkeypatch.setattr(tss.TimedTransaction, "__exit__", failing_exit)
+    with pytest.raises(tss.lmdb.Error):
+        tss.compact_metadata()
+    monkeypatch.undo()
+    storage_root = pathlib.Path(tss.app.config["STORAGE_ROOT"])
+    assert sorted(path.name for path in storage_root.glob("metadata*")) == ["metadata"]
+    client.put(object_url("b"), data=b"b")
+    # A new worker still opens the environment the writes went to
+    pid = tss.os.getpid()
+    monkeypatch.setattr(tss.os, "getpid", lambda: pid + 1)
+    assert lmdb_stats(client)["Path"] == "metadata"
+    assert client.get(object_url("b")).data == b"b"
+
+def test_interrupted_compaction_is_finished_by_workers(client):
+    client.put(object_url("a"), data=b"a")
+    storage_root = pathlib.Path(tss.app.config["STORAGE_ROOT"])
+    # The process that compacted exited after the commit, before it pointed metadata.current at the copy
+    (storage_root / "metadata-1").mkdir()
+    tss.get_lmdb_env().copy(str(storage_root / "metadata-1"), compact=True)
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        tx.put(tss.MOVED_KEY, b"metadata-1", db=tss.get_lmdb_db(b"state"))
+    assert client.put(object_url("b"), data=b"b").status_code == 200
+    assert (storage_root / "metadata.current").read_text().strip() == "metadata-1"
+    assert lmdb_stats(client)["Path"] == "metadata-1"
+    assert client.get(object_url("a")).data == b"a"
+
+def test_environment_moves_with_transaction_in_thread(client):
+    client.put(object_url("a"), data=b"a")
+    env = tss.get_lmdb_env()
+    with env.begin() as tx:
+        tss.compact_metadata()
+        # This thread still has a transaction in the old environment, so it cannot switch over yet
+        with pytest.raises(tss.lmdb.Error):
+            with env.begin():
+                pass
+    with env.begin() as tx:
+        assert tss.read_metadata(tx, "test", "a") is not None
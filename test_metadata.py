@@ -117,13 +117,15 @@ def test_delete_meta_data(client):
     r = client.put(flask.url_for('put_object', bucket_name="test", object_name="foo/bar/test.txt"), data="test",
                    headers={"X-TSS-Foo": "Bar"})
     assert r.status_code == 200
-    # Count number of values
-    assert tss.get_lmdb_env().stat()["entries"] == 5 # (Content-{Length,Type,Encoding}, Last-Modified + X-TSS-Foo)
+    # Count number of records
+    with tss.get_lmdb_env().begin() as tx:
+        assert tx.stat(tss.get_lmdb_db(b"objects"))["entries"] == 1
     # Delete the file
     r = client.delete(flask.url_for('delete_object', bucket_name="test", object_name="foo/bar/test.txt"))
     assert r.status_code == 200
-    # Count number of values
-    assert tss.get_lmdb_env().stat()["entries"] == 0
+    # Count number of records
+    with tss.get_lmdb_env().begin() as tx:
+        assert tx.stat(tss.get_lmdb_db(b"objects"))["entries"] == 0
 
 def test_last_modified(client):
     # Create a bucket
@@ -175,3 +177,85 @@ def test_update_object(client):
     assert "X-TSS-X" in r.headers
     assert r.headers["X-TSS-X"] == "XxX"
     assert r.headers["Content-Length"] == "7"
+
+def test_pack_metadata():
+    meta_data = {
+        "Content-Type": "text/plain",
+        "Content-Encoding": "gzip",
+        "Content-Length": "1234",
+        "ETag": '"abcd"',
+        "Last-Modified": "Sun, 18 Oct 2026 04:10:10 GMT",
+        "X-Tss-Foo": "Bar:Baz",
+    }
+    assert tss.unpack_metadata(tss.pack_metadata(meta_data)) == meta_data
+
+def test_pack_metadata_defaults():
+    meta_data = {
+        "Content-Type": tss.DEFAULT_CONTENT_TYPE,
+        "Content-Encoding": tss.DEFAULT_CONTENT_ENCODING,
+        "Content-Length": "0",
+        "Last-Modified": "Sun, 18 Oct 2026 04:10:10 GMT",
+    }
+    record = tss.pack_metadata(meta_data)
+    assert len(record) == tss.METADATA_RECORD.size
+    assert tss.unpack_metadata(record) == meta_data
+
+def test_unpack_metadata_unknown_version():
+    record = bytearray(tss.pack_metadata({"Content-Length": "0"}))
+    record[0] = 99
+    with pytest.raises(ValueError):
+        tss.unpack_metadata(bytes(record))
+
+LEGACY_METADATA = {
+    "Content-Type": "text/plain",
+    "Content-Encoding": "identity",
+    "Content-Length": "4",
+    "Last-Modified": "Sun, 18 Oct 2026 04:10:10 GMT",
+}
+
+def put_legacy_objects(client, count):
+    r = client.put(flask.url_for('put_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        for n in range(count):
+            object_path = tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", f"test-{n}.txt", create=True)
+            object_path.write_bytes(b"test")
+            for name, value in dict(LEGACY_METADATA, **{"X-Tss-N": str(n)}).items():
+                tx.put(f"test:test-{n}.txt:{name}".encode(), value.encode())
+    # The format of the metadata is detected when the environment is opened
+    tss.close_lmdb_env()
+
+def test_legacy_metadata(client):
+    put_legacy_objects(client, 3)
+    r = client.head(flask.url_for('get_object', bucket_name="test", object_name="test-1.txt"))
+    assert r.status_code == 200
+    assert r.headers["Content-Type"] == "text/plain"
+    assert r.headers["X-Tss-N"] == "1"
+    # Listings merge legacy keys and records
+    r = client.put(flask.url_for('put_object', bucket_name="test", object_name="test-1.txt"), data="new")
+    assert r.status_code == 200
+    r = client.get(flask.url_for('get_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    assert [o["Key"] for o in r.json] == ["test-0.txt", "test-1.txt", "test-2.txt"]
+    assert r.json[1]["Content-Length"] == "3"
+    assert "X-Tss-N" not in r.json[1]
+    # Deleting removes the legacy keys
+    r = client.delete(flask.url_for('delete_object', bucket_name="test", object_name="test-2.txt"))
+    assert r.status_code == 200
+    with tss.get_lmdb_env().begin() as tx:
+        assert not any(key.startswith(b"test:test-1.txt:") or key.startswith(b"test:test-2.txt:")
+                       for key in tx.cursor().iternext(values=False))
+
+def test_migrate_metadata(client):
+    put_legacy_objects(client, 5)
+    result = tss.app.test_cli_runner().invoke(args=["migrate-metadata", "--batch-size", "2"])
+    assert result.exit_code == 0
+    assert "Converted 5 objects" in result.output
+    with tss.get_lmdb_env().begin() as tx:
+        assert [key for key in tx.cursor().iternext(values=False)] == sorted(tss.LMDB_DATABASES)
+        assert tx.stat(tss.get_lmdb_db(b"objects"))["entries"] == 5
+        meta_data = tss.read_metadata(tx, "test", "test-3.txt")
+    assert meta_data == dict(LEGACY_METADATA, **{"X-Tss-N": "3"})
+    r = client.get(flask.url_for('get_bucket', bucket_name="test"))
+    assert r.status_code == 200
+    assert [o["Key"] for o in r.json] == [f"test-{n}.txt" for n in range(5)]
@@ -0,0 +1,125 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import importlib.util
+import os
+import pathlib
+import subprocess
+import sys
+import types
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+
+def scrape(client):
+    r = client.get(flask.url_for('get_metrics_endpoint'))
+    assert r.status_code == 200
+    assert r.mimetype == "text/plain"
+    samples = {}
+    for line in r.data.decode().splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+def test_request_metrics(client):
+    object_url = flask.url_for('get_object', bucket_name="test", object_name="a.txt")
+    client.put(object_url, data=b"x" * 1000)
+    client.get(object_url).close()
+    client.get(object_url).close()
+    client.get(flask.url_for('get_object', bucket_name="test", object_name="missing")).close()
+    samples = scrape(client)
+    assert samples['tss_requests_total{method="GET",route="get_object",status="200"}'] == 2
+    assert samples['tss_requests_total{method="GET",route="get_object",status="404"}'] == 1
+    assert samples['tss_requests_total{method="PUT",route="put_object",status="200"}'] == 1
+    assert samples['tss_received_bytes_total{route="put_object"}'] == 1000
+    assert samples['tss_sent_bytes_total{route="get_object"}'] >= 2000
+    assert samples['tss_request_duration_seconds_count{route="get_object"}'] == 3
+    assert samples['tss_request_duration_seconds_bucket{route="get_object",le="+Inf"}'] == 3
+    assert samples['tss_request_duration_seconds_bucket{route="get_object",le="0.0001"}'] <= 3
+    assert samples['tss_lmdb_transaction_seconds_count{write="true"}'] >= 2
+    assert samples['tss_lmdb_write_lock_wait_seconds_count'] >= 2
+    assert samples['tss_open_files{pid="%d"}' % os.getpid()] > 0
+
+def test_metrics_are_summed_across_workers(client):
+    client.get(flask.url_for('get_bucket', bucket_name="test")).close()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            metrics = tss.Metrics(tss.get_metrics_dir())
+            metrics.add("tss_requests_total", (("method", "GET"), ("route", "get_bucket"), ("status", "200")), 5)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    samples = scrape(client)
+    assert samples['tss_requests_total{method="GET",route="get_bucket",status="200"}'] == 6
+    # The exited worker has no open files to report
+    assert 'tss_open_files{pid="%d"}' % pid not in samples
+
+def test_open_files_of_reused_pid(client):
+    # Another process now has the pid of an exited worker
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    try:
+        directory = tss.get_metrics_dir()
+        (directory / f"{process.pid}.json").write_text("[]")
+        (directory / f"{process.pid}.metrics").write_bytes(bytes(8 * tss.METRICS_SLOTS))
+        samples = scrape(client)
+        assert 'tss_open_files{pid="%d"}' % process.pid not in samples
+        assert 'tss_open_files{pid="%d"}' % os.getpid() in samples
+    finally:
+        process.kill()
+        process.wait()
+
+def load_gunicorn_conf():
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", pathlib.Path(__file__).parent / "gunicorn.conf.py")
+    conf = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(conf)
+    return conf
+
+def test_metrics_dir_is_emptied_on_start(tmp_path, monkeypatch):
+    conf = load_gunicorn_conf()
+    monkeypatch.setenv("TSS_STORAGE_ROOT", "%s,/elsewhere:2" % tmp_path)
+    monkeypatch.delenv("TSS_METRICS_DIR", raising=False)
+    tss.Metrics(tmp_path / "metrics").add("tss_requests_total", (), 1)
+    (tmp_path / "metrics" / "other").write_text("kept")
+    conf.on_starting(None)
+    assert [path.name for path in (tmp_path / "metrics").iterdir()] == ["other"]
+
+def test_preload_without_gc_freeze(monkeypatch):
+    # Like Python 3.6
+    conf = load_gunicorn_conf()
+    monkeypatch.delattr(conf.gc, "freeze", raising=False)
+    conf.when_ready(types.SimpleNamespace(cfg=types.SimpleNamespace(preload_app=True)))
+
+def test_cluster_requests_are_reported(tmp_path):
+    metrics = tss.Metrics(tmp_path)
+    metrics.add("tss_cluster_requests_total", (("node", "http://node-1"), ("status", "200")), 3)
+    text = tss.format_metrics(tss.collect_metrics(tmp_path))
+    assert "# TYPE tss_cluster_requests_total counter" in text
+    assert 'tss_cluster_requests_total{node="http://node-1",status="200"} 3.0' in text
+
+def test_histogram_is_cumulative(tmp_path):
+    metrics = tss.Metrics(tmp_path)
+    for value in (0.00005, 0.003, 0.003, 20):
+        metrics.observe("tss_request_duration_seconds", (("route", "x"),), value)
+    text = tss.format_metrics(tss.collect_metrics(tmp_path))
+    assert 'tss_request_duration_seconds_bucket{route="x",le="0.0001"} 1.0' in text
+    assert 'tss_request_duration_seconds_bucket{route="x",le="0.0025"} 1.0' in text
+    assert 'tss_request_duration_seconds_bucket{route="x",le="0.005"} 3.0' in text
+    assert 'tss_request_duration_seconds_bucket{route="x",le="10.0"} 3.0' in text
+    assert 'tss_request_duration_seconds_bucket{route="x",le="+Inf"} 4.0' in text
+    assert 'tss_request_duration_seconds_count{route="x"} 4.0' in text
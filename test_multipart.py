@@ -0,0 +1,118 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import hashlib
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+
+def object_url(**kwargs):
+    return flask.url_for('get_object', bucket_name="test", object_name="big.bin", **kwargs)
+
+def create_upload(client):
+    r = client.post(object_url(uploads=""), headers={"Content-Type": "application/test", "X-TSS-Foo": "Bar"})
+    assert r.status_code == 200
+    return r.json["UploadId"]
+
+def test_multipart_upload(client):
+    upload_id = create_upload(client)
+    parts = {1: b"a" * 1000, 2: b"b" * 1000, 3: b"c" * 10}
+    # Parts can arrive in any order
+    for n in (3, 1, 2):
+        r = client.put(object_url(uploadId=upload_id, partNumber=n), data=parts[n])
+        assert r.status_code == 200
+        assert r.headers["ETag"] == '"%s"' % hashlib.sha256(parts[n]).hexdigest()
+    r = client.get(object_url(uploadId=upload_id))
+    assert r.status_code == 200
+    assert [part["PartNumber"] for part in r.json["Parts"]] == [1, 2, 3]
+    # The object does not exist until the upload is completed
+    assert client.head(object_url()).status_code == 404
+    r = client.post(object_url(uploadId=upload_id))
+    assert r.status_code == 200
+    assert r.json["ETag"].endswith('-3"')
+    r = client.get(object_url())
+    assert r.status_code == 200
+    assert r.data == parts[1] + parts[2] + parts[3]
+    assert r.headers["Content-Length"] == "2010"
+    assert r.headers["Content-Type"] == "application/test"
+    assert r.headers["X-Tss-Foo"] == "Bar"
+    # The staging directory and upload records are removed
+    assert not tss.make_upload_path(tss.app.config["STORAGE_ROOT"], "test", upload_id).exists()
+    assert client.get(object_url(uploadId=upload_id)).status_code == 404
+
+def test_multipart_upload_selected_parts(client):
+    upload_id = create_upload(client)
+    etags = {}
+    for n in (1, 2, 3):
+        r = client.put(object_url(uploadId=upload_id, partNumber=n), data=str(n) * 3)
+        etags[n] = r.json["ETag"]
+    r = client.post(object_url(uploadId=upload_id), json=[{"PartNumber": 1, "ETag": etags[1]}, {"PartNumber": 3}])
+    assert r.status_code == 200
+    assert client.get(object_url()).data == b"111333"
+
+def test_multipart_upload_invalid_parts(client):
+    upload_id = create_upload(client)
+    r = client.put(object_url(uploadId=upload_id, partNumber=1), data="1")
+    assert r.status_code == 200
+    assert client.put(object_url(uploadId=upload_id, partNumber=0), data="0").status_code == 400
+    assert client.put(object_url(uploadId=upload_id, partNumber=10001), data="0").status_code == 400
+    assert client.post(object_url(uploadId=upload_id), json=[{"PartNumber": 2}]).status_code == 400
+    assert client.post(object_url(uploadId=upload_id), json=[{"PartNumber": 1, "ETag": '"wrong"'}]).status_code == 400
+    assert client.post(object_url(uploadId=upload_id), json=[{"PartNumber": 1}, {"PartNumber": 1}]).status_code == 400
+
+def test_multipart_upload_unknown(client):
+    assert client.put(object_url(uploadId="nope", partNumber=1), data="1").status_code == 404
+    assert client.post(object_url(uploadId="nope")).status_code == 404
+    assert client.delete(object_url(uploadId="nope")).status_code == 404
+    upload_id = create_upload(client)
+    other_url = flask.url_for('get_object', bucket_name="test", object_name="other.bin", uploadId=upload_id)
+    assert client.get(other_url).status_code == 404
+
+def test_multipart_upload_abort(client):
+    upload_id = create_upload(client)
+    r = client.put(object_url(uploadId=upload_id, partNumber=1), data="1")
+    assert r.status_code == 200
+    r = client.delete(object_url(uploadId=upload_id))
+    assert r.status_code == 200
+    assert not tss.make_upload_path(tss.app.config["STORAGE_ROOT"], "test", upload_id).exists()
+    assert client.post(object_url(uploadId=upload_id)).status_code == 404
+    assert client.head(object_url()).status_code == 404
+
+def test_cleanup_uploads(client):
+    old_upload_id = create_upload(client)
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        upload = tss.json.loads(tx.get(old_upload_id.encode(), db=tss.get_lmdb_db(b"uploads")))
+        upload["Initiated"] -= 3600
+        tx.put(old_upload_id.encode(), tss.json.dumps(upload).encode(), db=tss.get_lmdb_db(b"uploads"))
+    new_upload_id = create_upload(client)
+    result = tss.app.test_cli_runner().invoke(args=["cleanup-uploads", "--max-age", "60"])
+    assert result.exit_code == 0
+    assert "Removed 1 uploads" in result.output
+    assert client.get(object_url(uploadId=old_upload_id)).status_code == 404
+    assert client.get(object_url(uploadId=new_upload_id)).status_code == 200
+    assert not tss.make_upload_path(tss.app.config["STORAGE_ROOT"], "test", old_upload_id).exists()
+
+def test_concatenate_files(tmpdir):
+    paths = []
+    for n in range(3):
+        path = tmpdir.join(str(n))
+        path.write_binary(bytes([n]) * (n * 1000))
+        paths.append(tss.pathlib.Path(str(path)))
+    with tss.app.app_context():
+        temp_path, size = tss.concatenate_files(tss.pathlib.Path(str(tmpdir)), paths)
+    assert size == 3000
+    assert temp_path.read_bytes() == b"\x01" * 1000 + b"\x02" * 2000
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import email
+import flask
+import pytest
+import tss
+
+
+DATA = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            r = c.put(flask.url_for('put_object', bucket_name="test", object_name="test.bin"), data=DATA,
+                      headers={"Content-Type": "application/test"})
+            assert r.status_code == 200
+            yield c
+
+def get_range(client, value):
+    return client.get(flask.url_for('get_object', bucket_name="test", object_name="test.bin"), headers={"Range": value})
+
+def test_accept_ranges(client):
+    r = client.get(flask.url_for('get_object', bucket_name="test", object_name="test.bin"))
+    assert r.status_code == 200
+    assert r.headers["Accept-Ranges"] == "bytes"
+    assert r.data == DATA
+    r = client.head(flask.url_for('get_object', bucket_name="test", object_name="test.bin"))
+    assert r.status_code == 200
+    assert r.headers["Accept-Ranges"] == "bytes"
+
+def test_single_range(client):
+    r = get_range(client, "bytes=10-19")
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == "bytes 10-19/1024"
+    assert r.headers["Content-Length"] == "10"
+    assert r.headers["Content-Type"] == "application/test"
+    assert r.data == DATA[10:20]
+
+def test_open_ended_range(client):
+    r = get_range(client, "bytes=1000-")
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == "bytes 1000-1023/1024"
+    assert r.data == DATA[1000:]
+
+def test_suffix_range(client):
+    r = get_range(client, "bytes=-24")
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == "bytes 1000-1023/1024"
+    assert r.data == DATA[-24:]
+
+def test_range_past_end_is_clipped(client):
+    r = get_range(client, "bytes=1020-5000")
+    assert r.status_code == 206
+    assert r.headers["Content-Range"] == "bytes 1020-1023/1024"
+    assert r.data == DATA[1020:]
+
+def test_unsatisfiable_range(client):
+    r = get_range(client, "bytes=1024-2000")
+    assert r.status_code == 416
+    assert r.headers["Content-Range"] == "bytes */1024"
+
+def test_malformed_range_is_ignored(client):
+    for value in ("bytes=20-10", "items=0-10", "bytes=abc"):
+        r = get_range(client, value)
+        assert r.status_code == 200
+        assert r.data == DATA
+
+def test_multiple_ranges(client):
+    r = get_range(client, "bytes=0-9,100-109,-5")
+    assert r.status_code == 206
+    assert r.headers["Content-Type"].startswith("multipart/byteranges; boundary=")
+    assert r.headers["Content-Length"] == str(len(r.data))
+    message = email.message_from_bytes(b"Content-Type: " + r.headers["Content-Type"].encode() + b"\r\n\r\n" + r.data)
+    parts = message.get_payload()
+    assert [part["Content-Range"] for part in parts] == ["bytes 0-9/1024", "bytes 100-109/1024", "bytes 1019-1023/1024"]
+    assert [part["Content-Type"] for part in parts] == ["application/test"] * 3
+    assert [part.get_payload(decode=True) for part in parts] == [DATA[0:10], DATA[100:110], DATA[1019:]]
+
+def test_range_empty_object(client):
+    r = client.put(flask.url_for('put_object', bucket_name="test", object_name="empty"), data=b"")
+    assert r.status_code == 200
+    r = client.get(flask.url_for('get_object', bucket_name="test", object_name="empty"), headers={"Range": "bytes=0-"})
+    assert r.status_code == 416
+
+def test_file_slice(tmpdir):
+    path = tmpdir.join("slice")
+    path.write_binary(DATA)
+    with open(str(path), "rb") as f:
+        s = tss.FileSlice(f, 100, 50)
+        assert s.fileno() == f.fileno()
+        assert s.read(10) == DATA[100:110]
+        assert s.read() == DATA[110:150]
+        assert s.read() == b""
@@ -0,0 +1,163 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import os
+import pathlib
+import time
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def client(tmpdir_factory):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+
+def object_url(object_name):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name)
+
+def object_path(object_name):
+    return tss.make_object_path(tss.app.config["STORAGE_ROOT"], "test", object_name)
+
+def make_old(path):
+    modified = time.time() - 2 * tss.SCRUB_GRACE
+    os.utime(str(path), (modified, modified))
+
+def scrub(client, *args):
+    result = tss.app.test_cli_runner().invoke(args=["scrub", "--rate", "0"] + list(args))
+    assert result.exit_code == 0, result.output
+    r = client.get(flask.url_for('get_scrub'))
+    assert r.status_code == 200
+    assert r.json["Current"] is None
+    return r.json["LastPass"], r.json["Problems"]
+
+def test_clean_pass(client):
+    for name in ("a", "b", "c/d"):
+        client.put(object_url(name), data=b"data")
+        make_old(object_path(name))
+    last_pass, problems = scrub(client)
+    assert last_pass["Pass"] == 1
+    assert last_pass["Phase"] == "done"
+    assert last_pass["Checked"] == 6
+    assert last_pass["Problems"] == {}
+    assert problems == []
+    assert scrub(client)[0]["Pass"] == 2
+
+def test_orphan_file(client):
+    client.put(object_url("a"), data=b"a")
+    orphan_path = object_path("orphan")
+    orphan_path.parent.mkdir(parents=True, exist_ok=True)
+    orphan_path.write_bytes(b"orphan")
+    make_old(orphan_path)
+    last_pass, problems = scrub(client)
+    assert last_pass["Problems"] == {"orphan-file": 1}
+    assert problems[0]["Kind"] == "orphan-file"
+    assert not problems[0]["Repaired"]
+    assert orphan_path.exists()
+
+    last_pass, problems = scrub(client, "--repair")
+    assert last_pass["Repaired"] == 1
+    assert not orphan_path.exists()
+    lost_path = pathlib.Path(tss.app.config["STORAGE_ROOT"], "lost+found", orphan_path.relative_to(
+        pathlib.Path(tss.app.config["STORAGE_ROOT"])))
+    assert lost_path.read_bytes() == b"orphan"
+    assert client.get(object_url("a")).data == b"a"
+
+def test_recent_file_is_not_reported(client):
+    # It could belong to an object that was stored after the pass started
+    path = object_path("new")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"new")
+    assert scrub(client)[0]["Problems"] == {}
+
+def test_old_temporary_file(client):
+    path = object_path("a").with_name(".tmp-upload")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"partial")
+    make_old(path)
+    assert scrub(client, "--repair")[0]["Problems"] == {"temporary-file": 1}
+    assert not path.exists()
+
+def test_missing_content(client):
+    client.put(object_url("a"), data=b"a")
+    client.put(object_url("b"), data=b"b")
+    object_path("a").unlink()
+    last_pass, problems = scrub(client)
+    assert last_pass["Problems"] == {"missing-content": 1}
+    assert problems[0]["Object"] == "a"
+    assert client.head(object_url("a")).status_code == 200
+
+    scrub(client, "--repair")
+    assert client.head(object_url("a")).status_code == 404
+    assert client.get(object_url("b")).data == b"b"
+
+def test_size_mismatch_is_only_reported(client):
+    client.put(object_url("a"), data=b"abc")
+    object_path("a").write_bytes(b"abcdef")
+    last_pass, problems = scrub(client, "--repair")
+    assert last_pass["Problems"] == {"size-mismatch": 1}
+    assert "6 bytes, 3 expected" in problems[0]["Detail"]
+    assert not problems[0]["Repaired"]
+    assert client.head(object_url("a")).status_code == 200
+
+def test_orphan_metadata(client):
+    with tss.get_lmdb_env().begin(write=True) as tx:
+        tss.write_metadata(tx, "unknown", "a", {"Content-Length": "1"})
+    last_pass, problems = scrub(client, "--repair")
+    assert last_pass["Problems"] == {"orphan-metadata": 1}
+    assert problems[0]["Repaired"]
+    with tss.get_lmdb_env().begin() as tx:
+        assert tss.read_metadata(tx, "unknown", "a") is None
+
+def test_pass_is_resumed(client, monkeypatch):
+    monkeypatch.setattr(tss, "SCRUB_CHUNK_SIZE", 2)
+    for i in range(5):
+        client.put(object_url("object-%d" % i), data=b"data")
+        make_old(object_path("object-%d" % i))
+    lock = tss.lock_scrubber()
+    try:
+        assert tss.scrub_step()
+        assert tss.scrub_step()
+    finally:
+        lock.close()
+    state, last_pass = tss.read_scrub_state()
+    assert last_pass is None
+    assert (state["Phase"], state["Position"], state["Checked"]) == ("metadata", "test:object-3:", 4)
+    # The objects in the index from before the restart are not orphans
+    last_pass, problems = scrub(client)
+    assert last_pass["Pass"] == 1
+    assert last_pass["Problems"] == {}
+
+def test_one_scrubber_at_a_time(client):
+    lock = tss.lock_scrubber()
+    try:
+        assert tss.lock_scrubber() is None
+        result = tss.app.test_cli_runner().invoke(args=["scrub"])
+        assert result.exit_code != 0
+    finally:
+        lock.close()
+
+def test_rate_limiter(monkeypatch):
+    clock = [100.0]
+    sleeps = []
+    monkeypatch.setattr(tss.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(tss.time, "sleep", lambda seconds: sleeps.append(seconds) or clock.__setitem__(0, clock[0] + seconds))
+    limiter = tss.RateLimiter(10)
+    for _ in range(5):
+        limiter.wait()
+    assert sleeps == pytest.approx([0.1] * 4)
+    clock[0] += 10
+    limiter.wait()
+    assert len(sleeps) == 4
+    unlimited = tss.RateLimiter(0)
+    unlimited.wait(1000)
+    assert len(sleeps) == 4
@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+import collections
+import hashlib
+import pathlib
+import flask
+import pytest
+import tss
+
+
+@pytest.fixture
+def volumes(tmpdir_factory):
+    return [(str(tmpdir_factory.mktemp("volume")), 1.0), (str(tmpdir_factory.mktemp("volume")), 2.0)]
+
+@pytest.fixture
+def client(tmpdir_factory, volumes):
+    app = tss.app
+    app.config["STORAGE_ROOT"] = str(tmpdir_factory.mktemp("data"))
+    app.config["SERVER_NAME"] = "localhost"
+    app.config["VOLUMES"] = volumes
+    with app.test_client() as c:
+        with app.app_context():
+            r = c.put(flask.url_for('put_bucket', bucket_name="test"))
+            assert r.status_code == 200
+            yield c
+    app.config["VOLUMES"] = []
+    app.config["DEDUP"] = False
+
+def object_url(object_name):
+    return flask.url_for('get_object', bucket_name="test", object_name=object_name)
+
+def object_files(object_name):
+    """The volumes that have a file of an object."""
+    return [path for path, _ in tss.get_volumes() if tss.make_object_path(path, "test", object_name).exists()]
+
+def placed(object_name):
+    return tss.place_data(tss.hash_object_name(object_name))
+
+def test_parse_volumes():
+    assert tss.parse_volumes("/data") == [("/data", 1.0)]
+    assert tss.parse_volumes("/data, /mnt/a:2,/mnt/b:0.5") == [("/data", 1.0), ("/mnt/a", 2.0), ("/mnt/b", 0.5)]
+
+def test_placement_follows_weights(client):
+    counts = collections.Counter(tss.place_data("%040x" % i) for i in range(4000))
+    shares = [counts[path] / 4000 for path, _ in tss.get_volumes()]
+    assert shares == pytest.approx([0.25, 0.25, 0.5], abs=0.04)
+
+def test_new_volume_only_takes_data(client, tmpdir_factory):
+    names = ["%040x" % i for i in range(1000)]
+    before = {name: tss.place_data(name) for name in names}
+    new_volume = str(tmpdir_factory.mktemp("volume"))
+    tss.app.config["VOLUMES"] = tss.app.config["VOLUMES"] + [(new_volume, 1.0)]
+    after = {name: tss.place_data(name) for name in names}
+    moved = [name for name in names if before[name] != after[name]]
+    assert moved
+    assert all(after[name] == new_volume for name in moved)
+
+def test_objects_are_spread(client):
+    for i in range(30):
+        assert client.put(object_url("object-%d" % i), data=b"data %d" % i).status_code == 200
+    for i in range(30):
+        assert object_files("object-%d" % i) == [placed("object-%d" % i)]
+        assert client.get(object_url("object-%d" % i)).data == b"data %d" % i
+    assert {placed("object-%d" % i) for i in range(30)} == {path for path, _ in tss.get_volumes()}
+
+    for i in range(30):
+        assert client.delete(object_url("object-%d" % i)).status_code == 200
+        assert object_files("object-%d" % i) == []
+
+def test_rebalance(client, volumes):
+    tss.app.config["VOLUMES"] = []
+    for i in range(30):
+        client.put(object_url("object-%d" % i), data=b"data %d" % i)
+    tss.app.config["VOLUMES"] = volumes
+    misplaced = [i for i in range(30) if placed("object-%d" % i) != tss.app.config["STORAGE_ROOT"]]
+    assert misplaced
+    # Until the rebalancer has moved them, they are found on the storage root
+    assert client.get(object_url("object-%d" % misplaced[0])).data == b"data %d" % misplaced[0]
+
+    result = tss.app.test_cli_runner().invoke(args=["rebalance"])
+    assert result.exit_code == 0
+    assert "Moved %d files" % len(misplaced) in result.output
+    for i in range(30):
+        assert object_files("object-%d" % i) == [placed("object-%d" % i)]
+        assert client.get(object_url("object-%d" % i)).data == b"data %d" % i
+    assert "Moved 0 files" in tss.app.test_cli_runner().invoke(args=["rebalance"]).output
+
+def test_replaced_file_is_not_moved_back(client, volumes):
+    name = next(name for name in ("object-%d" % i for i in range(100)) if placed(name) != tss.app.config["STORAGE_ROOT"])
+    tss.app.config["VOLUMES"] = []
+    client.put(object_url(name), data=b"old")
+    tss.app.config["VOLUMES"] = volumes
+    client.put(object_url(name), data=b"new")
+    assert len(object_files(name)) == 2
+    tss.rebalance()
+    assert object_files(name) == [placed(name)]
+    assert client.get(object_url(name)).data == b"new"
+
+def test_delete_bucket(client):
+    tss.app.config["REAPER"] = False
+    try:
+        for i in range(50):
+            client.put(object_url("object-%d" % i), data=b"data")
+        assert client.delete(flask.url_for('delete_bucket', bucket_name="test")).status_code == 202
+        for path, _ in tss.get_volumes():
+            assert not tss.make_bucket_path(path, "test").exists()
+            assert len(list(pathlib.Path(path, "deleted").iterdir())) == 1
+        while tss.reap_deleted_buckets():
+            pass
+        for path, _ in tss.get_volumes():
+            assert list(pathlib.Path(path, "deleted").iterdir()) == []
+    finally:
+        tss.app.config["REAPER"] = True
+
+def test_dedup_blobs_are_spread(client):
+    tss.app.config["DEDUP"] = True
+    contents = [b"content %d" % i for i in range(20)]
+    for i, data in enumerate(contents):
+        client.put(object_url("object-%d" % i), data=data)
+        client.put(object_url("copy-%d" % i), data=data)
+    for i, data in enumerate(contents):
+        digest = hashlib.sha256(data).hexdigest()
+        assert tss.make_blob_path(tss.place_data(digest), digest).read_bytes() == data
+        assert client.get(object_url("copy-%d" % i)).data == data
+    for path, _ in tss.get_volumes():
+        assert not [entry for entry in pathlib.Path(path, "blobs").glob(".tmp-*")]
+
+def test_volume_stats(client, volumes):
+    stats = client.get(flask.url_for('get_stats')).json["Volumes"]
+    assert [(volume["Path"], volume["Weight"]) for volume in stats] == tss.get_volumes()
+    assert all(volume["FreeBytes"] <= volume["TotalBytes"] for volume in stats)
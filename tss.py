@@ -3,22 +3,83 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import atexit
 import base64
+import bisect
+import calendar
+import collections
+import concurrent.futures
+import fcntl
 import hashlib
+import heapq
+import hmac
+import http.client
+import io
+import itertools
+import json
+import math
+import mmap
 import os
 import pathlib
+import pickle
+import queue
 import shutil
-
-from flask import Flask, abort, jsonify, request, g, url_for, Response
+import socket
+import struct
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import quote, urlencode, urlsplit
+
+import click
+from flask import Flask, abort, g, has_request_context, jsonify, request, stream_with_context, url_for, Response
+from werkzeug.datastructures import Headers
+from werkzeug.exceptions import HTTPException, ServiceUnavailable
+from werkzeug.http import http_date, parse_date, parse_etags, parse_if_range_header, parse_range_header, quote_etag, unquote_etag
 from werkzeug.routing import BaseConverter
+from werkzeug.test import EnvironBuilder, run_wsgi_app
 from werkzeug.wsgi import wrap_file
 import lmdb
-import maya
 
 
 DEFAULT_CONTENT_TYPE = "application/octet-stream"
 DEFAULT_CONTENT_ENCODING = "identity"
 
+FSYNC_POLICIES = ("none", "file", "dir")
+GROUP_COMMIT_MODES = ("none", "thread", "service")
+SEND_CHUNK_SIZE = 64 * 1024
+DEFAULT_LIST_KEYS = 100
+MAX_LIST_KEYS = 1000
+EXPORT_CHUNK_SIZE = 1000  # Listing entries read in one transaction by an NDJSON export
+MAX_BATCH_KEYS = 1000
+CLUSTER_VNODES = 64  # Points of each node on the hash ring
+CLUSTER_THREADS = 64
+MAX_VERSION = 2 ** 63 - 1  # Nanoseconds, into the year 2262
+# Headers of a single connection, which are not forwarded between nodes
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                      "transfer-encoding", "upgrade"}
+MAX_UPLOAD_PARTS = 10000
+NDJSON_MIMETYPE = "application/x-ndjson"
+TAR_MIMETYPE = "application/x-tar"
+# The PAX header fields that hold the metadata of an object in an archive
+ARCHIVE_PAX_PREFIX = "TSS."
+COMPRESSION_WBITS = {"gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+DEFAULT_COMPRESSED_TYPES = ["text/*", "application/json", "application/javascript", "application/xml"]
+
+LMDB_DATABASES = (b"objects", b"buckets", b"state", b"uploads", b"blobs", b"inline", b"deletions", b"tombstones")
+COUNTER = struct.Struct("<Q")
+BLOB = struct.Struct("<QQ")  # Reference count, size
+COMMIT_FRAME = struct.Struct("<I")  # Length of the pickled message that follows it
+
+METADATA_VERSION = 1
+# Headers stored as a one byte tag in metadata records. Only ever append to this, the tag is the position + 1.
+METADATA_HEADERS = ("Content-Type", "Content-Encoding", "ETag", "Tss-Blob", "Tss-Inline", "Tss-Compression",
+                    "Tss-Stored-Length")
+METADATA_RECORD = struct.Struct("<BQQ")  # Version, Content-Length, Last-Modified
+METADATA_FIELD = struct.Struct("<BH")  # Tag (0 for "Name:Value" custom headers), length of the value
+
 
 class BucketNameConverter(BaseConverter):
 
@@ -33,17 +94,564 @@ class BucketNameConverter(BaseConverter):
         return value
 
 
+def parse_volumes(value):
+    """Parses a comma separated list of data roots, each optionally followed by a colon and its weight,
+    into a list of (path, weight)."""
+    volumes = []
+    for volume in value.split(","):
+        path, _, weight = volume.strip().partition(":")
+        volumes.append((path, float(weight) if weight else 1.0))
+    return volumes
+
+
 app = Flask(__name__)
 app.url_map.converters['bucket_name'] = BucketNameConverter
-app.config["STORAGE_ROOT"] = os.getenv("TSS_STORAGE_ROOT", "/data")
+# The first data root is the storage root, which also holds the metadata
+_volumes = parse_volumes(os.getenv("TSS_STORAGE_ROOT", "/data"))
+app.config["STORAGE_ROOT"], app.config["STORAGE_WEIGHT"] = _volumes[0]
+app.config["VOLUMES"] = _volumes[1:]
 app.config["API_TOKEN"] = os.getenv("TSS_API_TOKEN", None)
+app.config["LMDB_MAP_SIZE"] = int(os.getenv("TSS_LMDB_MAP_SIZE", str(4 * 1024 * 1024 * 1024)))
+app.config["LMDB_MAX_READERS"] = int(os.getenv("TSS_LMDB_MAX_READERS", "126"))
+app.config["LMDB_READAHEAD"] = os.getenv("TSS_LMDB_READAHEAD", "1") == "1"
+app.config["UPLOAD_CHUNK_SIZE"] = int(os.getenv("TSS_UPLOAD_CHUNK_SIZE", str(64 * 1024)))
+app.config["FSYNC"] = os.getenv("TSS_FSYNC", "none")
+app.config["DELETE_THREADS"] = int(os.getenv("TSS_DELETE_THREADS", "8"))
+app.config["DELETE_BATCH_SIZE"] = int(os.getenv("TSS_DELETE_BATCH_SIZE", "1000"))
+app.config["ARCHIVE_THREADS"] = int(os.getenv("TSS_ARCHIVE_THREADS", "8"))
+app.config["ARCHIVE_BATCH_SIZE"] = int(os.getenv("TSS_ARCHIVE_BATCH_SIZE", "100"))
+app.config["REAPER"] = os.getenv("TSS_REAPER", "1") == "1"
+app.config["GROUP_COMMIT"] = os.getenv("TSS_GROUP_COMMIT", "none")
+app.config["GROUP_COMMIT_BATCH_SIZE"] = int(os.getenv("TSS_GROUP_COMMIT_BATCH_SIZE", "256"))
+app.config["GROUP_COMMIT_SOCKET"] = os.getenv("TSS_GROUP_COMMIT_SOCKET", None)
+app.config["SCRUB"] = os.getenv("TSS_SCRUB", "0") == "1"
+app.config["SCRUB_RATE"] = int(os.getenv("TSS_SCRUB_RATE", "1000"))
+app.config["SCRUB_REPAIR"] = os.getenv("TSS_SCRUB_REPAIR", "0") == "1"
+app.config["SCRUB_INTERVAL"] = int(os.getenv("TSS_SCRUB_INTERVAL", str(24 * 60 * 60)))
+app.config["CLUSTER_NODES"] = [node.strip().rstrip("/") for node in os.getenv("TSS_CLUSTER_NODES", "").split(",")
+                               if node.strip()]
+app.config["CLUSTER_SELF"] = os.getenv("TSS_CLUSTER_SELF", "").rstrip("/") or None
+app.config["CLUSTER_SECRET"] = os.getenv("TSS_CLUSTER_SECRET", None)
+app.config["CLUSTER_REPLICAS"] = int(os.getenv("TSS_CLUSTER_REPLICAS", "3"))
+app.config["CLUSTER_WRITE_QUORUM"] = int(os.getenv("TSS_CLUSTER_WRITE_QUORUM", "2"))
+app.config["CLUSTER_READ_QUORUM"] = int(os.getenv("TSS_CLUSTER_READ_QUORUM", "2"))
+app.config["CLUSTER_TIMEOUT"] = float(os.getenv("TSS_CLUSTER_TIMEOUT", "10"))
+app.config["CLUSTER_TOMBSTONE_TTL"] = int(os.getenv("TSS_CLUSTER_TOMBSTONE_TTL", str(7 * 24 * 60 * 60)))
+app.config["DEDUP"] = os.getenv("TSS_DEDUP", "0") == "1"
+app.config["INLINE_THRESHOLD"] = int(os.getenv("TSS_INLINE_THRESHOLD", "0"))
+app.config["CACHE_SIZE"] = int(os.getenv("TSS_CACHE_SIZE", "0"))
+app.config["CACHE_MAX_OBJECT_SIZE"] = int(os.getenv("TSS_CACHE_MAX_OBJECT_SIZE", str(64 * 1024)))
+app.config["METRICS_DIR"] = os.getenv("TSS_METRICS_DIR", None)
+app.config["MULTIPART_EXPIRY"] = int(os.getenv("TSS_MULTIPART_EXPIRY", str(7 * 24 * 60 * 60)))
+
+# Settings that would otherwise fail every request are checked once, when the app is loaded
+if app.config["FSYNC"] not in FSYNC_POLICIES:
+    raise ValueError(f"Unknown TSS_FSYNC policy {app.config['FSYNC']!r}, expected one of {FSYNC_POLICIES}")
+if app.config["GROUP_COMMIT"] not in GROUP_COMMIT_MODES:
+    raise ValueError(f"Unknown TSS_GROUP_COMMIT mode {app.config['GROUP_COMMIT']!r}, "
+                     f"expected one of {GROUP_COMMIT_MODES}")
+if app.config["CLUSTER_NODES"] and not app.config["CLUSTER_SECRET"]:
+    raise ValueError("TSS_CLUSTER_SECRET is required with TSS_CLUSTER_NODES")
+
+
+#
+# The LMDB environment is shared by all requests in a worker process. It is
+# opened lazily, so that nothing is opened in the gunicorn master when the
+# app is preloaded, and it is keyed on the pid so that a forked worker never
+# uses an environment that was opened by its parent.
+#
+# The map is grown when it fills up. LMDB stores its size with every commit,
+# so other workers adopt it when they run into the end of their map. Only a
+# process without transactions can change the size of its map, so all
+# transactions share a lock which resizing takes alone.
+#
+# Compaction copies the environment to a new directory and marks the old
+# environment as moved, after which metadata.current in the storage root is
+# pointed at the copy. Workers that still have the old one open switch over at
+# their next transaction, and finish the switch of metadata.current if the
+# compaction did not get to it.
+#
+
+_lmdb_lock = threading.Lock()
+_lmdb = None
+
+MOVED_KEY = b"moved-to"
+OBJECT_CACHE_KEY = b"object-cache"  # Set once a worker has had an object cache
+
+
+def metadata_path(storage_root):
+    try:
+        name = pathlib.Path(storage_root, "metadata.current").read_text().strip()
+    except FileNotFoundError:
+        name = "metadata"
+    return pathlib.Path(storage_root, name)
+
+
+def set_metadata_path(storage_root, name):
+    current_path = pathlib.Path(storage_root, "metadata.current")
+    temp_path = current_path.with_name(f"metadata.current.tmp-{os.urandom(8).hex()}")
+    temp_path.write_text(name + "\n")
+    os.replace(str(temp_path), str(current_path))
+
+
+class TransactionLock:
+    """Held shared by every transaction of a process, and alone to resize or reopen the environment. A thread
+    that already has a transaction can always begin another, so nested transactions never wait for a resize."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = 0
+        self.exclusive = False
+        self.local = threading.local()
+
+    def held(self):
+        return getattr(self.local, "count", 0) > 0
+
+    def acquire_shared(self):
+        with self.condition:
+            if not self.held():
+                while self.exclusive:
+                    self.condition.wait()
+            self.active += 1
+        self.local.count = getattr(self.local, "count", 0) + 1
+
+    def release_shared(self):
+        self.local.count -= 1
+        with self.condition:
+            self.active -= 1
+            if self.active == 0:
+                self.condition.notify_all()
+
+    def acquire_exclusive(self):
+        """Returns False when this thread has a transaction, because it would wait for itself."""
+        if self.held():
+            return False
+        with self.condition:
+            while self.exclusive:
+                self.condition.wait()
+            self.exclusive = True
+            while self.active:
+                self.condition.wait()
+        return True
+
+    def release_exclusive(self):
+        with self.condition:
+            self.exclusive = False
+            self.condition.notify_all()
+
+
+class _LMDB:
+
+    def __init__(self, key, storage_root):
+        self.key = key
+        self.storage_root = storage_root
+        self.lock = TransactionLock()
+        self.open()
+        # Anything in the main database besides the named databases is metadata in the pre version 1 format
+        with self.env.begin() as tx:
+            self.legacy = any(key not in self.dbs for key in tx.cursor().iternext(values=False))
+            registered = tx.get(b"buckets-registered", db=self.dbs[b"state"])
+        if registered is None:
+            self.register_buckets(storage_root)
+        self.bucket_cache = (None, {})
+        self.object_cache = ObjectCache(app.config["CACHE_SIZE"]) if app.config["CACHE_SIZE"] > 0 else None
+        self.generations = self.object_cache is not None
+        if self.object_cache is not None:
+            # Before anything is cached, so that every write from now on increments the generation counters
+            with self.env.begin(write=True) as tx:
+                tx.put(OBJECT_CACHE_KEY, b"1", db=self.dbs[b"state"])
+        self.metrics = Metrics(get_metrics_dir())
+        self.timed_env = TimedEnvironment(self, self.metrics)
+        with self.env.begin() as tx:
+            self.pending_deletions = tx.stat(self.dbs[b"deletions"])["entries"] > 0
+
+    def open(self):
+        # A compaction can replace the environment between reading metadata.current and opening it
+        while True:
+            path = metadata_path(self.storage_root)
+            try:
+                env = lmdb.open(str(path), map_size=app.config["LMDB_MAP_SIZE"], max_dbs=len(LMDB_DATABASES),
+                                max_readers=app.config["LMDB_MAX_READERS"], readahead=app.config["LMDB_READAHEAD"],
+                                create=path.name == "metadata")
+            except lmdb.Error:
+                if metadata_path(self.storage_root) != path:
+                    continue
+                raise
+            if metadata_path(self.storage_root) == path:
+                break
+            env.close()
+        self.path = path
+        self.env = env
+        self.dbs = {name: self.env.open_db(name) for name in LMDB_DATABASES}
+        self.page_size = self.env.stat()["psize"]
+
+    def register_buckets(self, storage_root):
+        """Adds the bucket directories created before there was a bucket registry to it."""
+        buckets_path = pathlib.Path(storage_root, "buckets")
+        with self.env.begin(write=True) as tx:
+            if buckets_path.is_dir():
+                for path in buckets_path.iterdir():
+                    if path.is_dir():
+                        tx.put(path.name.encode(), json.dumps({}).encode(), db=self.dbs[b"buckets"], overwrite=False)
+            tx.put(b"buckets-registered", b"1", db=self.dbs[b"state"])
+
+    def begin(self, write, kwargs):
+        """Begins a transaction, and holds the transaction lock until end() is called."""
+        while True:
+            nested = self.lock.held()
+            self.lock.acquire_shared()
+            try:
+                if write and not nested and self.nearly_full(self.env.info()):
+                    self.lock.release_shared()
+                    self.grow()
+                    continue
+                tx = self.env.begin(write=write, **kwargs)
+            except lmdb.MapResizedError:
+                # Another process grew the map, and wrote beyond the end of ours
+                self.lock.release_shared()
+                if nested:
+                    raise
+                self.grow()
+                continue
+            except BaseException:
+                self.lock.release_shared()
+                raise
+            if tx.get(MOVED_KEY, db=self.dbs[b"state"]) is None:
+                return tx
+            tx.abort()
+            self.lock.release_shared()
+            if not self.reopen():
+                raise lmdb.Error("The environment was compacted while this thread has a transaction")
+
+    def end(self, map_full=False):
+        self.lock.release_shared()
+        if map_full:
+            self.grow(full=True)
+
+    def nearly_full(self, info):
+        # Keep a quarter of the map free, so that a transaction rarely fills it up
+        return (info["last_pgno"] + 1) * self.page_size > info["map_size"] * 3 // 4
+
+    def grow(self, full=False):
+        """Adopts the map size of another process when that is larger, or else doubles it when it is (nearly) full."""
+        if not self.lock.acquire_exclusive():
+            return
+        try:
+            size = self.env.info()["map_size"]
+            self.env.set_mapsize(0)
+            info = self.env.info()
+            if info["map_size"] > size:
+                return
+            if full or self.nearly_full(info):
+                size *= 2
+                app.logger.info("Growing the LMDB map to %d bytes", size)
+            self.env.set_mapsize(size)
+        finally:
+            self.lock.release_exclusive()
+
+    def reopen(self):
+        """Switches to the environment that a compaction replaced this one with. Returns False when this
+        thread has a transaction, which keeps it from waiting for the other transactions of the process."""
+        if not self.lock.acquire_exclusive():
+            return False
+        try:
+            with self.env.begin() as tx:
+                moved_to = tx.get(MOVED_KEY, db=self.dbs[b"state"])
+            if moved_to is None:
+                return True  # Another thread already did
+            if metadata_path(self.storage_root) == self.path:
+                # The compaction has not pointed metadata.current at the copy yet, or was interrupted before it
+                # did, and opening the environment again would only find it moved again
+                set_metadata_path(self.storage_root, moved_to.decode())
+            self.env.close()
+            self.open()
+            return True
+        finally:
+            self.lock.release_exclusive()
+
+
+def _get_lmdb():
+    global _lmdb
+    key = (os.getpid(), app.config["STORAGE_ROOT"])
+    current = _lmdb
+    if current is not None and current.key == key:
+        return current
+    with _lmdb_lock:
+        if _lmdb is None or _lmdb.key != key:
+            if _lmdb is not None:
+                # Closing an environment inherited through fork() only releases this process's reader slots
+                _lmdb.env.close()
+                _lmdb = None
+            _lmdb = _LMDB(key, app.config["STORAGE_ROOT"])
+            if _lmdb.pending_deletions:
+                # Continue deletions that were interrupted by a restart
+                start_reaper()
+            start_scrubber()
+        return _lmdb
 
 
 def get_lmdb_env():
-    env = getattr(g, '_env', None)
-    if env is None:
-        g._env = lmdb.open(app.config["STORAGE_ROOT"] + '/metadata', map_size=4*1024*1024*1024)
-    return g._env
+    return _get_lmdb().timed_env
+
+
+def get_lmdb_db(name):
+    return _get_lmdb().dbs[name]
+
+
+@atexit.register
+def close_lmdb_env():
+    global _lmdb
+    with _lmdb_lock:
+        if _lmdb is not None:
+            _lmdb.env.close()
+        _lmdb = None
+
+
+def compact_metadata():
+    """Copies the environment without its free pages to a new directory and moves every worker over to it.
+    Writes wait until the copy is done, reads go on. Returns the size of the data file before and after."""
+    storage_root = app.config["STORAGE_ROOT"]
+    owner = _get_lmdb()
+    name = "metadata-%d" % (time.time() * 1000)
+    path = pathlib.Path(storage_root, name)
+    try:
+        with get_lmdb_env().begin(write=True) as tx:
+            # Holding the write lock keeps anything from being written to the old environment after the copy
+            old_path = owner.path
+            path.mkdir()
+            owner.env.copy(str(path), compact=True)
+            tx.put(MOVED_KEY, name.encode(), db=get_lmdb_db(b"state"))
+    except BaseException:
+        shutil.rmtree(str(path), ignore_errors=True)
+        raise
+    # Only once the old environment tells every writer that it moved are new processes sent to the copy
+    set_metadata_path(storage_root, name)
+    size = (old_path / "data.mdb").stat().st_size
+    # Workers that still have it open keep their mapping of the files
+    shutil.rmtree(str(old_path), ignore_errors=True)
+    return size, (path / "data.mdb").stat().st_size
+
+
+#
+# Metrics
+#
+# Every worker counts into a memory mapped file of doubles of its own in the
+# metrics directory, next to a JSON index of the metric in each slot, and
+# /_metrics sums the files of all workers. Files of workers that exited are
+# kept, so that counters never go down until the directory is emptied.
+# Histogram buckets are counted separately and made cumulative when they are
+# reported.
+#
+
+METRICS_SLOTS = 8192
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   float("inf"))
+LATENCY_LABELS = tuple("+Inf" if bound == float("inf") else repr(bound) for bound in LATENCY_BUCKETS)
+METRICS = {
+    "tss_requests_total": ("counter", "Requests by method, route and status."),
+    "tss_request_duration_seconds": ("histogram", "Time to handle a request, until the response body starts."),
+    "tss_received_bytes_total": ("counter", "Bytes of request bodies."),
+    "tss_sent_bytes_total": ("counter", "Bytes of response bodies."),
+    "tss_lmdb_transaction_seconds": ("histogram", "Duration of LMDB transactions."),
+    "tss_lmdb_write_lock_wait_seconds": ("histogram", "Time spent waiting for the LMDB write lock."),
+    "tss_group_commits_total": ("counter", "Transactions of the group committer."),
+    "tss_group_commit_writes_total": ("counter", "Writes merged into the transactions of the group committer."),
+    "tss_cluster_requests_total": ("counter", "Requests to other nodes by node and status."),
+    "tss_open_files": ("gauge", "Open file descriptors of each running worker."),
+}
+
+
+def get_metrics_dir():
+    return pathlib.Path(app.config["METRICS_DIR"] or pathlib.Path(app.config["STORAGE_ROOT"], "metrics"))
+
+
+class Metrics:
+    """The metrics of this worker. Recording one takes a dict lookup and an add to shared memory."""
+
+    def __init__(self, directory):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = directory / f"{os.getpid()}.json"
+        # The file stays open with a shared lock for as long as this process lives, which tells the workers
+        # that collect the metrics it is still running. A file left by an earlier process with the same pid is
+        # continued.
+        self.fd = os.open(str(directory / f"{os.getpid()}.metrics"), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        os.ftruncate(self.fd, METRICS_SLOTS * 8)
+        self.mmap = mmap.mmap(self.fd, METRICS_SLOTS * 8)
+        self.values = memoryview(self.mmap).cast("d")
+        self.slots = {key: slot for slot, key in enumerate(read_metrics_index(self.index_path))}
+        self.lock = threading.Lock()
+
+    def add(self, name, labels=(), amount=1):
+        slot = self.slots.get((name, labels))
+        if slot is None:
+            slot = self.allocate((name, labels))
+            if slot is None:
+                return
+        with self.lock:
+            self.values[slot] += amount
+
+    def observe(self, name, labels, value):
+        self.add(name + "_bucket", labels + (("le", LATENCY_LABELS[bisect.bisect_left(LATENCY_BUCKETS, value)]),))
+        self.add(name + "_sum", labels, value)
+        self.add(name + "_count", labels)
+
+    def allocate(self, key):
+        with self.lock:
+            if key not in self.slots:
+                if len(self.slots) == METRICS_SLOTS:
+                    return None
+                self.slots[key] = len(self.slots)
+                keys = sorted(self.slots, key=self.slots.get)
+                temp_path = self.index_path.with_suffix(".tmp")
+                temp_path.write_text(json.dumps([[name, [list(label) for label in labels]] for name, labels in keys]))
+                os.replace(str(temp_path), str(self.index_path))
+            return self.slots[key]
+
+
+def read_metrics_index(path):
+    try:
+        keys = json.loads(path.read_text())
+    except FileNotFoundError:
+        return []
+    return [(name, tuple(tuple(label) for label in labels)) for name, labels in keys]
+
+
+def get_metrics():
+    return _get_lmdb().metrics
+
+
+def collect_metrics(directory):
+    """Sums the metrics of all workers that wrote to directory."""
+    totals = collections.defaultdict(float)
+    pids = []
+    for index_path in directory.glob("*.json"):
+        keys = read_metrics_index(index_path)
+        try:
+            data = index_path.with_suffix(".metrics").read_bytes()
+        except FileNotFoundError:
+            continue
+        values = memoryview(data).cast("d")
+        for slot, key in enumerate(keys):
+            totals[key] += values[slot]
+        pids.append(int(index_path.stem))
+    for pid in pids:
+        # The pid of an exited worker may have been reused by another process
+        if not worker_is_running(directory / f"{pid}.metrics"):
+            continue
+        try:
+            totals[("tss_open_files", (("pid", str(pid)),))] = len(os.listdir(f"/proc/{pid}/fd"))
+        except OSError:
+            pass  # Not on Linux
+    return totals
+
+
+def worker_is_running(metrics_path):
+    """Tells if the process that wrote a metrics file still holds its lock."""
+    try:
+        fd = os.open(str(metrics_path), os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def format_metrics(totals):
+    """Formats metrics in the Prometheus text format."""
+    lines = []
+    for name, (kind, description) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind != "histogram":
+            for (key_name, labels), value in sorted(totals.items()):
+                if key_name == name:
+                    lines.append(f"{name}{format_labels(labels)} {value!r}")
+            continue
+        buckets = collections.defaultdict(dict)
+        for (key_name, labels), value in totals.items():
+            if key_name == name + "_bucket":
+                le = dict(labels)["le"]
+                buckets[tuple(label for label in labels if label[0] != "le")][le] = value
+        for labels in sorted(buckets):
+            count = 0
+            for le in LATENCY_LABELS:
+                count += buckets[labels].get(le, 0)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {count!r}")
+            lines.append(f"{name}_sum{format_labels(labels)} {totals[(name + '_sum', labels)]!r}")
+            lines.append(f"{name}_count{format_labels(labels)} {totals[(name + '_count', labels)]!r}")
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    # JSON strings are escaped the way Prometheus label values are
+    return "{" + ",".join("%s=%s" % (name, json.dumps(value, ensure_ascii=False)) for name, value in labels) + "}"
+
+
+class TimedEnvironment:
+    """Wraps the LMDB environment of a process to time its transactions, and how long write transactions wait
+    for the lock. Its transactions also keep the map large enough and follow the environment when it moves."""
+
+    def __init__(self, owner, metrics):
+        self.owner = owner
+        self.metrics = metrics
+
+    def begin(self, write=False, **kwargs):
+        return TimedTransaction(self, write, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.owner.env, name)
+
+
+class TimedTransaction:
+
+    def __init__(self, timed_env, write, kwargs):
+        self.timed_env = timed_env
+        self.write = write
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.tx = self.timed_env.owner.begin(self.write, self.kwargs)
+        self.start = time.perf_counter()
+        if self.write:
+            self.timed_env.metrics.observe("tss_lmdb_write_lock_wait_seconds", (), self.start - start)
+        return self.tx.__enter__()
+
+    def __exit__(self, *exc_info):
+        map_full = exc_info[0] is not None and issubclass(exc_info[0], lmdb.MapFullError)
+        try:
+            return self.tx.__exit__(*exc_info)
+        except lmdb.MapFullError:
+            map_full = True
+            raise
+        finally:
+            self.timed_env.metrics.observe("tss_lmdb_transaction_seconds", (("write", str(self.write).lower()),),
+                                           time.perf_counter() - self.start)
+            self.timed_env.owner.end(map_full)
+
+
+_executors_lock = threading.Lock()
+_executors = {}
+
+
+def get_executor(name, max_workers):
+    """Returns a thread pool that is shared by the requests in this process. Like the LMDB
+    environment it is created on first use, because threads do not survive a fork()."""
+    key = (os.getpid(), name)
+    executor = _executors.get(key)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(key)
+            if executor is None:
+                executor = _executors[key] = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    return executor
 
 
 def hash_object_name(object_name):
@@ -58,6 +666,10 @@ def make_object_path(storage_root, bucket_name, object_name, create=False):
     return path
 
 
+def make_blob_path(storage_root, digest):
+    return pathlib.Path(storage_root, "blobs", digest[0:2], digest[2:4], digest[4:])
+
+
 def make_bucket_path(storage_root, bucket_name, create=False):
     path = pathlib.Path(storage_root, "buckets", bucket_name)
     if create and not path.exists():
@@ -65,6 +677,61 @@ def make_bucket_path(storage_root, bucket_name, create=False):
     return path
 
 
+#
+# Object data can be spread over several volumes, the data roots after the
+# storage root in TSS_STORAGE_ROOT. Files and blobs are placed by weighted
+# rendezvous hashing of the hash or digest they are named after, so every
+# worker finds them without looking anything up, and a new volume only takes
+# data from the others. The metadata stays on the storage root.
+#
+# Until the rebalancer has moved data to its new volume, it is looked for on
+# the other volumes too. The rebalancer renames a file into place before it
+# removes the old one, and new data is always written to its own volume, so
+# looking on that volume once more after the others never misses data.
+#
+
+def get_volumes():
+    """The (path, weight) of all data volumes, the storage root first."""
+    return [(app.config["STORAGE_ROOT"], app.config["STORAGE_WEIGHT"])] + app.config["VOLUMES"]
+
+
+def place_data(name):
+    """The path of the volume for the data named name, a hash or a digest."""
+    volumes = get_volumes()
+    if len(volumes) == 1:
+        return volumes[0][0]
+    return max(volumes, key=lambda volume: rendezvous_score(volume, name))[0]
+
+
+def rendezvous_score(volume, name):
+    path, weight = volume
+    value = int.from_bytes(hashlib.sha1(f"{path}:{name}".encode()).digest()[:8], "big")
+    # -weight / ln(u) of a uniform u in (0, 1) is the highest for a volume in proportion to its weight
+    return -weight / math.log((value + 1) / (2 ** 64 + 1))
+
+
+def data_paths(make_path, name):
+    """The paths data may be at, on the volume it is placed on first."""
+    placed = place_data(name)
+    return [make_path(placed)] + [make_path(path) for path, _ in get_volumes() if path != placed]
+
+
+def object_data_paths(bucket_name, object_name, meta_data):
+    if "Tss-Blob" in meta_data:
+        return data_paths(lambda volume: make_blob_path(volume, meta_data["Tss-Blob"]), meta_data["Tss-Blob"])
+    return data_paths(lambda volume: make_object_path(volume, bucket_name, object_name), hash_object_name(object_name))
+
+
+def find_data(paths, function):
+    """Returns function applied to the first of paths that exists, or raises FileNotFoundError."""
+    for path in (paths + paths[:1] if len(paths) > 1 else paths):
+        try:
+            return function(path)
+        except FileNotFoundError:
+            pass
+    raise FileNotFoundError(str(paths[0]))
+
+
 def key_prefix(bucket_name, object_name=None):
     if object_name:
         return f"{bucket_name}:{object_name}:"
@@ -76,9 +743,1128 @@ def split_key(key):
     return key.decode().split(":", 3)
 
 
-def my_send_file(path, headers):
-    return app.response_class(wrap_file(request.environ, path.open(mode="rb")), mimetype=headers.get("Content-Type", DEFAULT_CONTENT_TYPE),
-                              headers=headers, direct_passthrough=True)
+#
+# Metadata is stored as one record per object in the objects database, keyed
+# on key_prefix(bucket_name, object_name). The record starts with the format
+# version, Content-Length and Last-Modified, followed by tagged fields for the
+# other headers. Content-Type and Content-Encoding are left out when they
+# have their default value. Tss- fields are for internal use and are not
+# returned to clients.
+#
+# Before version 1 every header was a separate `bucket:object:Header` key in
+# the main database. Those are still read, and removed when an object is
+# written, until `flask migrate-metadata` has converted them.
+#
+
+def pack_metadata(meta_data):
+    last_modified = parse_date(meta_data.get("Last-Modified"))
+    fields = [METADATA_RECORD.pack(METADATA_VERSION, int(meta_data.get("Content-Length", 0)),
+                                   calendar.timegm(last_modified.utctimetuple()) if last_modified else 0)]
+    for name, value in meta_data.items():
+        if name in ("Content-Length", "Last-Modified"):
+            continue
+        if name == "Content-Type" and value == DEFAULT_CONTENT_TYPE:
+            continue
+        if name == "Content-Encoding" and value == DEFAULT_CONTENT_ENCODING:
+            continue
+        if name in METADATA_HEADERS:
+            tag, data = METADATA_HEADERS.index(name) + 1, value.encode()
+        else:
+            tag, data = 0, f"{name}:{value}".encode()
+        fields.append(METADATA_FIELD.pack(tag, len(data)))
+        fields.append(data)
+    return b"".join(fields)
+
+
+def unpack_metadata(record):
+    version, content_length, last_modified = METADATA_RECORD.unpack_from(record)
+    if version != METADATA_VERSION:
+        raise ValueError(f"Unsupported metadata record version {version}")
+    meta_data = {
+        "Content-Type": DEFAULT_CONTENT_TYPE,
+        "Content-Encoding": DEFAULT_CONTENT_ENCODING,
+        "Content-Length": str(content_length),
+    }
+    if last_modified:
+        meta_data["Last-Modified"] = http_date(last_modified)
+    offset = METADATA_RECORD.size
+    while offset < len(record):
+        tag, length = METADATA_FIELD.unpack_from(record, offset)
+        offset += METADATA_FIELD.size
+        value = bytes(record[offset:offset + length]).decode()
+        offset += length
+        if tag:
+            meta_data[METADATA_HEADERS[tag - 1]] = value
+        else:
+            name, value = value.split(":", 1)
+            meta_data[name] = value
+    return meta_data
+
+
+def read_metadata(tx, bucket_name, object_name):
+    """Returns the metadata of an object, or None if there is none."""
+    key = key_prefix(bucket_name, object_name).encode()
+    record = tx.get(key, db=get_lmdb_db(b"objects"))
+    if record is not None:
+        return unpack_metadata(record)
+    if _get_lmdb().legacy:
+        return read_legacy_metadata(tx, key)
+    return None
+
+
+def write_metadata(tx, bucket_name, object_name, meta_data):
+    key = key_prefix(bucket_name, object_name).encode()
+    tx.put(key, pack_metadata(meta_data), db=get_lmdb_db(b"objects"))
+    if count_generations(tx):
+        increment_counter(tx, generation_key(bucket_name, object_name))
+    if _get_lmdb().legacy:
+        delete_legacy_metadata(tx, key)
+
+
+def delete_metadata(tx, bucket_name, object_name):
+    """Deletes the metadata of an object. Returns the metadata that was deleted, or None if there was none."""
+    meta_data = read_metadata(tx, bucket_name, object_name)
+    if meta_data is not None:
+        key = key_prefix(bucket_name, object_name).encode()
+        tx.delete(key, db=get_lmdb_db(b"objects"))
+        if count_generations(tx):
+            increment_counter(tx, generation_key(bucket_name, object_name))
+        if _get_lmdb().legacy:
+            delete_legacy_metadata(tx, key)
+    return meta_data
+
+
+def object_headers(meta_data):
+    return {name: value for name, value in meta_data.items() if not name.startswith("Tss-")}
+
+
+def iter_metadata(tx, start, prefix):
+    """Yields (key, meta_data) for the objects with keys that start with prefix, from key start on."""
+    cursor = tx.cursor(db=get_lmdb_db(b"objects"))
+    records = ((key, unpack_metadata(value)) for key, value in iter_prefix(cursor, start, prefix))
+    if not _get_lmdb().legacy:
+        yield from records
+        return
+    last_key = None
+    for key, meta_data in heapq.merge(records, iter_legacy_metadata(tx, start, prefix), key=lambda item: item[0]):
+        if key != last_key:
+            yield key, meta_data
+        last_key = key
+
+
+def iter_prefix(cursor, start, prefix):
+    if cursor.set_range(start):
+        for key, value in cursor:
+            if not key.startswith(prefix):
+                break
+            yield key, value
+
+
+def legacy_object_key(key):
+    """The object part of a pre version 1 `bucket:object:Header` key, including the trailing colon."""
+    return key[:key.rindex(b":") + 1]
+
+
+def new_legacy_metadata():
+    return {"Content-Type": DEFAULT_CONTENT_TYPE, "Content-Encoding": DEFAULT_CONTENT_ENCODING}
+
+
+def read_legacy_metadata(tx, key):
+    meta_data = None
+    for header_key, value in iter_prefix(tx.cursor(), key, key):
+        if legacy_object_key(header_key) == key:
+            meta_data = meta_data or new_legacy_metadata()
+            meta_data[header_key[len(key):].decode()] = value.decode()
+    return meta_data
+
+
+def delete_legacy_metadata(tx, key):
+    header_keys = [header_key for header_key, _ in iter_prefix(tx.cursor(), key, key)
+                   if legacy_object_key(header_key) == key]
+    for header_key in header_keys:
+        tx.delete(header_key)
+    return bool(header_keys)
+
+
+def iter_legacy_metadata(tx, start, prefix):
+    key, meta_data = None, None
+    for header_key, value in iter_prefix(tx.cursor(), start, prefix):
+        object_key = legacy_object_key(header_key)
+        if object_key != key:
+            if meta_data is not None:
+                yield key, meta_data
+            key, meta_data = object_key, new_legacy_metadata()
+        meta_data[header_key[len(object_key):].decode()] = value.decode()
+    if meta_data is not None:
+        yield key, meta_data
+
+
+#
+# Buckets are registered in the buckets database. Every worker keeps the
+# entries it has seen in a cache, which it drops when the buckets-generation
+# counter in the state database, that is incremented by every change to the
+# registry, no longer matches the one it was filled at.
+#
+
+def get_bucket_entry(tx, bucket_name):
+    """Returns the registry entry of a bucket, or None if it does not exist."""
+    lmdb_ = _get_lmdb()
+    generation = tx.get(b"buckets-generation", db=lmdb_.dbs[b"state"])
+    cache_generation, cache = lmdb_.bucket_cache
+    if cache_generation != generation:
+        cache = {}
+        lmdb_.bucket_cache = (generation, cache)
+    if bucket_name not in cache:
+        value = tx.get(bucket_name.encode(), db=lmdb_.dbs[b"buckets"])
+        cache[bucket_name] = json.loads(value) if value is not None else None
+    return cache[bucket_name]
+
+
+def put_bucket_entry(tx, bucket_name, entry):
+    tx.put(bucket_name.encode(), json.dumps(entry).encode(), db=get_lmdb_db(b"buckets"))
+    increment_counter(tx, b"buckets-generation")
+
+
+def delete_bucket_entry(tx, bucket_name):
+    tx.delete(bucket_name.encode(), db=get_lmdb_db(b"buckets"))
+    increment_counter(tx, b"buckets-generation")
+
+
+def read_counter(tx, name):
+    value = tx.get(name, db=get_lmdb_db(b"state"))
+    return COUNTER.unpack(value)[0] if value is not None else 0
+
+
+def increment_counter(tx, name, amount=1):
+    value = read_counter(tx, name) + amount
+    tx.put(name, COUNTER.pack(value), db=get_lmdb_db(b"state"))
+    return value
+
+
+#
+# Workers can cache small objects in memory, up to TSS_CACHE_SIZE bytes each.
+# Every write or delete of an object increments a generation counter in LMDB,
+# so a cached entry is valid as long as the generation it was read at is
+# still current, whichever worker changed the object. Each bucket has 256 of
+# these counters, picked by object name hash, so that a write only
+# invalidates a fraction of the cached objects of its bucket.
+#
+# Until a worker with a cache has opened the environment, which it marks
+# with OBJECT_CACHE_KEY, writes skip the counters. The mark is in LMDB rather
+# than taken from TSS_CACHE_SIZE, because writers such as the commit service
+# and the commands need not have the configuration of the workers.
+#
+
+def generation_key(bucket_name, object_name):
+    return ("generation:%s:%s" % (bucket_name, hash_object_name(object_name)[:2])).encode()
+
+
+def count_generations(tx):
+    """Whether writes have to increment the generation counters. Once they do, they always will."""
+    lmdb_ = _get_lmdb()
+    if not lmdb_.generations:
+        lmdb_.generations = tx.get(OBJECT_CACHE_KEY, db=lmdb_.dbs[b"state"]) is not None
+    return lmdb_.generations
+
+
+class ObjectCache:
+    """A least recently used cache of object metadata and content, bounded by the size of the content."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        """Returns the (metadata, content) of key if it was cached at generation, otherwise None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != generation:
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, generation, meta_data, data):
+        if len(data) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (generation, meta_data, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        _, _, data = self.entries.pop(key)
+        self.size -= len(data)
+
+    def stats(self):
+        with self.lock:
+            return {"Hits": self.hits, "Misses": self.misses, "Evictions": self.evictions,
+                    "Entries": len(self.entries), "Bytes": self.size, "MaxBytes": self.max_size}
+
+
+def get_object_cache():
+    """The object cache of this worker, or None when caching is disabled."""
+    return _get_lmdb().object_cache
+
+
+#
+# Object data is stored in a file at make_object_path(), or with TSS_DEDUP
+# enabled, in a blob at make_blob_path() that is named after the SHA-256 of
+# the content and shared by all objects with that content. The blobs database
+# keeps a reference count per blob. Blobs are created and removed inside the
+# write transaction that changes their reference count, so that a concurrent
+# upload of the same content can never lose its blob.
+#
+# Objects of at most TSS_INLINE_THRESHOLD bytes are stored in the inline
+# database instead, under the same key as their metadata, and marked with a
+# Tss-Inline field. They never touch the filesystem.
+#
+
+def upload_directory(bucket_name, object_name):
+    """The directory to receive the content of an object in, on the filesystem it will end up on. A blob
+    is named after its content, so until that is known it is received on the volume of the object."""
+    volume = place_data(hash_object_name(object_name))
+    if app.config["DEDUP"]:
+        return pathlib.Path(volume, "blobs")
+    return make_object_path(volume, bucket_name, object_name).parent
+
+
+def blob_name(digest, meta_data):
+    # The same content compressed with another algorithm is stored as a blob of its own
+    if "Tss-Compression" in meta_data:
+        return "%s.%s" % (digest, meta_data["Tss-Compression"])
+    return digest
+
+
+def move_upload_to_blob_volume(temp_path, digest, meta_data):
+    """Copies a received upload to the volume of its blob, unless it is there or the blob exists already.
+    Returns the path of the upload. This is done before the write transaction, which it would hold up."""
+    volume = place_data(blob_name(digest, meta_data))
+    if temp_path.parent == pathlib.Path(volume, "blobs"):
+        return temp_path
+    with get_lmdb_env().begin() as tx:
+        if tx.get(blob_name(digest, meta_data).encode(), db=get_lmdb_db(b"blobs")) is not None:
+            return temp_path
+    fd, moved_path = create_temp_file(pathlib.Path(volume, "blobs"))
+    try:
+        with os.fdopen(fd, "wb") as f, temp_path.open(mode="rb") as source:
+            shutil.copyfileobj(source, f)
+    except BaseException:
+        os.unlink(moved_path)
+        raise
+    os.unlink(str(temp_path))
+    return pathlib.Path(moved_path)
+
+
+def store_object(tx, bucket_name, object_name, meta_data, digest, temp_path=None, data=None):
+    """Stores the content of an object, received either in temp_path or in memory as data when it is to
+    be stored inline, and writes its metadata."""
+    if get_bucket_entry(tx, bucket_name) is None:
+        # Deleted while the content was received, which moved the directory of the upload with the bucket
+        if temp_path is not None:
+            unlink_quietly(temp_path)
+        abort(404)
+    old_meta_data = read_metadata(tx, bucket_name, object_name)
+    if "Tss-Version" in meta_data:
+        version = int(meta_data["Tss-Version"])
+        tombstone = read_tombstone(tx, bucket_name, object_name)
+        if newer_version(old_meta_data, version) or (tombstone is not None and tombstone >= version):
+            # A replica can receive writes out of order, the newest one or the delete after it is kept
+            if temp_path is not None:
+                os.unlink(str(temp_path))
+            return
+        if tombstone is not None:
+            tx.delete(key_prefix(bucket_name, object_name).encode(), db=get_lmdb_db(b"tombstones"))
+    if data is not None:
+        meta_data["Tss-Inline"] = "1"
+        tx.put(key_prefix(bucket_name, object_name).encode(), data, db=get_lmdb_db(b"inline"))
+    elif app.config["DEDUP"]:
+        digest = blob_name(digest, meta_data)
+        meta_data["Tss-Blob"] = digest
+        stored_length = int(meta_data.get("Tss-Stored-Length", meta_data["Content-Length"]))
+        new, stored_length = acquire_blob(tx, digest, stored_length)
+        if "Tss-Stored-Length" in meta_data:
+            # Buckets with other compression levels store the same content in the same blob, in fewer or more bytes
+            meta_data["Tss-Stored-Length"] = str(stored_length)
+        if new:
+            if app.config["FSYNC"] != "none":
+                sync_file(temp_path)
+            # Where the blob was deleted since the upload was moved to its volume, it is left to the rebalancer
+            blob_path = make_blob_path(temp_path.parent.parent, digest)
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            commit_file(temp_path, blob_path)
+        else:
+            # The content is already stored, so this upload never has to be synced or renamed
+            os.unlink(str(temp_path))
+        increment_counter(tx, b"dedup-logical-bytes", int(meta_data["Content-Length"]))
+    else:
+        volume = place_data(hash_object_name(object_name))
+        commit_file(temp_path, make_object_path(volume, bucket_name, object_name))
+    write_metadata(tx, bucket_name, object_name, meta_data)
+    if old_meta_data is not None and not ("Tss-Inline" in old_meta_data and "Tss-Inline" in meta_data):
+        at_object_path = "Tss-Blob" not in meta_data and "Tss-Inline" not in meta_data
+        release_object_data(tx, bucket_name, object_name, old_meta_data, unlink=not at_object_path)
+
+
+def newer_version(meta_data, version):
+    """Whether an object has a newer version than version, which is what replicated writes are ordered by."""
+    return meta_data is not None and int(meta_data.get("Tss-Version", "0")) > version
+
+
+def release_object_data(tx, bucket_name, object_name, meta_data, unlink=True):
+    """Releases the content of an object that was deleted or replaced. Returns the paths of files that
+    still have to be unlinked, one per volume. With unlink the files are removed right away instead."""
+    if "Tss-Inline" in meta_data:
+        tx.delete(key_prefix(bucket_name, object_name).encode(), db=get_lmdb_db(b"inline"))
+        return []
+    if "Tss-Blob" in meta_data:
+        release_blob(tx, meta_data["Tss-Blob"])
+        increment_counter(tx, b"dedup-logical-bytes", -int(meta_data["Content-Length"]))
+        return []
+    paths = object_data_paths(bucket_name, object_name, meta_data)
+    if not unlink:
+        return paths
+    for path in paths:
+        unlink_quietly(path)
+    return []
+
+
+def remove_object(tx, bucket_name, object_name, version=None):
+    """Deletes the metadata and the content of an object. Given the version of a replicated delete, a newer
+    version of the object is kept, and a tombstone is left for older ones. Returns False if there was no
+    object."""
+    if get_bucket_entry(tx, bucket_name) is None:
+        abort(404)
+    if version is not None:
+        if newer_version(read_metadata(tx, bucket_name, object_name), version):
+            return True
+        write_tombstone(tx, bucket_name, object_name, version)
+    meta_data = delete_metadata(tx, bucket_name, object_name)
+    if meta_data is None:
+        if version is not None:
+            return False  # The tombstone is still committed
+        abort(404)
+    # Its file is unlinked under the write lock, so that it can never remove the file of a new upload
+    release_object_data(tx, bucket_name, object_name, meta_data)
+    return True
+
+
+#
+# Tombstones
+#
+# A replicated delete leaves the version it was made at in the tombstones
+# database, so that a replica does not store a write that is older than the
+# delete when it arrives late, and so that a read can tell that the 404 of a
+# replica is newer than the object another replica still has. Every
+# replicated delete also looks at the next few tombstones, going round the
+# database, and removes those older than TSS_CLUSTER_TOMBSTONE_TTL, by when
+# every replica has long had the delete or missed it for good.
+#
+
+TOMBSTONES_REAPED_KEY = b"tombstones-reaped-to"
+TOMBSTONES_REAPED_PER_DELETE = 2
+
+
+def read_tombstone(tx, bucket_name, object_name):
+    """Returns the version at which an object was deleted, or None."""
+    value = tx.get(key_prefix(bucket_name, object_name).encode(), db=get_lmdb_db(b"tombstones"))
+    return int(value) if value is not None else None
+
+
+def write_tombstone(tx, bucket_name, object_name, version):
+    tombstone = read_tombstone(tx, bucket_name, object_name)
+    if tombstone is None or tombstone < version:
+        tx.put(key_prefix(bucket_name, object_name).encode(), str(version).encode(), db=get_lmdb_db(b"tombstones"))
+    reap_tombstones(tx, TOMBSTONES_REAPED_PER_DELETE)
+
+
+def reap_tombstones(tx, count):
+    """Removes the expired ones among the next count tombstones after those looked at last. Returns how
+    many were removed."""
+    tombstones = get_lmdb_db(b"tombstones")
+    state = get_lmdb_db(b"state")
+    expiry = new_version() - app.config["CLUSTER_TOMBSTONE_TTL"] * 10 ** 9
+    cursor = tx.cursor(db=tombstones)
+    found = cursor.set_range(tx.get(TOMBSTONES_REAPED_KEY, db=state) or b"")
+    expired = []
+    position = b""
+    for _ in range(count):
+        if not found:
+            position = b""  # Around again
+            break
+        if int(cursor.value()) < expiry:
+            expired.append(cursor.key())
+        position = cursor.key() + b"\x00"
+        found = cursor.next()
+    cursor.close()
+    for key in expired:
+        tx.delete(key, db=tombstones)
+    tx.put(TOMBSTONES_REAPED_KEY, position, db=state)
+    return len(expired)
+
+
+# The writes that can be sent to the commit service
+COMMIT_FUNCTIONS = (store_object, remove_object)
+
+
+def acquire_blob(tx, digest, size):
+    """Adds a reference to a blob. Returns whether the blob is new and its content has to be stored, and the size
+    of the blob."""
+    blobs = get_lmdb_db(b"blobs")
+    increment_counter(tx, b"dedup-references")
+    value = tx.get(digest.encode(), db=blobs)
+    if value is None:
+        tx.put(digest.encode(), BLOB.pack(1, size), db=blobs)
+        increment_counter(tx, b"dedup-physical-bytes", size)
+        return True, size
+    references, size = BLOB.unpack(value)
+    tx.put(digest.encode(), BLOB.pack(references + 1, size), db=blobs)
+    return False, size
+
+
+def release_blob(tx, digest):
+    blobs = get_lmdb_db(b"blobs")
+    value = tx.get(digest.encode(), db=blobs)
+    if value is None:
+        return
+    increment_counter(tx, b"dedup-references", -1)
+    references, size = BLOB.unpack(value)
+    if references > 1:
+        tx.put(digest.encode(), BLOB.pack(references - 1, size), db=blobs)
+    else:
+        tx.delete(digest.encode(), db=blobs)
+        increment_counter(tx, b"dedup-physical-bytes", -size)
+        for path in data_paths(lambda volume: make_blob_path(volume, digest), digest):
+            unlink_quietly(path)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with path.open(mode="rb") as f:
+        for chunk in iter(lambda: f.read(SEND_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def migrate_metadata(batch_size):
+    """Converts the metadata of up to batch_size objects to version 1 records in a single write
+    transaction. Returns the number of objects that were converted."""
+    objects = get_lmdb_db(b"objects")
+    with get_lmdb_env().begin(write=True) as tx:
+        legacy = {}
+        for key in tx.cursor().iternext(values=False):
+            if key in LMDB_DATABASES:
+                continue
+            object_key = legacy_object_key(key)
+            if object_key not in legacy and len(legacy) == batch_size:
+                break
+            legacy.setdefault(object_key, []).append(key)
+        for object_key, header_keys in legacy.items():
+            # An object that was written during the migration already has a record
+            if tx.get(object_key, db=objects) is None:
+                meta_data = new_legacy_metadata()
+                for header_key in header_keys:
+                    meta_data[header_key[len(object_key):].decode()] = tx.get(header_key).decode()
+                tx.put(object_key, pack_metadata(meta_data), db=objects)
+            for header_key in header_keys:
+                tx.delete(header_key)
+    return len(legacy)
+
+
+def receive_file(directory, stream, sync=True, compression=None):
+    """Copy a stream in fixed size chunks to a new temporary file in directory. Returns the path
+    of the temporary file, the number of bytes received and the SHA-256 hex digest of the content.
+    Without sync the file is not synced, regardless of the fsync policy. With compression settings
+    the file is compressed while it is written."""
+    fsync = app.config["FSYNC"]
+    chunk_size = app.config["UPLOAD_CHUNK_SIZE"]
+    fd, temp_path = create_temp_file(directory)
+    try:
+        size, digest = 0, hashlib.sha256()
+        compressor = make_compressor(compression) if compression is not None else None
+        with os.fdopen(fd, "wb") as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(compressor.compress(chunk) if compressor is not None else chunk)
+                digest.update(chunk)
+                size += len(chunk)
+            if compressor is not None:
+                f.write(compressor.flush())
+            if has_request_context():
+                g.received_bytes = g.get("received_bytes", 0) + size
+            if sync and fsync != "none":
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return pathlib.Path(temp_path), size, digest.hexdigest()
+
+
+def create_temp_file(directory):
+    try:
+        return tempfile.mkstemp(dir=str(directory), prefix=".tmp-")
+    except FileNotFoundError:
+        directory.mkdir(parents=True, exist_ok=True)
+        return tempfile.mkstemp(dir=str(directory), prefix=".tmp-")
+
+
+def make_compressor(compression):
+    return zlib.compressobj(compression.get("Level", 6), zlib.DEFLATED, COMPRESSION_WBITS[compression["Algorithm"]])
+
+
+def iter_decompressed(f, algorithm):
+    """Yields the decompressed content of file f in chunks, and closes it."""
+    with f:
+        decompressor = zlib.decompressobj(COMPRESSION_WBITS[algorithm])
+        for chunk in iter(lambda: f.read(SEND_CHUNK_SIZE), b""):
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+
+def concatenate_files(directory, paths, sync=True):
+    """Concatenates files into a new temporary file in directory, with copy_file_range() where the
+    platform and filesystem support it. Returns the path of the temporary file and its size."""
+    fd, temp_path = create_temp_file(directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for path in paths:
+                with path.open(mode="rb") as part:
+                    copy_file(part, f)
+            size = f.tell()
+            if sync and app.config["FSYNC"] != "none":
+                f.flush()
+                os.fsync(f.fileno())
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return pathlib.Path(temp_path), size
+
+
+def copy_file(src, dst):
+    """Appends the rest of file src to file dst."""
+    dst.flush()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src.fileno(), dst.fileno(), 1024 * 1024 * 1024):
+                pass
+        except OSError:
+            pass  # Not supported between these files, the copy below continues where it stopped
+        src.seek(os.lseek(src.fileno(), 0, os.SEEK_CUR))
+        dst.seek(0, os.SEEK_END)
+    shutil.copyfileobj(src, dst, SEND_CHUNK_SIZE)
+
+
+def sync_file(path):
+    fd = os.open(str(path), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def commit_file(temp_path, path):
+    """Atomically rename a file written by receive_file over path."""
+    os.replace(str(temp_path), str(path))
+    if app.config["FSYNC"] == "dir":
+        sync_file(path.parent)
+
+
+class FileSlice:
+    """A read only view of length bytes of a file, starting at offset. Because it exposes the fileno() of
+    the underlying file, a wsgi.file_wrapper like the one in gunicorn can send it with os.sendfile()."""
+
+    def __init__(self, f, offset, length):
+        f.seek(offset)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+def resolve_ranges(range_header, length):
+    """Returns the satisfiable (start, stop) byte ranges of a Range header, [] if none of them are
+    satisfiable or None if the header is missing, malformed or not in bytes."""
+    rng = parse_range_header(range_header)
+    if rng is None or rng.units != "bytes":
+        return None
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start = max(length + start, 0)
+        if stop is None or stop > length:
+            stop = length
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def multipart_byteranges_parts(ranges, length, boundary, content_type):
+    """The parts of a multipart/byteranges body: bytes for the part headers and (start, stop) for the data."""
+    for start, stop in ranges:
+        yield (f"\r\n--{boundary}\r\nContent-Type: {content_type}\r\n"
+               f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n").encode()
+        yield start, stop
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+
+def iter_byteranges(f, ranges, length, boundary, content_type):
+    try:
+        for part in multipart_byteranges_parts(ranges, length, boundary, content_type):
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, stop = part
+            f.seek(start)
+            while start < stop:
+                data = f.read(min(SEND_CHUNK_SIZE, stop - start))
+                if not data:
+                    return
+                start += len(data)
+                yield data
+    finally:
+        f.close()
+
+
+def evaluate_preconditions(headers):
+    """Evaluates the conditional request headers against the metadata of an object. Returns the
+    412 or 304 response to send instead of the object, or None if the request should proceed."""
+    etag, _ = unquote_etag(headers.get("ETag"))
+    last_modified = parse_date(headers.get("Last-Modified"))
+
+    if "If-Match" in request.headers:
+        if_match = parse_etags(request.headers["If-Match"])
+        if not (if_match.star_tag or (etag and if_match.contains(etag))):
+            abort(412)
+    elif "If-Unmodified-Since" in request.headers:
+        date = parse_date(request.headers["If-Unmodified-Since"])
+        if date and last_modified and last_modified > date:
+            abort(412)
+
+    not_modified = False
+    if "If-None-Match" in request.headers:
+        if_none_match = parse_etags(request.headers["If-None-Match"])
+        not_modified = if_none_match.star_tag or bool(etag and if_none_match.contains_weak(etag))
+    elif "If-Modified-Since" in request.headers:
+        date = parse_date(request.headers["If-Modified-Since"])
+        not_modified = bool(date and last_modified and last_modified <= date)
+
+    if not_modified:
+        return Response(status=304, headers={"ETag": headers["ETag"]} if "ETag" in headers else {})
+    return None
+
+
+def if_range_matches(headers):
+    """True if the If-Range header is absent or still matches the object, in which case Range applies."""
+    if "If-Range" not in request.headers:
+        return True
+    if_range = parse_if_range_header(request.headers["If-Range"])
+    if if_range.etag is not None:
+        etag, weak = unquote_etag(headers.get("ETag"))
+        return bool(etag) and not weak and etag == if_range.etag
+    return if_range.date is not None and if_range.date == parse_date(headers.get("Last-Modified"))
+
+
+def send_object_file(f, headers, length=None):
+    """Build the response for the already opened object file f, honouring the Range header."""
+    if length is None:
+        length = os.fstat(f.fileno()).st_size
+    content_type = headers.get("Content-Type", DEFAULT_CONTENT_TYPE)
+    headers["Accept-Ranges"] = "bytes"
+    headers["Content-Length"] = str(length)
+
+    ranges = resolve_ranges(request.headers.get("Range"), length) if if_range_matches(headers) else None
+    if ranges == []:
+        f.close()
+        return Response(status=416, headers={"Content-Range": f"bytes */{length}", "Accept-Ranges": "bytes"})
+
+    if ranges is None:
+        body, status = wrap_file(request.environ, f), 200
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+        headers["Content-Length"] = str(stop - start)
+        body, status = wrap_file(request.environ, FileSlice(f, start, stop - start)), 206
+    else:
+        boundary = os.urandom(16).hex()
+        headers["Content-Length"] = str(sum(len(part) if isinstance(part, bytes) else part[1] - part[0]
+                                            for part in multipart_byteranges_parts(ranges, length, boundary, content_type)))
+        body, status = iter_byteranges(f, ranges, length, boundary, content_type), 206
+        return app.response_class(body, status, headers=headers, content_type=f"multipart/byteranges; boundary={boundary}",
+                                  direct_passthrough=True)
+
+    return app.response_class(body, status, headers=headers, mimetype=content_type, direct_passthrough=True)
+
+
+#
+# Group commit
+#
+# With TSS_GROUP_COMMIT=thread the metadata writes of PUT and DELETE requests
+# are not made in a write transaction of their own each, but handed to a
+# committer thread in the worker, which makes all writes that are waiting in
+# a single transaction. Every write runs in a nested transaction, so that one
+# that fails is rolled back alone. A request returns once the transaction
+# with its write has been committed, and LMDB syncs every commit.
+#
+# With TSS_GROUP_COMMIT=service workers send their writes over a unix socket
+# to the commit service, started with "flask commit-service", whose committer
+# merges the writes of all workers. As long as the service is not running,
+# workers make their writes themselves.
+#
+
+class GroupCommitter:
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="tss-committer", daemon=True)
+        self.thread.start()
+
+    def submit(self, function, args, kwargs):
+        """Queues function(tx, *args, **kwargs) and returns its result once it is committed."""
+        future = concurrent.futures.Future()
+        self.queue.put((function, args, kwargs, future))
+        return future.result()
+
+    def run(self):
+        while True:
+            # Whatever was queued while the previous batch was committed goes into the next one
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.commit(batch)
+            except Exception:
+                # The writes of the batch have their results, the committer goes on with the next one
+                app.logger.exception("Group commit failed")
+
+    def commit(self, batch):
+        results = []
+        try:
+            env = get_lmdb_env()
+            with env.begin(write=True) as tx:
+                for function, args, kwargs, future in batch:
+                    try:
+                        with env.begin(write=True, parent=tx) as child:
+                            results.append((future, function(child, *args, **kwargs), None))
+                    except Exception as error:
+                        results.append((future, None, error))
+        except BaseException as error:
+            for _, _, _, future in batch:
+                future.set_exception(error)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        metrics = get_metrics()
+        metrics.add("tss_group_commits_total")
+        metrics.add("tss_group_commit_writes_total", amount=len(batch))
+        if any(isinstance(error, lmdb.MapFullError) for _, _, error in results):
+            # A nested transaction cannot grow the map, because the committer still had its parent
+            _get_lmdb().grow(full=True)
+
+
+_committers_lock = threading.Lock()
+_committers = {}
+
+
+def get_group_committer():
+    """Returns the committer thread of this process, which is started on first use like the executors."""
+    key = os.getpid()
+    committer = _committers.get(key)
+    if committer is None:
+        with _committers_lock:
+            committer = _committers.get(key)
+            if committer is None:
+                committer = _committers[key] = GroupCommitter(app.config["GROUP_COMMIT_BATCH_SIZE"])
+    return committer
+
+
+def commit_write(function, *args, **kwargs):
+    """Runs function(tx, *args, **kwargs) in a write transaction, on its own or merged with other writes
+    depending on TSS_GROUP_COMMIT, and returns its result once it has been committed."""
+    mode = app.config["GROUP_COMMIT"]
+    if mode == "thread":
+        return get_group_committer().submit(function, args, kwargs)
+    if mode == "service":
+        connection = get_commit_connection()
+        if connection is not None:
+            try:
+                send_message(connection, (function.__name__, args, kwargs))
+                status, value = receive_message(connection)
+            except OSError:
+                # The write may or may not have been committed, so it cannot be made here instead
+                close_commit_connection()
+                abort(503)
+            if status == "ok":
+                return value
+            if status == "abort":
+                abort(value)
+            if status == "map-full":
+                raise lmdb.MapFullError(value)
+            raise RuntimeError("Commit service failed: %s" % value)
+    with get_lmdb_env().begin(write=True) as tx:
+        return function(tx, *args, **kwargs)
+
+
+def get_commit_socket_path():
+    return pathlib.Path(app.config["GROUP_COMMIT_SOCKET"] or pathlib.Path(app.config["STORAGE_ROOT"], "commit.sock"))
+
+
+_commit_connections = threading.local()
+
+
+def get_commit_connection():
+    """Returns the connection of this thread to the commit service, or None when the service is not running."""
+    key = (os.getpid(), get_commit_socket_path())
+    current = getattr(_commit_connections, "current", None)
+    if current is not None and current[0] == key:
+        return current[1]
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(str(key[1]))
+    except OSError:
+        connection.close()
+        return None
+    _commit_connections.current = (key, connection)
+    return connection
+
+
+def close_commit_connection():
+    current = getattr(_commit_connections, "current", None)
+    if current is not None:
+        current[1].close()
+        _commit_connections.current = None
+
+
+def send_message(connection, message):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    connection.sendall(COMMIT_FRAME.pack(len(data)) + data)
+
+
+def receive_message(connection):
+    """Returns the next message on a connection, or raises EOFError when it was closed."""
+    size, = COMMIT_FRAME.unpack(receive_exactly(connection, COMMIT_FRAME.size))
+    return pickle.loads(receive_exactly(connection, size))
+
+
+def receive_exactly(connection, size):
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = connection.recv(size - len(buffer))
+        if not chunk:
+            raise EOFError()
+        buffer += chunk
+    return bytes(buffer)
+
+
+def open_commit_socket(path):
+    """Listens on the socket of the commit service, replacing the socket of a service that is no longer running."""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(str(path))
+    except FileNotFoundError:
+        pass
+    except ConnectionRefusedError:
+        path.unlink()
+    else:
+        raise click.ClickException(f"A commit service is already listening on {path}")
+    finally:
+        probe.close()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Messages are unpickled, so only processes of the same user may connect
+    umask = os.umask(0o177)
+    try:
+        listener.bind(str(path))
+    finally:
+        os.umask(umask)
+    listener.listen(128)
+    return listener
+
+
+def serve_commits(listener):
+    """Accepts connections from workers until the listener is closed, with a thread for each."""
+    while True:
+        try:
+            connection, _ = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=serve_commit_connection, args=(connection,), daemon=True).start()
+
+
+def serve_commit_connection(connection):
+    functions = {function.__name__: function for function in COMMIT_FUNCTIONS}
+    committer = get_group_committer()
+    with connection:
+        while True:
+            try:
+                name, args, kwargs = receive_message(connection)
+            except (EOFError, OSError):
+                return
+            try:
+                response = ("ok", committer.submit(functions[name], args, kwargs))
+            except HTTPException as error:
+                response = ("abort", error.code)
+            except lmdb.MapFullError as error:
+                response = ("map-full", str(error))
+            except Exception as error:
+                app.logger.exception("Failed to commit %s", name)
+                response = ("error", repr(error))
+            try:
+                send_message(connection, response)
+            except OSError:
+                return
+
+
+#
+# Commands
+#
+
+@app.cli.command("migrate-metadata")
+@click.option("--batch-size", default=1000, help="Number of objects to convert per write transaction.")
+def migrate_metadata_command(batch_size):
+    """Convert metadata to the current record format, while the server keeps running."""
+    total = 0
+    while True:
+        try:
+            count = migrate_metadata(batch_size)
+        except lmdb.MapFullError:
+            continue  # Again, in the grown map
+        if count == 0:
+            break
+        total += count
+        click.echo(f"Converted {total} objects")
+    click.echo("Metadata is up to date")
+
+
+@app.cli.command("reap-buckets")
+@click.option("--batch-size", default=1000, help="Number of objects to delete per write transaction.")
+def reap_buckets_command(batch_size):
+    """Finish deleting deleted buckets, in the foreground."""
+    while True:
+        try:
+            if not reap_deleted_buckets(batch_size):
+                break
+        except lmdb.MapFullError:
+            pass  # Again, in the grown map
+    click.echo("Deleted buckets are reaped")
+
+
+@app.cli.command("compact-metadata")
+def compact_metadata_command():
+    """Copy the metadata without its free pages, while the server keeps running."""
+    before, after = compact_metadata()
+    click.echo(f"Compacted the metadata from {before} to {after} bytes")
+
+
+@app.cli.command("commit-service")
+def commit_service_command():
+    """Merge the metadata writes of all workers into group commits, until interrupted."""
+    path = get_commit_socket_path()
+    listener = open_commit_socket(path)
+    click.echo(f"Listening on {path}")
+    try:
+        serve_commits(listener)
+    finally:
+        listener.close()
+        path.unlink()
+
+
+@app.cli.command("rebalance")
+@click.option("--rate", type=int, default=0, help="Files moved per second, 0 for no limit.")
+def rebalance_command(rate):
+    """Move files and blobs to the volumes they are placed on, while the server keeps running."""
+    moved, moved_bytes = rebalance(RateLimiter(rate))
+    click.echo(f"Moved {moved} files of {moved_bytes} bytes")
+
+
+@app.cli.command("scrub")
+@click.option("--repair", is_flag=True, default=False, help="Repair the problems that are found.")
+@click.option("--rate", type=int, default=None, help="Checks per second, defaults to TSS_SCRUB_RATE.")
+def scrub_command(repair, rate):
+    """Check that metadata and files agree, continuing the current pass or starting a new one."""
+    lock = lock_scrubber()
+    if lock is None:
+        raise click.ClickException("Another process is scrubbing")
+    try:
+        limiter = RateLimiter(rate if rate is not None else app.config["SCRUB_RATE"])
+        while scrub_step(repair, limiter):
+            pass
+    finally:
+        lock.close()
+    _, last_pass = read_scrub_state()
+    click.echo(f"Checked {last_pass['Checked']}, found {sum(last_pass['Problems'].values())} problems, "
+               f"repaired {last_pass['Repaired']}")
+
+
+@app.cli.command("cleanup-uploads")
+@click.option("--max-age", type=int, default=None, help="Age in seconds, defaults to TSS_MULTIPART_EXPIRY.")
+def cleanup_uploads_command(max_age):
+    """Abort multipart uploads that were abandoned."""
+    count = cleanup_uploads(max_age if max_age is not None else app.config["MULTIPART_EXPIRY"])
+    click.echo(f"Removed {count} uploads")
+
+
+#
+# Request metrics
+#
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Files are sent by the server after this, and werkzeug does not call close callbacks for them,
+    # so the duration ends when the response starts and the sent bytes are taken from Content-Length
+    route = request.url_rule.endpoint if request.url_rule is not None else "none"
+    metrics = get_metrics()
+    metrics.add("tss_requests_total", (("method", request.method), ("route", route),
+                                       ("status", str(response.status_code))))
+    metrics.observe("tss_request_duration_seconds", (("route", route),),
+                    time.perf_counter() - g.get("request_start", time.perf_counter()))
+    metrics.add("tss_received_bytes_total", (("route", route),), g.get("received_bytes", request.content_length or 0))
+    if request.method != "HEAD":
+        metrics.add("tss_sent_bytes_total", (("route", route),), response.content_length or 0)
+    return response
+
+
+@app.route("/_metrics", methods=["GET"])
+def get_metrics_endpoint():
+    return app.response_class(format_metrics(collect_metrics(get_metrics_dir())),
+                              mimetype="text/plain; version=0.0.4")
 
 
 #
@@ -93,62 +1879,1439 @@ def authenticate():
             abort(401)
 
 
+#
+# Cluster
+#
+# With TSS_CLUSTER_NODES the nodes form a consistent hash ring, on which every
+# object is stored on the TSS_CLUSTER_REPLICAS nodes that follow its key. The
+# node that receives a request coordinates it: writes are sent to all of the
+# replicas and succeed once TSS_CLUSTER_WRITE_QUORUM of them have them, reads
+# ask TSS_CLUSTER_READ_QUORUM replicas for the version they have and are
+# served by the one with the newest. Buckets exist on every node, so bucket
+# changes go to all nodes and listings are merged from all of them.
+#
+# Every write gets a version from the clock of its coordinator, and replicas
+# keep the newest version they received, in whatever order writes arrive. A
+# delete leaves a tombstone with its version.
+# Requests between nodes carry TSS_CLUSTER_SECRET in a Tss-Replica header and
+# are handled like requests to a single node, in process when a node is its
+# own replica. Clients cannot send Tss-Replica, so they can neither skip the
+# replication nor choose the version of a write.
+#
+
+class HashRing:
+    def __init__(self, nodes, vnodes=CLUSTER_VNODES):
+        points = sorted((hash_point(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+        self.count = len(set(nodes))
+
+    def preference_list(self, key, count):
+        """The first count different nodes after key on the ring."""
+        nodes = []
+        start = bisect.bisect(self.points, hash_point(key))
+        for i in range(len(self.nodes)):
+            node = self.nodes[(start + i) % len(self.nodes)]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == min(count, self.count):
+                    break
+        return nodes
+
+
+def hash_point(key):
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+
+_rings = {}
+
+
+def get_ring():
+    nodes = tuple(app.config["CLUSTER_NODES"])
+    if app.config["CLUSTER_SELF"] not in nodes:
+        raise ValueError(f"TSS_CLUSTER_SELF {app.config['CLUSTER_SELF']!r} is not one of TSS_CLUSTER_NODES")
+    ring = _rings.get(nodes)
+    if ring is None:
+        ring = _rings[nodes] = HashRing(nodes)
+    return ring
+
+
+def object_replicas(bucket_name, object_name):
+    return get_ring().preference_list(key_prefix(bucket_name, object_name), app.config["CLUSTER_REPLICAS"])
+
+
+def is_replica_request():
+    """Whether this request was sent by another node. A Tss-Replica header without the secret is refused."""
+    value = request.headers.get("Tss-Replica")
+    if value is None:
+        return False
+    secret = app.config["CLUSTER_SECRET"]
+    if not app.config["CLUSTER_NODES"] or not secret or not hmac.compare_digest(value.encode(), secret.encode()):
+        abort(403)
+    return True
+
+
+def replica_version():
+    """The Tss-Version of a write that another node coordinated, or None."""
+    if not is_replica_request() or "Tss-Version" not in request.headers:
+        return None
+    value = request.headers["Tss-Version"]
+    if not 1 <= len(value) <= len(str(MAX_VERSION)) or value.strip("0123456789") or int(value) > MAX_VERSION:
+        abort(400)
+    return int(value)
+
+
+@app.before_request
+def route_cluster_request():
+    """Coordinates requests in cluster mode. Returns None where this node serves the request itself."""
+    if is_replica_request() or not app.config["CLUSTER_NODES"] or request.url_rule is None:
+        return None
+    endpoint = request.url_rule.endpoint
+    if endpoint == "post_bucket" or endpoint == "post_object" or "uploadId" in request.args:
+        # Batches and multipart uploads span several objects, which are on different nodes
+        abort(501)
+    if endpoint == "get_bucket" and (request.args.get("format") == "ndjson" or "archive" in request.args):
+        # An export would have to merge the streams of all nodes
+        abort(501)
+    if endpoint == "get_object":
+        return coordinate_read(request.view_args["bucket_name"], request.view_args["object_name"])
+    if endpoint in ("put_object", "delete_object"):
+        return coordinate_write(request.view_args["bucket_name"], request.view_args["object_name"])
+    if endpoint in ("put_bucket", "delete_bucket"):
+        return coordinate_bucket_change()
+    if endpoint == "get_bucket":
+        return coordinate_listing(request.view_args["bucket_name"])
+    return None
+
+
+def coordinate_write(bucket_name, object_name):
+    nodes = object_replicas(bucket_name, object_name)
+    quorum = min(app.config["CLUSTER_WRITE_QUORUM"], len(nodes))
+    headers = forwarded_headers()
+    headers["Tss-Version"] = str(new_version())
+    bodies = [None] * len(nodes)
+    if request.method == "PUT":
+        # Every replica reads its own handle on the body, which is gone once they are all closed
+        with tempfile.NamedTemporaryFile(dir=app.config["STORAGE_ROOT"], prefix=".tmp-") as f:
+            shutil.copyfileobj(request.stream, f, app.config["UPLOAD_CHUNK_SIZE"])
+            f.flush()
+            headers["Content-Length"] = str(f.tell())
+            bodies = [open(f.name, "rb") for _ in nodes]
+    executor = get_executor("cluster", CLUSTER_THREADS)
+    futures = [executor.submit(send_to_replica, node, request.method, forwarded_path(), headers, body)
+               for node, body in zip(nodes, bodies)]
+
+    acks = []
+    answers = []
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=app.config["CLUSTER_TIMEOUT"]):
+            response = future.result()
+            if response is None:
+                continue
+            answers.append(response)
+            # Deleting what a replica does not have is done as well
+            if response.status < 300 or (request.method == "DELETE" and response.status == 404):
+                acks.append(response)
+                if len(acks) == quorum:
+                    break
+    except concurrent.futures.TimeoutError:
+        pass
+    if len(acks) < quorum:
+        for response in answers:
+            if 400 <= response.status < 500:
+                return node_response(response)
+        abort(503)
+    # The other replicas still get the write, after the response
+    return node_response(min(acks, key=lambda response: response.status))
+
+
+def new_version():
+    """The version of a write, nanoseconds since the epoch on the clock of its coordinator."""
+    # Like time.time_ns(), which Python 3.6 does not have
+    return int(time.time() * 1e9)
+
+
+def send_to_replica(node, method, path, headers, body):
+    """Sends a write to a replica. Returns its response, or None if it could not be reached."""
+    try:
+        return node_request_quietly(node, method, path, headers, body)
+    finally:
+        if body is not None:
+            body.close()
+
+
+def coordinate_read(bucket_name, object_name):
+    nodes = object_replicas(bucket_name, object_name)
+    quorum = min(app.config["CLUSTER_READ_QUORUM"], len(nodes))
+    self_node = app.config["CLUSTER_SELF"]
+    if quorum == 1:
+        if self_node in nodes:
+            return None
+        return proxy_request(nodes)
+
+    # Only the versions are compared, the content is sent by one replica with the newest
+    headers = {name: value for name, value in forwarded_headers().items() if name in ("Authorization", "Tss-Replica")}
+    executor = get_executor("cluster", CLUSTER_THREADS)
+    futures = {executor.submit(node_request_quietly, node, "HEAD", forwarded_path(), headers): node for node in nodes}
+    versions = []
+    answers = 0
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=app.config["CLUSTER_TIMEOUT"]):
+            response = future.result()
+            if response is None or response.status >= 500:
+                continue
+            answers += 1
+            if response.status == 200:
+                versions.append((int(response.headers.get("Tss-Version", "0")), False, futures[future]))
+            elif response.status == 404 and "Tss-Version" in response.headers:
+                # A replica that took a delete, which is newer than the object it deleted on the others
+                versions.append((int(response.headers["Tss-Version"]), True, None))
+            if answers == quorum:
+                break
+    except concurrent.futures.TimeoutError:
+        pass
+    if answers < quorum:
+        abort(503)
+    if not versions:
+        abort(404)
+    _, deleted, node = max(versions, key=lambda version: (version[0], version[1], version[2] == self_node))
+    if deleted:
+        abort(404)
+    if node == self_node:
+        return None
+    return proxy_request([node])
+
+
+def proxy_request(nodes):
+    """Sends this request to the first of nodes that can be reached, and streams its response back."""
+    for node in nodes:
+        try:
+            response, release = node_request(node, request.method, forwarded_path(), forwarded_headers(), stream=True)
+        except (OSError, http.client.HTTPException) as e:
+            app.logger.warning("Failed to reach %s: %s", node, e)
+            continue
+
+        def body():
+            try:
+                yield from iter(lambda: response.read(SEND_CHUNK_SIZE), b"")
+            except BaseException:
+                release(reuse=False)
+                raise
+            release()
+
+        headers = [(name, value) for name, value in response.getheaders() if name.lower() not in HOP_BY_HOP_HEADERS]
+        return app.response_class(body(), response.status, headers=headers, direct_passthrough=True)
+    abort(503)
+
+
+def coordinate_bucket_change():
+    """Sends a change of a bucket to all nodes. Succeeds when all of them made it."""
+    headers = forwarded_headers()
+    data = request.get_data()
+    if data:
+        headers["Content-Length"] = str(len(data))
+    method, path = request.method, forwarded_path()
+    executor = get_executor("cluster", CLUSTER_THREADS)
+    responses = list(executor.map(lambda node: node_request_quietly(node, method, path, headers, io.BytesIO(data)),
+                                  app.config["CLUSTER_NODES"]))
+    if any(response is None or response.status >= 500 for response in responses):
+        abort(503)
+    # Repeating a change that only some nodes made fails on the others with 404 or 409
+    return node_response(min(responses, key=lambda response: response.status))
+
+
+def coordinate_listing(bucket_name):
+    """Merges the listings of all nodes into one page."""
+    max_keys = request.args.get("max-keys", str(DEFAULT_LIST_KEYS))
+    if not max_keys.isdigit() or not 1 <= int(max_keys) <= MAX_LIST_KEYS:
+        abort(400)
+    max_keys = int(max_keys)
+    headers, path = forwarded_headers(), forwarded_path()
+    executor = get_executor("cluster", CLUSTER_THREADS)
+    responses = list(executor.map(lambda node: node_request_quietly(node, "GET", path, headers),
+                                  app.config["CLUSTER_NODES"]))
+    if any(response is None or response.status >= 500 for response in responses):
+        abort(503)
+    for response in responses:
+        if response.status != 200:
+            return node_response(response)
+
+    bucket_prefix = key_prefix(bucket_name).encode()
+
+    def position(entry):
+        # Where the listing of a node continues after the entry, which also orders the entries like keys
+        if "Key" in entry:
+            return key_prefix(bucket_name, entry["Key"]).encode() + b"\x00"
+        return bucket_prefix + entry["Prefix"].encode() + b"\xff"
+
+    entries = {}
+    end = None
+    for response in responses:
+        page = json.loads(response.body)
+        for entry in page:
+            entries.setdefault(position(entry), entry)
+        # Beyond the last entry of a node that has more, the entries of the others cannot be complete
+        if "Link" in response.headers and page:
+            end = min(end, position(page[-1])) if end is not None else position(page[-1])
+    positions = sorted(key for key in entries if end is None or key <= end)
+    more = end is not None or len(positions) > max_keys
+    positions = positions[:max_keys]
+    results = [entries[key] for key in positions]
+    if more and positions:
+        args = {name: value for name, value in request.args.items() if name not in ("next", "start-after")}
+        args["next"] = base64.b64encode(positions[-1]).decode()
+        next_link = "%s?%s" % (request.base_url, urlencode(args))
+        return jsonify(results), 200, {"Link": f"<{next_link}>; rel=next"}
+    return jsonify(results)
+
+
+def forwarded_path():
+    path = quote(request.path)
+    if request.query_string:
+        path += "?" + request.query_string.decode("latin-1")
+    return path
+
+
+def forwarded_headers():
+    headers = {name: value for name, value in request.headers.items()
+               if name.lower() not in HOP_BY_HOP_HEADERS
+               and name.lower() not in ("host", "content-length", "expect", "tss-version")}
+    headers["Tss-Replica"] = app.config["CLUSTER_SECRET"]
+    return headers
+
+
+class NodeResponse:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+def node_response(response):
+    headers = [(name, value) for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+    return app.response_class(response.body, response.status, headers=headers)
+
+
+class NodeConnections:
+    """Keep-alive connections to the other nodes, shared by the threads of a worker."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+
+    def get(self, node):
+        """Returns an idle connection to node, or a new one, and whether it was idle."""
+        with self.lock:
+            if self.idle[node]:
+                return self.idle[node].pop(), True
+        url = urlsplit(node)
+        return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=app.config["CLUSTER_TIMEOUT"]), False
+
+    def put(self, node, connection):
+        with self.lock:
+            self.idle[node].append(connection)
+
+
+_node_connections = {}
+
+
+def get_node_connections():
+    connections = _node_connections.get(os.getpid())
+    if connections is None:
+        connections = _node_connections.setdefault(os.getpid(), NodeConnections())
+    return connections
+
+
+def node_request(node, method, path, headers, body=None, stream=False):
+    """Makes a request to a node. Returns a NodeResponse, or with stream the http.client response and
+    a function to call when it has been read."""
+    if node == app.config["CLUSTER_SELF"] and not stream:
+        return local_request(method, path, headers, body)
+    connections = get_node_connections()
+    while True:
+        connection, idle = connections.get(node)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            break
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            # The node closes connections that were idle for too long, a new one is tried before giving up
+            if not idle:
+                raise
+            if body is not None:
+                body.seek(0)
+    metrics = get_metrics()
+    metrics.add("tss_cluster_requests_total", (("node", node), ("status", str(response.status))))
+
+    def release(reuse=True):
+        if reuse and not response.will_close:
+            connections.put(node, connection)
+        else:
+            connection.close()
+
+    if stream:
+        return response, release
+    data = response.read()
+    release()
+    return NodeResponse(response.status, Headers(response.getheaders()), data)
+
+
+def node_request_quietly(node, method, path, headers, body=None):
+    """Like node_request(), but returns None when the node cannot be reached."""
+    try:
+        return node_request(node, method, path, headers, body)
+    except (OSError, http.client.HTTPException) as e:
+        app.logger.warning("Failed to reach %s: %s", node, e)
+        return None
+
+
+def local_request(method, path, headers, body=None):
+    """Handles a request to this node in process."""
+    builder = EnvironBuilder(path=path, method=method, headers=headers, input_stream=body,
+                             content_length=int(headers["Content-Length"]) if "Content-Length" in headers else None)
+    try:
+        app_iter, status, response_headers = run_wsgi_app(app.wsgi_app, builder.get_environ(), buffered=True)
+        return NodeResponse(int(status.split()[0]), Headers(response_headers), b"".join(app_iter))
+    finally:
+        builder.close()
+
+
+#
+# Service
+#
+
+@app.route("/_stats", methods=["GET"])
+def get_stats():
+    with get_lmdb_env().begin() as tx:
+        blobs = tx.stat(get_lmdb_db(b"blobs"))["entries"]
+        references = read_counter(tx, b"dedup-references")
+        logical_bytes = read_counter(tx, b"dedup-logical-bytes")
+        physical_bytes = read_counter(tx, b"dedup-physical-bytes")
+    return jsonify({
+        "Dedup": {
+            "Enabled": app.config["DEDUP"],
+            "Blobs": blobs,
+            "References": references,
+            "LogicalBytes": logical_bytes,
+            "PhysicalBytes": physical_bytes,
+            "Ratio": logical_bytes / physical_bytes if physical_bytes else 1.0,
+        },
+        # Per worker, so consecutive requests may report different workers
+        "Cache": get_object_cache().stats() if get_object_cache() is not None else None,
+        "Volumes": [volume_stats(path, weight) for path, weight in get_volumes()],
+    })
+
+
+def volume_stats(path, weight):
+    stats = {"Path": path, "Weight": weight, "TotalBytes": None, "FreeBytes": None}
+    try:
+        usage = shutil.disk_usage(path)
+    except FileNotFoundError:
+        return stats
+    return dict(stats, TotalBytes=usage.total, FreeBytes=usage.free)
+
+
+@app.route("/_lmdb", methods=["GET"])
+def get_lmdb_stats():
+    env = get_lmdb_env()
+    with env.begin() as tx:
+        info = env.info()
+        databases = {"main": env.stat()}
+        for name in LMDB_DATABASES:
+            databases[name.decode()] = tx.stat(get_lmdb_db(name))
+        path = _get_lmdb().path
+    page_size = databases["main"]["psize"]
+    pages = info["last_pgno"] + 1
+    used_pages = sum(stat["branch_pages"] + stat["leaf_pages"] + stat["overflow_pages"] for stat in databases.values())
+    return jsonify({
+        "Path": path.name,
+        "MapSize": info["map_size"],
+        "PageSize": page_size,
+        "Pages": pages,
+        # Pages that are in no database besides the two meta pages, the free list itself is counted as free
+        "FreePages": pages - 2 - used_pages,
+        "FileSize": (path / "data.mdb").stat().st_size,
+        "LastTransaction": info["last_txnid"],
+        "Readers": info["num_readers"],
+        "MaxReaders": info["max_readers"],
+        "Databases": {name: {"Depth": stat["depth"], "BranchPages": stat["branch_pages"],
+                             "LeafPages": stat["leaf_pages"], "OverflowPages": stat["overflow_pages"],
+                             "Entries": stat["entries"]} for name, stat in databases.items()},
+    })
+
+
+@app.errorhandler(lmdb.MapFullError)
+def map_full(error):
+    # The transaction was rolled back and the map has been grown, so the request can be repeated
+    return ServiceUnavailable(retry_after=1).get_response()
+
+
 #
 # Buckets
 #
 
 @app.route("/<bucket_name:bucket_name>", methods=["GET"])
 def get_bucket(bucket_name):
-    bucket_path = make_bucket_path(app.config["STORAGE_ROOT"], bucket_name, create=False)
-    if not bucket_path.exists():
-        abort(404)
-
-    prefix = key_prefix(bucket_name).encode()
+    list_format = request.args.get("format", "json")
+    if list_format not in ("json", "ndjson") or request.args.get("archive", "tar") != "tar":
+        abort(400)
+    object_prefix = request.args.get("prefix", "")
+    delimiter = request.args.get("delimiter", "")
+    max_keys = request.args.get("max-keys", str(DEFAULT_LIST_KEYS))
+    if not max_keys.isdigit() or not 1 <= int(max_keys) <= MAX_LIST_KEYS:
+        abort(400)
+    max_keys = int(max_keys)
+
+    start = (key_prefix(bucket_name) + object_prefix).encode()
+    if "start-after" in request.args:
+        start = max(start, key_prefix(bucket_name, request.args["start-after"]).encode() + b"\x00")
     if "next" in request.args:
-        prefix = base64.b64decode(request.args.get("next"))
+        try:
+            start = max(start, base64.b64decode(request.args["next"], validate=True))
+        except ValueError:
+            abort(400)
+
+    with get_lmdb_env().begin() as tx:
+        if get_bucket_entry(tx, bucket_name) is None:
+            abort(404)
+        if "archive" in request.args:
+            return app.response_class(stream_with_context(export_archive(bucket_name, start, object_prefix)),
+                                      mimetype=TAR_MIMETYPE)
+        if list_format == "ndjson":
+            return app.response_class(stream_with_context(export_listing(bucket_name, start, object_prefix, delimiter)),
+                                      mimetype=NDJSON_MIMETYPE)
+        listing = iter_listing(tx, bucket_name, start, object_prefix, delimiter)
+        entries = list(itertools.islice(listing, max_keys + 1))
+        listing.close()
+
+    results = [entry for _, entry in entries[:max_keys]]
+    if len(entries) > max_keys:
+        args = {name: value for name, value in request.args.items() if name not in ("next", "start-after")}
+        args["next"] = base64.b64encode(entries[max_keys - 1][0]).decode()
+        next_link = "%s?%s" % (request.base_url, urlencode(args))
+        return jsonify(results), 200, {"Link": f"<{next_link}>; rel=next"}
+
+    return jsonify(results)
 
+
+def iter_listing(tx, bucket_name, start, object_prefix, delimiter):
+    """Yields (position, entry) for the listing of a bucket from key start on, where position is the key
+    that the listing continues at after the entry."""
+    bucket_prefix = key_prefix(bucket_name).encode()
+    prefix = bucket_prefix + object_prefix.encode()
+    entries = iter_metadata(tx, start, prefix)
+    try:
+        while True:
+            key, meta_data = next(entries, (None, None))
+            if key is None:
+                return
+            object_name = key[len(bucket_prefix):-1].decode()
+            if delimiter and delimiter in object_name[len(object_prefix):]:
+                # Roll everything up to and including the delimiter into one entry, and continue after it
+                common_prefix = object_name[:object_name.index(delimiter, len(object_prefix)) + len(delimiter)]
+                position = bucket_prefix + common_prefix.encode() + b"\xff"
+                yield position, {"Prefix": common_prefix}
+                entries.close()
+                entries = iter_metadata(tx, position, prefix)
+                continue
+            yield key + b"\x00", {"Key": object_name, **object_headers(meta_data)}
+    finally:
+        entries.close()
+
+
+def export_listing(bucket_name, start, object_prefix, delimiter):
+    """Yields a whole listing as NDJSON, with the token to continue after each entry in its Next field.
+    Every EXPORT_CHUNK_SIZE entries are read in a transaction of their own, and sent once it has ended, so
+    that a slow client neither holds a transaction open nor makes the listing take more memory."""
+    while True:
+        with get_lmdb_env().begin() as tx:
+            if get_bucket_entry(tx, bucket_name) is None:
+                return
+            lines = []
+            listing = iter_listing(tx, bucket_name, start, object_prefix, delimiter)
+            for start, entry in itertools.islice(listing, EXPORT_CHUNK_SIZE):
+                entry["Next"] = base64.b64encode(start).decode()
+                lines.append(json.dumps(entry) + "\n")
+            listing.close()
+        if lines:
+            yield "".join(lines).encode()
+        if len(lines) < EXPORT_CHUNK_SIZE:
+            return
+
+
+@app.route("/<bucket_name:bucket_name>", methods=["POST"])
+def post_bucket(bucket_name):
+    if "delete" in request.args:
+        return delete_objects(bucket_name)
+    if "stat" in request.args:
+        return stat_objects(bucket_name)
+    if request.args.get("archive") == "tar":
+        return import_archive(bucket_name)
+    abort(400)
+
+
+def read_batch_keys():
+    """Reads the object names of a batch request: a JSON list or NDJSON lines of names or {"Key": name} objects."""
+    try:
+        if request.mimetype == NDJSON_MIMETYPE:
+            items = [json.loads(line) for line in request.get_data().splitlines() if line.strip()]
+        else:
+            items = json.loads(request.get_data())
+    except ValueError:
+        abort(400)
+    if not isinstance(items, list) or len(items) > MAX_BATCH_KEYS:
+        abort(400)
+    keys = [item.get("Key") if isinstance(item, dict) else item for item in items]
+    if not all(isinstance(key, str) and key for key in keys):
+        abort(400)
+    return keys
+
+
+def batch_response(results):
+    if request.mimetype == NDJSON_MIMETYPE:
+        return app.response_class("".join(json.dumps(result) + "\n" for result in results), mimetype=NDJSON_MIMETYPE)
+    return jsonify(results)
+
+
+def stat_objects(bucket_name):
+    keys = read_batch_keys()
     results = []
+    with get_lmdb_env().begin() as tx:
+        if get_bucket_entry(tx, bucket_name) is None:
+            abort(404)
+        for key in keys:
+            meta_data = read_metadata(tx, bucket_name, key)
+            if meta_data is None:
+                results.append({"Key": key, "Status": 404})
+            else:
+                results.append({"Key": key, "Status": 200, **object_headers(meta_data)})
+    return batch_response(results)
+
+
+def delete_objects(bucket_name):
+    keys = read_batch_keys()
+    results = []
+    paths = []
+    with get_lmdb_env().begin(write=True) as tx:
+        if get_bucket_entry(tx, bucket_name) is None:
+            abort(404)
+        for key in keys:
+            meta_data = delete_metadata(tx, bucket_name, key)
+            results.append({"Key": key, "Status": 200 if meta_data is not None else 404})
+            if meta_data is not None:
+                # Renamed under the write lock, so that removing them can never hit the file of a later upload
+                for path in release_object_data(tx, bucket_name, key, meta_data, unlink=False):
+                    path = set_aside(path)
+                    if path is not None:
+                        paths.append(path)
+
+    # The files are removed after the commit, so that the write lock is not held while waiting on the disk
+    executor = get_executor("delete", app.config["DELETE_THREADS"])
+    for path, error in zip(paths, executor.map(unlink_quietly, paths)):
+        if error is not None:
+            app.logger.error("Failed to delete %s: %s", path, error)
+
+    return batch_response(results)
+
+
+def set_aside(path):
+    """Renames a file to a unique temporary name in its directory, to be unlinked later. Returns the new
+    path, or None if there is no file."""
+    temp_path = path.with_name(".tmp-deleted-" + os.urandom(8).hex())
+    try:
+        os.rename(str(path), str(temp_path))
+    except FileNotFoundError:
+        return None
+    return temp_path
+
+
+def unlink_quietly(path):
+    """Unlinks path, ignoring files that are already gone. Returns any other error."""
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        return e
+    return None
+
 
+#
+# Archives
+#
+# GET /<bucket>?archive=tar streams the objects of a bucket as a tar archive,
+# with the metadata of each in the TSS. fields of its PAX header, and
+# POST /<bucket>?archive=tar stores the files of one as objects. Neither holds
+# more than one object in memory. An import receives each file into a
+# temporary file, syncs it or moves it to the volume of its blob on a pool of
+# TSS_ARCHIVE_THREADS threads while the next ones are received, and stores
+# every TSS_ARCHIVE_BATCH_SIZE files in one write transaction.
+#
+
+def export_archive(bucket_name, start, object_prefix):
+    """Yields a tar archive of the objects of a bucket from key start on. Like an NDJSON export, the metadata
+    is read EXPORT_CHUNK_SIZE objects at a time, and no transaction is open while the archive is sent."""
+    prefix = (key_prefix(bucket_name) + object_prefix).encode()
+    size = 0
+    while True:
+        with get_lmdb_env().begin() as tx:
+            if get_bucket_entry(tx, bucket_name) is None:
+                return
+            entries = iter_metadata(tx, start, prefix)
+            chunk = list(itertools.islice(entries, EXPORT_CHUNK_SIZE))
+            entries.close()
+        for key, meta_data in chunk:
+            object_name = key[len(key_prefix(bucket_name)):-1].decode()
+            for block in iter_archive_member(bucket_name, object_name, meta_data):
+                size += len(block)
+                yield block
+        if len(chunk) < EXPORT_CHUNK_SIZE:
+            break
+        start = chunk[-1][0] + b"\x00"
+    # Two empty blocks end the archive, which is padded to a whole record like tarfile does
+    end = 2 * tarfile.BLOCKSIZE
+    yield bytes(end + -(size + end) % tarfile.RECORDSIZE)
+
+
+def iter_archive_member(bucket_name, object_name, meta_data):
+    """Yields the header and content of an object in a tar archive, or nothing if it was deleted since its
+    metadata was read."""
+    f = open_archive_content(bucket_name, object_name, meta_data)
+    if f is None:
+        return
+    with f:
+        info = tarfile.TarInfo(object_name)
+        info.size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        info.mode = 0o644
+        # Werkzeug parses dates into naive datetimes in UTC, which timestamp() would take for local time. Like
+        # in the metadata records, an mtime of 0 stands for an object without Last-Modified.
+        last_modified = parse_date(meta_data.get("Last-Modified"))
+        info.mtime = calendar.timegm(last_modified.utctimetuple()) if last_modified is not None else 0
+        info.pax_headers = {ARCHIVE_PAX_PREFIX + name: value for name, value in object_headers(meta_data).items()
+                            if name != "Content-Length"}
+        yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        # The size is that of the file that was opened, so it is the same even if the object was replaced since
+        remaining = info.size
+        while remaining > 0:
+            chunk = f.read(min(SEND_CHUNK_SIZE, remaining))
+            remaining -= len(chunk)
+            yield chunk
+        yield bytes(-info.size % tarfile.BLOCKSIZE)
+
+
+def open_archive_content(bucket_name, object_name, meta_data):
+    """Opens the content of an object, decompressed into a temporary file if it is stored compressed.
+    Returns None if the object was deleted since its metadata was read."""
+    if "Tss-Inline" in meta_data:
+        with get_lmdb_env().begin() as tx:
+            data = tx.get(key_prefix(bucket_name, object_name).encode(), db=get_lmdb_db(b"inline"))
+        if data is None:
+            return None
+        f = io.BytesIO(data)
+    else:
+        try:
+            f = find_data(object_data_paths(bucket_name, object_name, meta_data), lambda path: path.open(mode="rb"))
+        except FileNotFoundError:
+            return None
+    if "Tss-Compression" not in meta_data:
+        return f
+    # The decompressed size has to be known for the header, before any of the content is sent
+    decompressed = tempfile.TemporaryFile(dir=app.config["STORAGE_ROOT"], prefix=".tmp-")
+    try:
+        for chunk in iter_decompressed(f, meta_data["Tss-Compression"]):
+            decompressed.write(chunk)
+    except BaseException:
+        decompressed.close()
+        raise
+    return decompressed
+
+
+def import_archive(bucket_name):
     with get_lmdb_env().begin() as tx:
-        cursor = tx.cursor()
-        cursor.set_range(prefix)
-        for key, value in cursor:
-            if not key.startswith(f"{bucket_name}:".encode()):
-                break
-            _, object_name, header_name = split_key(key)
-            header_value = value.decode()
+        bucket_entry = get_bucket_entry(tx, bucket_name)
+    if bucket_entry is None:
+        abort(404)
 
-            if len(results) and results[-1]["Key"] == object_name:
-                results[-1][header_name] = header_value
-            else:
-                if len(results) == 100:
-                    break
-                results.append({"Key": object_name, header_name: header_value})
-        else:
-            key = None
+    executor = get_executor("archive", app.config["ARCHIVE_THREADS"])
+    batch = []
+    count = 0
+    try:
+        with tarfile.open(fileobj=request.stream, mode="r|*", encoding="utf-8") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                object_name = member.name[2:] if member.name.startswith("./") else member.name
+                meta_data = archive_metadata(member)
+                digest, temp_path, data = receive_object(bucket_name, object_name, bucket_entry, meta_data,
+                                                         archive.extractfile(member), member.size, sync=False)
+                future = executor.submit(prepare_archive_file, temp_path, digest, meta_data) \
+                    if temp_path is not None else None
+                batch.append((object_name, meta_data, digest, temp_path, data, future))
+                if len(batch) == app.config["ARCHIVE_BATCH_SIZE"]:
+                    count += commit_archive_batch(bucket_name, batch)
+        count += commit_archive_batch(bucket_name, batch)
+    except tarfile.TarError:
+        abort(400)
+    finally:
+        discard_archive_batch(batch)
+
+    return jsonify({"Objects": count})
+
+
+def archive_metadata(member):
+    """The metadata of an object that is taken from its file in an archive, like request_metadata()."""
+    meta_data = {"Content-Type": DEFAULT_CONTENT_TYPE, "Content-Encoding": DEFAULT_CONTENT_ENCODING}
+    for name, value in member.pax_headers.items():
+        if not name.startswith(ARCHIVE_PAX_PREFIX):
+            continue
+        name = name[len(ARCHIVE_PAX_PREFIX):]
+        if name in ("Content-Type", "Content-Encoding") or name.startswith("X-Tss-"):
+            meta_data[name] = value
+    if meta_data["Content-Type"] == "":
+        meta_data["Content-Type"] = DEFAULT_CONTENT_TYPE
+    # Files without a time, such as the objects without Last-Modified in an export, get the time of the
+    # import like an upload does
+    meta_data["Last-Modified"] = http_date(member.mtime if member.mtime > 0 else time.time())
+    return meta_data
 
-    if key and not not key.startswith(f"{bucket_name}:".encode()):
-        _, object_name, header_name = split_key(key)
-        next_prefix = key_prefix(bucket_name, object_name).encode()
-        next_link = "%s?next=%s" % (request.base_url, base64.b64encode(next_prefix).decode())
-        return jsonify(results), 200, {"Link": f"<{next_link}>; rel=next"}
 
-    return jsonify(results)
+def prepare_archive_file(temp_path, digest, meta_data):
+    """Gets a received file ready to be stored, like put_object() does before its write. Returns its path."""
+    if app.config["DEDUP"]:
+        return move_upload_to_blob_volume(temp_path, digest, meta_data)
+    if app.config["FSYNC"] != "none":
+        sync_file(temp_path)
+    return temp_path
+
+
+def commit_archive_batch(bucket_name, batch):
+    """Stores a batch of received files in one write transaction, and empties it. Returns their number."""
+    paths = [future.result() if future is not None else None for _, _, _, _, _, future in batch]
+    with get_lmdb_env().begin(write=True) as tx:
+        for (object_name, meta_data, digest, _, data, _), temp_path in zip(batch, paths):
+            store_object(tx, bucket_name, object_name, meta_data, digest, temp_path=temp_path, data=data)
+    count = len(batch)
+    batch.clear()
+    return count
+
+
+def discard_archive_batch(batch):
+    """Removes the temporary files of received files that were not stored."""
+    for _, _, _, temp_path, _, future in batch:
+        if future is not None:
+            try:
+                unlink_quietly(future.result())
+            except Exception:
+                pass
+        if temp_path is not None:
+            unlink_quietly(temp_path)
 
 
 @app.route("/<bucket_name:bucket_name>", methods=["PUT"])
 def put_bucket(bucket_name):
-    make_bucket_path(app.config["STORAGE_ROOT"], bucket_name, create=True)
+    settings = read_bucket_settings()
+    with get_lmdb_env().begin() as tx:
+        exists = get_bucket_entry(tx, bucket_name) is not None
+        if not exists and read_deletion(tx, bucket_name) is not None:
+            abort(409)
+    if not exists:
+        make_bucket_path(app.config["STORAGE_ROOT"], bucket_name, create=True)
+    if not exists or settings:
+        with get_lmdb_env().begin(write=True) as tx:
+            entry = get_bucket_entry(tx, bucket_name) or {}
+            put_bucket_entry(tx, bucket_name, {**entry, **settings})
     return jsonify({})
 
 
+def read_bucket_settings():
+    """Reads the settings of a bucket from the body of a PUT request. Only given settings are changed."""
+    if not request.get_data():
+        return {}
+    try:
+        settings = json.loads(request.get_data())
+    except ValueError:
+        abort(400)
+    if not isinstance(settings, dict) or not set(settings) <= {"Compression"}:
+        abort(400)
+    compression = settings.get("Compression")
+    if compression is not None:
+        # {"Algorithm": "gzip" or "deflate", "Level": 0 to 9, "ContentTypes": ["text/*", ...]}, or null to disable
+        if not isinstance(compression, dict) or compression.get("Algorithm") not in COMPRESSION_WBITS:
+            abort(400)
+        level = compression.get("Level", 6)
+        content_types = compression.get("ContentTypes", DEFAULT_COMPRESSED_TYPES)
+        if type(level) is not int or not 0 <= level <= 9:
+            abort(400)
+        if not isinstance(content_types, list) or not all(isinstance(t, str) for t in content_types):
+            abort(400)
+        settings["Compression"] = {"Algorithm": compression["Algorithm"], "Level": level,
+                                   "ContentTypes": [t.lower() for t in content_types]}
+    return settings
+
+
 @app.route("/<bucket_name:bucket_name>", methods=["DELETE"])
 def delete_bucket(bucket_name):
-    bucket_path = make_bucket_path(app.config["STORAGE_ROOT"], bucket_name, create=False)
-    if not bucket_path.exists():
+    with get_lmdb_env().begin(write=True) as tx:
+        if get_bucket_entry(tx, bucket_name) is None:
+            abort(404)
+        delete_bucket_entry(tx, bucket_name)
+        # Its uploads are aborted, their parts are in the directory of the bucket
+        upload_ids = [key.decode() for key, value in tx.cursor(db=get_lmdb_db(b"uploads"))
+                      if b":" not in key and json.loads(value)["Bucket"] == bucket_name]
+        for upload_id in upload_ids:
+            delete_upload_records(tx, upload_id)
+        # The files are moved out of the way right away, their metadata is removed by the reaper
+        deleted_path = pathlib.Path("deleted", "%s.%d" % (bucket_name, time.time() * 1000))
+        deletion = {"Bucket": bucket_name, "Started": int(time.time()), "Path": str(deleted_path),
+                    "ObjectsRemoved": 0, "Status": "metadata"}
+        tx.put(bucket_name.encode(), json.dumps(deletion).encode(), db=get_lmdb_db(b"deletions"))
+        for volume, _ in get_volumes():
+            try:
+                pathlib.Path(volume, "deleted").mkdir(exist_ok=True)
+                os.rename(str(make_bucket_path(volume, bucket_name)), str(pathlib.Path(volume, deleted_path)))
+            except FileNotFoundError:
+                pass
+    start_reaper()
+    return jsonify(deletion_status(deletion)), 202, {"Location": url_for("get_deletion", bucket_name=bucket_name)}
+
+
+#
+# Bucket deletion
+#
+# A deleted bucket is removed from the registry and recorded in the deletions
+# database, and its directory is renamed into deleted/. A reaper thread in the
+# worker then deletes the metadata of its objects in transactions of at most
+# TSS_DELETE_BATCH_SIZE objects, so that the write lock is never held for
+# long, and finally removes the directory. Reapers in several workers can run
+# at the same time, as every batch continues where the last one stopped. The
+# bucket cannot be created again until it has been reaped.
+#
+
+_reapers_lock = threading.Lock()
+_reapers = set()
+
+
+def start_reaper():
+    """Starts a thread in this worker that reaps deleted buckets, unless one is running already. With
+    TSS_REAPER=0 deleted buckets are only reaped by the reap-buckets command."""
+    if not app.config["REAPER"]:
+        return
+    key = (os.getpid(), app.config["STORAGE_ROOT"])
+    with _reapers_lock:
+        if key in _reapers:
+            return
+        _reapers.add(key)
+    threading.Thread(target=run_reaper, args=(key,), name="tss-reaper", daemon=True).start()
+
+
+def run_reaper(key):
+    try:
+        # Stops when the storage root changes, which only happens in tests
+        while app.config["STORAGE_ROOT"] == key[1]:
+            try:
+                if not reap_deleted_buckets(app.config["DELETE_BATCH_SIZE"]):
+                    break
+            except lmdb.MapFullError:
+                pass  # Again, in the grown map
+    except Exception:
+        app.logger.exception("Failed to reap deleted buckets")
+    finally:
+        with _reapers_lock:
+            _reapers.discard(key)
+
+
+def read_deletion(tx, bucket_name):
+    value = tx.get(bucket_name.encode(), db=get_lmdb_db(b"deletions"))
+    return json.loads(value) if value is not None else None
+
+
+def deletion_status(deletion):
+    return {name: deletion[name] for name in ("Bucket", "Started", "ObjectsRemoved", "Status")}
+
+
+def reap_deleted_buckets(batch_size=1000):
+    """Reaps one batch of every deleted bucket. Returns the number of buckets that are not done yet."""
+    with get_lmdb_env().begin() as tx:
+        bucket_names = [key.decode() for key in tx.cursor(db=get_lmdb_db(b"deletions")).iternext(values=False)]
+    return sum(1 for bucket_name in bucket_names if not reap_bucket(bucket_name, batch_size))
+
+
+def reap_bucket(bucket_name, batch_size):
+    """Deletes the metadata of the next batch_size objects of a deleted bucket, or its files once that is done.
+    Returns True when the bucket has been reaped."""
+    prefix = key_prefix(bucket_name).encode()
+    with get_lmdb_env().begin(write=True) as tx:
+        deletion = read_deletion(tx, bucket_name)
+        if deletion is None:
+            return True
+        entries = iter_metadata(tx, prefix, prefix)
+        object_names = [key[len(prefix):-1].decode() for key, _ in itertools.islice(entries, batch_size)]
+        entries.close()
+        for object_name in object_names:
+            meta_data = delete_metadata(tx, bucket_name, object_name)
+            # Files are removed with the directory
+            release_object_data(tx, bucket_name, object_name, meta_data, unlink=False)
+        deletion["ObjectsRemoved"] += len(object_names)
+        if not object_names:
+            deletion["Status"] = "files"
+        tx.put(bucket_name.encode(), json.dumps(deletion).encode(), db=get_lmdb_db(b"deletions"))
+    if object_names:
+        return False
+
+    for volume, _ in get_volumes():
+        shutil.rmtree(str(pathlib.Path(volume, deletion["Path"])), ignore_errors=True)
+    with get_lmdb_env().begin(write=True) as tx:
+        tx.delete(bucket_name.encode(), db=get_lmdb_db(b"deletions"))
+    return True
+
+
+@app.route("/_deletions", methods=["GET"])
+def get_deletions():
+    with get_lmdb_env().begin() as tx:
+        deletions = [json.loads(value) for value in tx.cursor(db=get_lmdb_db(b"deletions")).iternext(keys=False)]
+    return jsonify([deletion_status(deletion) for deletion in deletions])
+
+
+@app.route("/_deletions/<bucket_name:bucket_name>", methods=["GET"])
+def get_deletion(bucket_name):
+    """The progress of deleting a bucket, 404 once it is done."""
+    with get_lmdb_env().begin() as tx:
+        deletion = read_deletion(tx, bucket_name)
+    if deletion is None:
         abort(404)
-    shutil.rmtree(str(bucket_path))
-    return jsonify({})
+    return jsonify(deletion_status(deletion))
+
+
+#
+# Scrubbing
+#
+# The scrubber looks for inconsistencies between the metadata and the files,
+# in passes of three phases: the metadata of every object, the object files
+# under buckets/ and the blobs. Each phase goes in chunks of SCRUB_CHUNK_SIZE,
+# at most TSS_SCRUB_RATE checks a second, and after every chunk its position
+# is saved, so that a pass continues where it was after a restart.
+#
+# Files are named after a hash of their object name, so they cannot be looked
+# up in the metadata. While checking the metadata, the scrubber keeps an index
+# of the files it should find, which the file phase is checked against. Files
+# written after the pass started are not in it, so files modified less than
+# SCRUB_GRACE before the pass started are left alone. The position, the index
+# and the problems found are kept in an LMDB environment of their own in
+# scrub/, so that scrubbing never grows the metadata or waits for its lock.
+#
+# Problems are confirmed under the metadata write lock before they are
+# reported, because PUT and DELETE change files while holding it. With
+# TSS_SCRUB_REPAIR=1 metadata without content or bucket is deleted, and
+# orphaned files are moved to lost+found/ on their volume. Sizes that do not
+# match are only reported.
+#
+
+SCRUB_CHUNK_SIZE = 1000
+SCRUB_GRACE = 60 * 60
+SCRUB_DATABASES = (b"state", b"index", b"problems")
+SCRUB_PHASES = ("metadata", "files", "blobs")
+MAX_SCRUB_PROBLEMS = 1000  # Problems kept per pass, they are all counted
+
+
+class RateLimiter:
+    """Spaces out operations to at most rate a second, or not at all with rate 0."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next = time.monotonic()
+
+    def wait(self, count=1):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next > now:
+            time.sleep(self.next - now)
+        self.next = max(self.next, now) + count * self.interval
+
+
+_scrub_envs_lock = threading.Lock()
+_scrub_envs = {}
+
+
+def get_scrub_env():
+    """Returns the environment of the scrubber and its databases, opened once per process like the metadata."""
+    key = (os.getpid(), app.config["STORAGE_ROOT"])
+    scrub_env = _scrub_envs.get(key)
+    if scrub_env is None:
+        with _scrub_envs_lock:
+            scrub_env = _scrub_envs.get(key)
+            if scrub_env is None:
+                env = lmdb.open(str(pathlib.Path(app.config["STORAGE_ROOT"], "scrub")), map_size=64 * 1024 ** 3,
+                                max_dbs=len(SCRUB_DATABASES))
+                scrub_env = _scrub_envs[key] = (env, {name: env.open_db(name) for name in SCRUB_DATABASES})
+    return scrub_env
+
+
+def read_scrub_state():
+    """Returns the current pass and the last finished pass, either of which can be None."""
+    env, dbs = get_scrub_env()
+    with env.begin() as tx:
+        state = tx.get(b"state", db=dbs[b"state"])
+        last_pass = tx.get(b"last-pass", db=dbs[b"state"])
+    return (json.loads(state) if state is not None else None), (json.loads(last_pass) if last_pass is not None else None)
+
+
+def lock_scrubber():
+    """Returns the locked lock file of the scrubber, or None when another process is scrubbing."""
+    path = pathlib.Path(app.config["STORAGE_ROOT"], "scrub", "scrubber.lock")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    f = open(str(path), "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def scrub_step(repair=False, limiter=None):
+    """Checks the next chunk of the current pass, starting a new pass when there is none. Returns True while
+    the pass is not finished. Only call this while holding lock_scrubber()."""
+    limiter = limiter or RateLimiter(0)
+    env, dbs = get_scrub_env()
+    state, last_pass = read_scrub_state()
+    new_pass = state is None or state["Phase"] == "done"
+    if new_pass:
+        state = {"Pass": (state or {}).get("Pass", 0) + 1, "Started": int(time.time()), "Finished": None,
+                 "Phase": SCRUB_PHASES[0], "Position": None, "Checked": 0, "Problems": {}, "Repaired": 0}
+    scrub_phase = {"metadata": scrub_metadata, "files": scrub_files, "blobs": scrub_blobs}[state["Phase"]]
+    position, checked, index, problems = scrub_phase(state, limiter)
+    confirmed = []
+    for problem in problems:
+        problem = confirm_problem(problem, state, repair)
+        if problem is not None:
+            app.logger.warning("Scrubber found %s: %s", problem["Kind"], problem["Detail"])
+            confirmed.append(problem)
+
+    state["Checked"] += checked
+    state["Position"] = position
+    for problem in confirmed:
+        state["Problems"][problem["Kind"]] = state["Problems"].get(problem["Kind"], 0) + 1
+        state["Repaired"] += 1 if problem["Repaired"] else 0
+    if position is None:
+        next_phase = SCRUB_PHASES.index(state["Phase"]) + 1
+        state["Phase"] = SCRUB_PHASES[next_phase] if next_phase < len(SCRUB_PHASES) else "done"
+    with env.begin(write=True) as tx:
+        if new_pass:
+            tx.drop(dbs[b"index"], delete=False)
+            tx.drop(dbs[b"problems"], delete=False)
+        for key in index:
+            tx.put(key, b"", db=dbs[b"index"])
+        stored = tx.stat(dbs[b"problems"])["entries"]
+        for problem in confirmed[:max(MAX_SCRUB_PROBLEMS - stored, 0)]:
+            key = ("%s:%s" % (problem["Kind"], problem["Detail"])).encode()
+            tx.put(key, json.dumps(problem).encode(), db=dbs[b"problems"])
+        if state["Phase"] == "done":
+            state["Finished"] = int(time.time())
+            tx.drop(dbs[b"index"], delete=False)
+            tx.put(b"last-pass", json.dumps(state).encode(), db=dbs[b"state"])
+        tx.put(b"state", json.dumps(state).encode(), db=dbs[b"state"])
+    return state["Phase"] != "done"
+
+
+def split_object_key(key):
+    """Returns the bucket and object name of a key of the objects database."""
+    bucket_name, _, object_name = key[:-1].decode().partition(":")
+    return bucket_name, object_name
+
+
+def scrub_metadata(state, limiter):
+    """Checks that the content of the next chunk of objects exists and has the right size, and indexes their files.
+    Returns the new position, which is None at the end, the number of objects checked, the index keys and the
+    problems that were found."""
+    start = state["Position"].encode() + b"\x00" if state["Position"] is not None else b""
+    keys = []
+    objects = []
+    with get_lmdb_env().begin() as tx:
+        entries = iter_metadata(tx, start, b"")
+        for key, meta_data in itertools.islice(entries, SCRUB_CHUNK_SIZE):
+            keys.append(key)
+            bucket_name, object_name = split_object_key(key)
+            # Buckets that are being deleted are left to the reaper
+            if get_bucket_entry(tx, bucket_name) is None and read_deletion(tx, bucket_name) is not None:
+                continue
+            objects.append((bucket_name, object_name))
+        entries.close()
+    index = []
+    problems = []
+    for bucket_name, object_name in objects:
+        limiter.wait()
+        with get_lmdb_env().begin() as tx:
+            meta_data = read_metadata(tx, bucket_name, object_name)
+            problem = find_object_problem(tx, bucket_name, object_name)
+        if problem is not None:
+            problems.append(problem)
+        elif meta_data is not None and "Tss-Blob" not in meta_data and "Tss-Inline" not in meta_data:
+            index.append(("%s/%s" % (bucket_name, hash_object_name(object_name))).encode())
+    position = keys[-1].decode() if len(keys) == SCRUB_CHUNK_SIZE else None
+    return position, len(objects), index, problems
+
+
+def find_object_problem(tx, bucket_name, object_name):
+    """Returns the problem with the content of an object, or None if there is none."""
+    meta_data = read_metadata(tx, bucket_name, object_name)
+    if meta_data is None:
+        return None
+    problem = {"Kind": None, "Bucket": bucket_name, "Object": object_name, "Detail": f"{bucket_name}/{object_name}",
+               "Repaired": False}
+    if get_bucket_entry(tx, bucket_name) is None:
+        return dict(problem, Kind="orphan-metadata")
+    expected = int(meta_data.get("Tss-Stored-Length", meta_data["Content-Length"]))
+    if "Tss-Inline" in meta_data:
+        data = tx.get(key_prefix(bucket_name, object_name).encode(), db=get_lmdb_db(b"inline"))
+        size = len(data) if data is not None else None
+    else:
+        if "Tss-Blob" in meta_data and tx.get(meta_data["Tss-Blob"].encode(), db=get_lmdb_db(b"blobs")) is None:
+            size = None
+        else:
+            try:
+                size = find_data(object_data_paths(bucket_name, object_name, meta_data), os.stat).st_size
+            except FileNotFoundError:
+                size = None
+    if size is None:
+        return dict(problem, Kind="missing-content")
+    if size != expected:
+        return dict(problem, Kind="size-mismatch", Detail=f"{bucket_name}/{object_name} has {size} bytes, "
+                                                          f"{expected} expected")
+    return None
+
+
+def scrub_files(state, limiter):
+    """Checks the next directories of object files against the index. Returns the same as scrub_metadata()."""
+    env, dbs = get_scrub_env()
+    grace = state["Started"] - SCRUB_GRACE
+    checked = 0
+    problems = []
+    for volume, directory, position in iter_hash_directories("buckets", state["Position"], bucket_level=True):
+        bucket_name, first, second = position[1:]
+        with env.begin() as tx:
+            for entry in sorted(os.scandir(str(directory)), key=lambda entry: entry.name):
+                limiter.wait()
+                checked += 1
+                if not entry.is_file():
+                    continue
+                problem = {"Bucket": bucket_name, "Volume": volume, "Detail": entry.path, "Repaired": False,
+                           "Path": str(pathlib.Path(entry.path).relative_to(volume))}
+                if entry.name.startswith(".tmp-"):
+                    if entry.stat().st_mtime < grace:
+                        problems.append(dict(problem, Kind="temporary-file"))
+                    continue
+                key = ("%s/%s%s%s" % (bucket_name, first, second, entry.name)).encode()
+                if tx.get(key, db=dbs[b"index"]) is None and entry.stat().st_mtime < grace:
+                    problems.append(dict(problem, Kind="orphan-file"))
+        if checked >= SCRUB_CHUNK_SIZE:
+            return position, checked, [], problems
+    return None, checked, [], problems
+
+
+def scrub_blobs(state, limiter):
+    """Checks the next directories of blobs against the blobs database. Returns the same as scrub_metadata()."""
+    grace = state["Started"] - SCRUB_GRACE
+    checked = 0
+    problems = []
+    if state["Position"] is None:
+        # Blobs are received in the top directory
+        for volume, _ in get_volumes():
+            try:
+                entries = list(os.scandir(str(pathlib.Path(volume, "blobs"))))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_file() and entry.name.startswith(".tmp-") and entry.stat().st_mtime < grace:
+                    problems.append({"Kind": "temporary-file", "Volume": volume, "Detail": entry.path,
+                                     "Path": str(pathlib.Path(entry.path).relative_to(volume)), "Repaired": False})
+    for volume, directory, position in iter_hash_directories("blobs", state["Position"], bucket_level=False):
+        first, second = position[1:]
+        with get_lmdb_env().begin() as tx:
+            for entry in sorted(os.scandir(str(directory)), key=lambda entry: entry.name):
+                limiter.wait()
+                checked += 1
+                digest = first + second + entry.name
+                if entry.is_file() and tx.get(digest.encode(), db=get_lmdb_db(b"blobs")) is None:
+                    problems.append({"Kind": "orphan-blob", "Digest": digest, "Volume": volume, "Detail": entry.path,
+                                     "Path": str(pathlib.Path(entry.path).relative_to(volume)), "Repaired": False})
+        if checked >= SCRUB_CHUNK_SIZE:
+            return position, checked, [], problems
+    return None, checked, [], problems
+
+
+def iter_hash_directories(name, position, bucket_level):
+    """Yields (volume, directory, position) for the xx/yy directories under name, or under each bucket
+    directory in name, on all volumes in order, after position. A position is the list of the volume and
+    the names of a directory."""
+    def subdirectories(path, hashed):
+        try:
+            names = sorted(entry.name for entry in os.scandir(str(path)) if entry.is_dir())
+        except FileNotFoundError:
+            return []
+        # Uploads are left to cleanup-uploads
+        return [name for name in names if not hashed or (len(name) == 2 and not name.startswith("."))]
+
+    for volume in sorted(path for path, _ in get_volumes()):
+        root = pathlib.Path(volume, name)
+        levels = [(root, [volume])]
+        if bucket_level:
+            levels = [(root / bucket_name, [volume, bucket_name])
+                      for bucket_name in subdirectories(root, hashed=False) if not bucket_name.startswith(".")]
+        for path, parts in levels:
+            if position is not None and parts < position[:len(parts)]:
+                continue
+            for first in subdirectories(path, hashed=True):
+                if position is not None and parts + [first] < position[:len(parts) + 1]:
+                    continue
+                for second in subdirectories(path / first, hashed=True):
+                    if position is not None and parts + [first, second] <= position:
+                        continue
+                    yield volume, path / first / second, parts + [first, second]
+
+
+def confirm_problem(problem, state, repair):
+    """Checks a problem again under the metadata write lock, which keeps PUT and DELETE from changing files,
+    and repairs it when asked to. Returns the problem, or None if it was gone."""
+    with get_lmdb_env().begin(write=True) as tx:
+        if problem["Kind"] in ("orphan-metadata", "missing-content", "size-mismatch"):
+            problem = find_object_problem(tx, problem["Bucket"], problem["Object"])
+            if problem is None:
+                return None
+            if repair and problem["Kind"] != "size-mismatch":
+                meta_data = delete_metadata(tx, problem["Bucket"], problem["Object"])
+                release_object_data(tx, problem["Bucket"], problem["Object"], meta_data)
+                problem["Repaired"] = True
+            return problem
+        path = pathlib.Path(problem["Volume"], problem["Path"])
+        try:
+            modified = path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        if problem["Kind"] == "orphan-blob":
+            if tx.get(problem["Digest"].encode(), db=get_lmdb_db(b"blobs")) is not None:
+                return None
+        elif modified >= state["Started"] - SCRUB_GRACE:
+            return None  # Written again since
+        if repair:
+            if problem["Kind"] == "temporary-file":
+                unlink_quietly(path)
+            else:
+                lost_path = pathlib.Path(problem["Volume"], "lost+found", problem["Path"])
+                lost_path.parent.mkdir(parents=True, exist_ok=True)
+                os.rename(str(path), str(lost_path))
+            problem["Repaired"] = True
+        return problem
+
+
+_scrubbers_lock = threading.Lock()
+_scrubbers = set()
+
+
+def start_scrubber():
+    """Starts a thread in this worker that scrubs whenever a pass is due, if TSS_SCRUB is enabled. Only one
+    process scrubs at a time, the others find the lock taken."""
+    if not app.config["SCRUB"]:
+        return
+    key = (os.getpid(), app.config["STORAGE_ROOT"])
+    with _scrubbers_lock:
+        if key in _scrubbers:
+            return
+        _scrubbers.add(key)
+    threading.Thread(target=run_scrubber, args=(key,), name="tss-scrubber", daemon=True).start()
+
+
+def run_scrubber(key):
+    limiter = RateLimiter(app.config["SCRUB_RATE"])
+    # Stops when the storage root changes, which only happens in tests
+    while app.config["STORAGE_ROOT"] == key[1]:
+        lock = lock_scrubber()
+        if lock is not None:
+            try:
+                state, _ = read_scrub_state()
+                due = state is None or state["Phase"] != "done" or \
+                    time.time() >= state["Started"] + app.config["SCRUB_INTERVAL"]
+                while due and app.config["STORAGE_ROOT"] == key[1]:
+                    due = scrub_step(app.config["SCRUB_REPAIR"], limiter)
+            except Exception:
+                app.logger.exception("Failed to scrub")
+            finally:
+                lock.close()
+        time.sleep(60)
+
+
+@app.route("/_scrub", methods=["GET"])
+def get_scrub():
+    env, dbs = get_scrub_env()
+    state, last_pass = read_scrub_state()
+    with env.begin() as tx:
+        problems = [json.loads(value) for value in tx.cursor(db=dbs[b"problems"]).iternext(keys=False)]
+    return jsonify({"Current": state if state is not None and state["Phase"] != "done" else None,
+                    "LastPass": last_pass, "Problems": problems})
+
+
+#
+# Rebalancing
+#
+# When a volume is added or its weight is changed, some files and blobs are
+# placed on another volume than the one they are on. The rebalancer moves
+# them while the server keeps running. It copies a file to its new volume
+# first, and renames the copy into place under the metadata write lock,
+# where no upload or delete of it can be in progress, before it removes the
+# old file. If a file is in place already, the old one was replaced since.
+#
+
+def rebalance(limiter=None):
+    """Moves the files and blobs that are not on the volume they are placed on. Returns the number of files
+    that were moved and their total size."""
+    limiter = limiter or RateLimiter(0)
+    moved = moved_bytes = 0
+    for name, bucket_level in (("buckets", True), ("blobs", False)):
+        for volume, directory, position in iter_hash_directories(name, None, bucket_level):
+            for entry in list(os.scandir(str(directory))):
+                if not entry.is_file() or entry.name.startswith(".tmp-"):
+                    continue
+                placed = place_data(position[-2] + position[-1] + entry.name)
+                if placed == volume:
+                    continue
+                limiter.wait()
+                size = move_data(pathlib.Path(entry.path), pathlib.Path(placed, name, *position[1:], entry.name))
+                if size is not None:
+                    moved += 1
+                    moved_bytes += size
+    return moved, moved_bytes
+
+
+def move_data(path, target_path):
+    """Moves a file to another volume. Returns its size, or None if it did not have to be moved."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    fd, temp_path = create_temp_file(target_path.parent)
+    temp_path = pathlib.Path(temp_path)
+    try:
+        with os.fdopen(fd, "wb") as f, path.open(mode="rb") as source:
+            shutil.copyfileobj(source, f)
+            if app.config["FSYNC"] != "none":
+                f.flush()
+                os.fsync(f.fileno())
+        with get_lmdb_env().begin(write=True):
+            try:
+                current = path.stat()
+            except FileNotFoundError:
+                return None  # Deleted since
+            if (current.st_ino, current.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns):
+                return None  # Replaced since, the next run moves it
+            moved = not target_path.exists()
+            if moved:
+                commit_file(temp_path, target_path)
+            unlink_quietly(path)
+        return stat.st_size if moved else None
+    finally:
+        unlink_quietly(temp_path)
 
 
 #
@@ -157,55 +3320,158 @@ def delete_bucket(bucket_name):
 
 @app.route("/<bucket_name:bucket_name>/<path:object_name>", methods=["GET", "HEAD"])
 def get_object(bucket_name, object_name):
+    if "uploadId" in request.args:
+        return get_upload(bucket_name, object_name)
 
-    bucket_path = make_bucket_path(app.config["STORAGE_ROOT"], bucket_name, create=False)
-    if not bucket_path.exists():
-        abort(404)
-
-    object_path = make_object_path(app.config["STORAGE_ROOT"], bucket_name, object_name, create=False)
-    if not object_path.exists():
+    cache = get_object_cache()
+    cached = None
+    data = None
+    with get_lmdb_env().begin() as tx:
+        if get_bucket_entry(tx, bucket_name) is None:
+            abort(404)
+        if cache is not None:
+            generation = read_counter(tx, generation_key(bucket_name, object_name))
+            cached = cache.get((bucket_name, object_name), generation)
+        if cached is not None:
+            meta_data, data = cached
+        else:
+            meta_data = read_metadata(tx, bucket_name, object_name)
+            if meta_data is not None and "Tss-Inline" in meta_data and request.method == "GET":
+                data = tx.get(key_prefix(bucket_name, object_name).encode(), db=get_lmdb_db(b"inline"))
+        tombstone = read_tombstone(tx, bucket_name, object_name) if meta_data is None else None
+    if meta_data is None:
+        if is_replica_request() and tombstone is not None:
+            # The coordinator of a read compares the version of the delete with those of the other replicas
+            abort(Response(status=404, headers={"Tss-Version": str(tombstone)}))
         abort(404)
+    headers = object_headers(meta_data)
+    if "Tss-Version" in meta_data and is_replica_request():
+        headers["Tss-Version"] = meta_data["Tss-Version"]
+    decompress = negotiate_encoding(meta_data, headers)
 
-    headers = {
-        "Content-Type": DEFAULT_CONTENT_TYPE,
-        "Content-Encoding": DEFAULT_CONTENT_ENCODING,
-    }
-
-    with get_lmdb_env().begin() as tx:
-        cursor = tx.cursor()
-        prefix = key_prefix(bucket_name, object_name).encode()
-        cursor.set_range(prefix)
-        for key, value in cursor:
-            if not key.startswith(prefix):
-                break
-            _, _, header_name = split_key(key)
-            header_value = value.decode()
-            headers[header_name] = header_value
+    response = evaluate_preconditions(headers)
+    if response is not None:
+        return response
 
-    if request.method == "GET":
-        return my_send_file(object_path, headers)
-    else:
+    if request.method == "HEAD":
+        if decompress is None:
+            headers["Accept-Ranges"] = "bytes"
         response = Response()
         response.headers = headers
         return response
 
+    if data is None and "Tss-Inline" not in meta_data:
+        try:
+            f = find_data(object_data_paths(bucket_name, object_name, meta_data), lambda path: path.open(mode="rb"))
+        except FileNotFoundError:
+            abort(404)
+        if cache is None or int(meta_data["Content-Length"]) > app.config["CACHE_MAX_OBJECT_SIZE"]:
+            return send_object_body(f, headers, decompress)
+        with f:
+            data = f.read()
+    if data is None:
+        abort(404)
+    if cache is not None and cached is None and len(data) <= app.config["CACHE_MAX_OBJECT_SIZE"]:
+        cache.put((bucket_name, object_name), generation, meta_data, data)
+    return send_object_body(io.BytesIO(data), headers, decompress, length=len(data))
+
 
 @app.route("/<bucket_name:bucket_name>/<path:object_name>", methods=["PUT"])
 def put_object(bucket_name, object_name):
+    if "uploadId" in request.args:
+        return put_upload_part(bucket_name, object_name)
 
-    bucket_path = make_bucket_path(app.config["STORAGE_ROOT"], bucket_name, create=False)
-    if not bucket_path.exists():
+    version = replica_version()
+    with get_lmdb_env().begin() as tx:
+        bucket_entry = get_bucket_entry(tx, bucket_name)
+    if bucket_entry is None:
         abort(404)
 
-    object_path = make_object_path(app.config["STORAGE_ROOT"], bucket_name, object_name, create=True)
-    with object_path.open(mode="wb") as f:
-        f.write(request.get_data())
+    meta_data = request_metadata()
+    # With deduplication the upload is only synced once it turns out to be new content
+    digest, temp_path, data = receive_object(bucket_name, object_name, bucket_entry, meta_data, request.stream,
+                                             request.content_length, sync=not app.config["DEDUP"])
+    if temp_path is not None and app.config["DEDUP"]:
+        temp_path = move_upload_to_blob_volume(temp_path, digest, meta_data)
 
+    meta_data["Last-Modified"] = http_date(time.time())
+    if version is not None:
+        # All replicas of a write have the time of its coordinator
+        meta_data["Tss-Version"] = str(version)
+        meta_data["Last-Modified"] = http_date(version / 1e9)
+
+    commit_write(store_object, bucket_name, object_name, meta_data, digest, temp_path=temp_path, data=data)
+
+    return jsonify({})
+
+
+def receive_object(bucket_name, object_name, bucket_entry, meta_data, stream, length, sync=True):
+    """Receives the content of an object from stream, of length bytes where that is known, and adds its
+    size, ETag and compression to meta_data. Returns the SHA-256 hex digest of the content, and either the
+    path of a temporary file or, when it is to be stored inline, the content."""
+    compression = object_compression(bucket_entry, meta_data)
+    data = None
+    temp_path = None
+    if app.config["INLINE_THRESHOLD"] > 0 and length is not None and length <= app.config["INLINE_THRESHOLD"]:
+        data = stream.read()
+        size, digest = len(data), hashlib.sha256(data).hexdigest()
+        if compression is not None:
+            compressor = make_compressor(compression)
+            data = compressor.compress(data) + compressor.flush()
+            meta_data["Tss-Stored-Length"] = str(len(data))
+    else:
+        directory = upload_directory(bucket_name, object_name)
+        temp_path, size, digest = receive_file(directory, stream, sync=sync, compression=compression)
+        if compression is not None:
+            meta_data["Tss-Stored-Length"] = str(temp_path.stat().st_size)
+    if compression is not None:
+        meta_data["Tss-Compression"] = compression["Algorithm"]
+    meta_data["Content-Length"] = str(size)
+    meta_data["ETag"] = quote_etag(digest)
+    return digest, temp_path, data
+
+
+def object_compression(bucket_entry, meta_data):
+    """The compression settings to store an object with, or None if it is stored as it is sent."""
+    compression = bucket_entry.get("Compression")
+    if compression is None or meta_data["Content-Encoding"] != DEFAULT_CONTENT_ENCODING:
+        return None
+    mimetype = meta_data["Content-Type"].split(";")[0].strip().lower()
+    for pattern in compression["ContentTypes"]:
+        if pattern == mimetype or (pattern.endswith("/*") and mimetype.startswith(pattern[:-1])):
+            return compression
+    return None
+
+
+def negotiate_encoding(meta_data, headers):
+    """Chooses between sending a compressed object as stored or decompressed, from the Accept-Encoding
+    of the request, and adjusts headers to match. Returns the algorithm to decompress with, or None."""
+    algorithm = meta_data.get("Tss-Compression")
+    if algorithm is None:
+        return None
+    headers["Vary"] = "Accept-Encoding"
+    if request.accept_encodings[algorithm] > 0:
+        headers["Content-Encoding"] = algorithm
+        headers["Content-Length"] = meta_data["Tss-Stored-Length"]
+        # Each representation needs its own ETag, the plain one is for the decompressed content
+        headers["ETag"] = quote_etag("%s-%s" % (unquote_etag(meta_data["ETag"])[0], algorithm))
+        return None
+    return algorithm
+
+
+def send_object_body(f, headers, decompress=None, length=None):
+    if decompress is None:
+        return send_object_file(f, headers, length=length)
+    # The decompressed length is known from the metadata, but ranges of it cannot be served without decompressing
+    return app.response_class(iter_decompressed(f, decompress), 200, headers=headers,
+                              mimetype=headers.get("Content-Type", DEFAULT_CONTENT_TYPE), direct_passthrough=True)
+
+
+def request_metadata():
+    """The metadata of an object that is taken from the request headers."""
     meta_data = {
         "Content-Type": request.headers.get("Content-Type", DEFAULT_CONTENT_TYPE),
         "Content-Encoding": request.headers.get("Content-Encoding", DEFAULT_CONTENT_ENCODING),
-        "Content-Length": str(object_path.stat().st_size),
-        "Last-Modified": str(maya.now()),
     }
 
     if meta_data["Content-Type"] == "":
@@ -215,34 +3481,186 @@ def put_object(bucket_name, object_name):
         if name.startswith("X-Tss-"):
             meta_data[name] = value
 
-    with get_lmdb_env().begin(write=True) as tx:
-        cursor = tx.cursor()
-        prefix = key_prefix(bucket_name, object_name).encode()
-        cursor.set_range(prefix)
-        while cursor.key().startswith(prefix):
-            cursor.delete()
-        for k, v in meta_data.items():
-            tx.put(f"{bucket_name}:{object_name}:{k}".encode(), v.encode())
-
-    return jsonify({})
+    return meta_data
 
 
 @app.route("/<bucket_name:bucket_name>/<path:object_name>", methods=["DELETE"])
 def delete_object(bucket_name, object_name):
-    bucket_path = make_bucket_path(app.config["STORAGE_ROOT"], bucket_name, create=False)
-    if not bucket_path.exists():
+    if "uploadId" in request.args:
+        return delete_upload(bucket_name, object_name)
+
+    if not commit_write(remove_object, bucket_name, object_name, version=replica_version()):
         abort(404)
 
-    object_path = make_object_path(app.config["STORAGE_ROOT"], bucket_name, object_name, create=False)
-    if not object_path.exists():
+    return jsonify({})
+
+
+#
+# Multipart uploads
+#
+# An upload is initiated with POST ?uploads, after which its parts can be PUT
+# in any order and in parallel with ?uploadId=&partNumber=. Parts are staged
+# in the .uploads directory of the bucket and recorded in the uploads database,
+# under the upload id and upload id:part number. POST ?uploadId= concatenates
+# them into the object.
+#
+
+@app.route("/<bucket_name:bucket_name>/<path:object_name>", methods=["POST"])
+def post_object(bucket_name, object_name):
+    if "uploads" in request.args:
+        return create_upload(bucket_name, object_name)
+    if "uploadId" in request.args:
+        return complete_upload(bucket_name, object_name)
+    abort(400)
+
+
+def make_upload_path(storage_root, bucket_name, upload_id):
+    return pathlib.Path(make_bucket_path(storage_root, bucket_name), ".uploads", upload_id)
+
+
+def upload_part_key(upload_id, part_number):
+    return f"{upload_id}:{part_number:05d}".encode()
+
+
+def read_upload(tx, bucket_name, object_name):
+    """Returns the upload from the uploadId argument and its parts, or aborts with 404."""
+    upload_id = request.args["uploadId"]
+    value = tx.get(upload_id.encode(), db=get_lmdb_db(b"uploads"))
+    if value is None:
         abort(404)
+    upload = json.loads(value)
+    if upload["Bucket"] != bucket_name or upload["Key"] != object_name:
+        abort(404)
+    cursor = tx.cursor(db=get_lmdb_db(b"uploads"))
+    prefix = f"{upload_id}:".encode()
+    parts = {int(key[len(prefix):]): json.loads(value) for key, value in iter_prefix(cursor, prefix, prefix)}
+    return upload_id, upload, parts
+
+
+def delete_upload_records(tx, upload_id):
+    uploads = get_lmdb_db(b"uploads")
+    prefix = f"{upload_id}:".encode()
+    keys = [key for key, _ in iter_prefix(tx.cursor(db=uploads), prefix, prefix)]
+    for key in keys:
+        tx.delete(key, db=uploads)
+    return tx.delete(upload_id.encode(), db=uploads)
 
+
+def create_upload(bucket_name, object_name):
+    with get_lmdb_env().begin() as tx:
+        if get_bucket_entry(tx, bucket_name) is None:
+            abort(404)
+
+    upload_id = os.urandom(16).hex()
+    make_upload_path(app.config["STORAGE_ROOT"], bucket_name, upload_id).mkdir(parents=True)
+    upload = {"Bucket": bucket_name, "Key": object_name, "Initiated": int(time.time()), "Headers": request_metadata()}
     with get_lmdb_env().begin(write=True) as tx:
-        cursor = tx.cursor()
-        prefix = key_prefix(bucket_name, object_name).encode()
-        cursor.set_range(prefix)
-        while cursor.key().startswith(prefix):
-            cursor.delete()
-        object_path.unlink()
+        if get_bucket_entry(tx, bucket_name) is None:
+            # Deleted in the meantime
+            shutil.rmtree(str(make_upload_path(app.config["STORAGE_ROOT"], bucket_name, upload_id)), ignore_errors=True)
+            abort(404)
+        tx.put(upload_id.encode(), json.dumps(upload).encode(), db=get_lmdb_db(b"uploads"))
+
+    return jsonify({"Bucket": bucket_name, "Key": object_name, "UploadId": upload_id})
+
 
+def put_upload_part(bucket_name, object_name):
+    part_number = request.args.get("partNumber", "")
+    if not part_number.isdigit() or not 1 <= int(part_number) <= MAX_UPLOAD_PARTS:
+        abort(400)
+    part_number = int(part_number)
+
+    with get_lmdb_env().begin() as tx:
+        upload_id, _, _ = read_upload(tx, bucket_name, object_name)
+
+    upload_path = make_upload_path(app.config["STORAGE_ROOT"], bucket_name, upload_id)
+    if not upload_path.is_dir():
+        abort(404)
+    temp_path, size, digest = receive_file(upload_path, request.stream)
+    commit_file(temp_path, upload_path / str(part_number))
+
+    part = {"Size": size, "ETag": quote_etag(digest)}
+    with get_lmdb_env().begin(write=True) as tx:
+        if tx.get(upload_id.encode(), db=get_lmdb_db(b"uploads")) is None:
+            abort(404)  # Aborted or completed while the part was being received
+        tx.put(upload_part_key(upload_id, part_number), json.dumps(part).encode(), db=get_lmdb_db(b"uploads"))
+
+    return jsonify({"PartNumber": part_number, **part}), 200, {"ETag": part["ETag"]}
+
+
+def get_upload(bucket_name, object_name):
+    with get_lmdb_env().begin() as tx:
+        upload_id, upload, parts = read_upload(tx, bucket_name, object_name)
+    return jsonify({"UploadId": upload_id, "Initiated": upload["Initiated"],
+                    "Parts": [{"PartNumber": n, **part} for n, part in sorted(parts.items())]})
+
+
+def complete_upload(bucket_name, object_name):
+    with get_lmdb_env().begin() as tx:
+        upload_id, upload, parts = read_upload(tx, bucket_name, object_name)
+
+    # The parts to use can be listed as [{"PartNumber": n, "ETag": etag}], otherwise all uploaded parts are used
+    part_numbers = sorted(parts)
+    if request.get_data():
+        try:
+            requested = [(int(part["PartNumber"]), part.get("ETag")) for part in json.loads(request.get_data())]
+        except (ValueError, TypeError, KeyError):
+            abort(400)
+        for part_number, etag in requested:
+            if part_number not in parts or (etag is not None and etag != parts[part_number]["ETag"]):
+                abort(400)
+        part_numbers = [part_number for part_number, _ in requested]
+        if part_numbers != sorted(set(part_numbers)):
+            abort(400)
+    if not part_numbers:
+        abort(400)
+
+    upload_path = make_upload_path(app.config["STORAGE_ROOT"], bucket_name, upload_id)
+    directory = upload_directory(bucket_name, object_name)
+    temp_path, size = concatenate_files(directory, [upload_path / str(n) for n in part_numbers],
+                                        sync=not app.config["DEDUP"])
+    # Blobs are named after the digest of their whole content, which the composite ETag is not
+    content_digest = None
+    if app.config["DEDUP"]:
+        content_digest = file_digest(temp_path)
+        temp_path = move_upload_to_blob_volume(temp_path, content_digest, upload["Headers"])
+
+    # Like S3, the ETag of a multipart object is the digest of the digests of its parts, suffixed with the part count
+    digest = hashlib.sha256(b"".join(bytes.fromhex(unquote_etag(parts[n]["ETag"])[0]) for n in part_numbers))
+    meta_data = dict(upload["Headers"])
+    meta_data["Content-Length"] = str(size)
+    meta_data["ETag"] = quote_etag(f"{digest.hexdigest()}-{len(part_numbers)}")
+    meta_data["Last-Modified"] = http_date(time.time())
+
+    with get_lmdb_env().begin(write=True) as tx:
+        if not delete_upload_records(tx, upload_id):
+            os.unlink(str(temp_path))
+            abort(404)
+        store_object(tx, bucket_name, object_name, meta_data, content_digest, temp_path=temp_path)
+
+    shutil.rmtree(str(upload_path), ignore_errors=True)
+    return jsonify({"Bucket": bucket_name, "Key": object_name, "ETag": meta_data["ETag"]})
+
+
+def delete_upload(bucket_name, object_name):
+    with get_lmdb_env().begin(write=True) as tx:
+        upload_id, _, _ = read_upload(tx, bucket_name, object_name)
+        delete_upload_records(tx, upload_id)
+    shutil.rmtree(str(make_upload_path(app.config["STORAGE_ROOT"], bucket_name, upload_id)), ignore_errors=True)
     return jsonify({})
+
+
+def cleanup_uploads(max_age):
+    """Aborts the uploads that were initiated more than max_age seconds ago. Returns how many."""
+    expired = []
+    with get_lmdb_env().begin() as tx:
+        for key, value in tx.cursor(db=get_lmdb_db(b"uploads")):
+            if b":" not in key:
+                upload = json.loads(value)
+                if upload["Initiated"] < time.time() - max_age:
+                    expired.append((key.decode(), upload["Bucket"]))
+    for upload_id, bucket_name in expired:
+        with get_lmdb_env().begin(write=True) as tx:
+            delete_upload_records(tx, upload_id)
+        shutil.rmtree(str(make_upload_path(app.config["STORAGE_ROOT"], bucket_name, upload_id)), ignore_errors=True)
+    return len(expired)
@@ -0,0 +1,145 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""
+Serves tss.app as an ASGI application, for example with
+
+    gunicorn -k uvicorn.workers.UvicornWorker --workers=2 tss_asgi:app
+
+The event loop only moves bytes between the connection and the WSGI app.
+Everything that can block, calling the app and reading each chunk of its
+response, runs on a pool of TSS_ASGI_THREADS threads. A thread is only
+held while a chunk is being produced, not while it is being sent, so slow
+clients downloading large objects do not tie up the pool. Uploads do hold
+a thread while the app waits for the next chunk of the request body.
+"""
+
+import asyncio
+import io
+import os
+import sys
+
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.wsgi import FileWrapper
+
+import tss
+
+
+THREADS = int(os.getenv("TSS_ASGI_THREADS", "64"))
+
+
+class RequestBody(io.RawIOBase):
+    """The body of an ASGI request as a blocking file for a WSGI app that runs in another thread than the loop."""
+
+    def __init__(self, loop, receive):
+        self.loop = loop
+        self.receive = receive
+        self.buffer = b""
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        # Only the end of the body may give a short read, which Werkzeug takes for a disconnected client
+        while len(self.buffer) < len(b) and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            self.buffer += message.get("body", b"")
+            self.more_body = message.get("more_body", False)
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def file_wrapper(f, buffer_size=tss.SEND_CHUNK_SIZE):
+    return FileWrapper(f, max(buffer_size, tss.SEND_CHUNK_SIZE))
+
+
+def make_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "REMOTE_ADDR": scope["client"][0] if scope.get("client") else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "wsgi.file_wrapper": file_wrapper,
+    }
+    for name, value in scope["headers"]:
+        name, value = name.decode("latin-1"), value.decode("latin-1")
+        if name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        elif name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = environ[key] + "," + value if key in environ else value
+    if "CONTENT_LENGTH" not in environ:
+        # The body is whatever arrives until the client is done, otherwise the app stops at Content-Length
+        environ["wsgi.input_terminated"] = True
+    return environ
+
+
+class ASGIApp:
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        # The running loop, get_running_loop() needs Python 3.7
+        loop = asyncio.get_event_loop()
+        executor = tss.get_executor("asgi", THREADS)
+        environ = make_environ(scope, RequestBody(loop, receive))
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+            return None
+
+        iterable = await loop.run_in_executor(executor, self.wsgi_app, environ, start_response)
+        try:
+            iterator = iter(iterable)
+            # start_response may be called as late as when the first chunk is produced
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+            await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(executor, next, iterator, None)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if hasattr(iterable, "close"):
+                await loop.run_in_executor(executor, iterable.close)
+
+
+app = ASGIApp(tss.app)